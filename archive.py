@@ -0,0 +1,84 @@
+# archive.py
+# Перенос закрытых поездок в холодный архив (attached-база taxi_archive.db,
+# схема archive). Живая таблица trips остаётся маленькой, горячие запросы бота
+# её и читают; история и аналитика объединяют оба хранилища через
+# db_utils.trips_source(), когда диапазон дат заходит в архив.
+#
+# Перенос идёт пакетами: каждый пакет — своя транзакция писателя, поэтому его
+# можно прервать и запустить снова. INSERT OR REPLACE в архив делает повтор
+# безопасным, даже если после сбоя строка успела попасть в обе базы.
+# Заодно с тем же порогом чистится журнал изменений trip_events.
+import os
+import time
+
+import db_utils
+import migrations
+import timeutil
+
+ARCHIVE_AFTER_DAYS = float(os.getenv("ARCHIVE_AFTER_DAYS", "30"))
+ARCHIVE_BATCH = int(os.getenv("ARCHIVE_BATCH", "1000"))
+# Как часто бот сам запускает архивацию, часов; 0 — только вручную (manage.py archive)
+ARCHIVE_INTERVAL_HOURS = float(os.getenv("ARCHIVE_INTERVAL_HOURS", "0"))
+
+CLOSED_STATUSES = ('completed', 'cancelled', 'cancelled_by_passenger', 'cancelled_by_driver', 'expired')
+
+
+@db_utils.writes
+def archive_batch(cur, cutoff_ts, batch=ARCHIVE_BATCH):
+    """Переносит до batch закрытых поездок, созданных раньше cutoff_ts. Возвращает их число."""
+    statuses = ", ".join("?" * len(CLOSED_STATUSES))
+    # Старые строки могут быть ещё без created_ts (его дозаполняет бот при старте) —
+    # для них сравниваем текстовое время
+    ids = [row[0] for row in cur.execute(
+        f"SELECT id FROM main.trips WHERE status IN ({statuses}) "
+        "AND (created_ts < ? OR (created_ts IS NULL AND created_at < ?)) ORDER BY id LIMIT ?",
+        (*CLOSED_STATUSES, cutoff_ts, timeutil.to_text(cutoff_ts), batch))]
+    if not ids:
+        return 0
+    marks = ", ".join("?" * len(ids))
+    # В архив строки попадают уже с *_ts: его запросы читают только их
+    migrations.convert_timestamps(cur, "trips", f"id IN ({marks})", ids)
+    columns = ", ".join(db_utils.TRIP_COLUMNS)
+    cur.execute(
+        f"INSERT OR REPLACE INTO archive.trips ({columns}, archived_ts) "
+        f"SELECT {columns}, ? FROM main.trips WHERE id IN ({marks})",
+        (timeutil.now_ts(), *ids))
+    cur.execute(f"DELETE FROM main.trip_messages WHERE trip_id IN ({marks})", ids)
+    # Удаление не трогает user_stats_rollup и выручку: их триггеры срабатывают только на INSERT/UPDATE
+    cur.execute(f"DELETE FROM main.trips WHERE id IN ({marks})", ids)
+    return len(ids)
+
+
+def run(older_than_days=ARCHIVE_AFTER_DAYS, batch=ARCHIVE_BATCH, pause=0.0, progress=None):
+    """Архивирует все подходящие поездки пакетами. Возвращает, сколько перенесено."""
+    cutoff = timeutil.from_now(days=-older_than_days)
+    while db_utils.prune_trip_events(cutoff, batch):
+        if pause:
+            time.sleep(pause)
+    if not db_utils.POOL.archive_path:
+        return 0
+    moved = 0
+    while True:
+        count = archive_batch(cutoff, batch)
+        if not count:
+            return moved
+        moved += count
+        if progress:
+            progress(moved)
+        if pause:
+            time.sleep(pause)
+
+
+@db_utils.reads
+def stats(cur):
+    live = cur.execute("SELECT COUNT(*) FROM main.trips").fetchone()[0]
+    if not db_utils.POOL.archive_path:
+        return {"live": live, "archived": None}
+    archived, oldest, newest = cur.execute(
+        "SELECT COUNT(*), MIN(created_ts), MAX(created_ts) FROM archive.trips").fetchone()
+    return {
+        "live": live,
+        "archived": archived,
+        "archived_from": timeutil.to_text(oldest),
+        "archived_to": timeutil.to_text(newest),
+    }
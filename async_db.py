@@ -0,0 +1,273 @@
+# async_db.py
+import os
+import asyncio
+import copy
+import functools
+import contextvars
+from collections import deque
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+
+import db_utils
+
+# DB_ASYNC=0 возвращает старое поведение (запросы прямо в цикле событий) —
+# удобно, чтобы сравнить задержку цикла до и после перехода.
+DB_ASYNC = os.getenv("DB_ASYNC", "1") != "0"
+DB_READ_WORKERS = int(os.getenv("DB_READ_WORKERS", str(max(db_utils.DB_READERS, 1))))
+
+_MISSING = object()
+
+# Результаты чтений, которые ReadBatcher раздаёт копиями, а не общим объектом
+_MUTABLE = (list, dict, set)
+
+# Карта идентичности поездок в рамках одного апдейта Telegram: trip_id -> Trip
+_TRIPS = contextvars.ContextVar("trip_identity_map", default=None)
+
+READ_EXECUTOR = ThreadPoolExecutor(max_workers=DB_READ_WORKERS, thread_name_prefix="db-read")
+WRITE_EXECUTOR = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-write")
+
+
+class ReadBatcher:
+    """Собирает чтения, пришедшие за одну итерацию цикла, в одну задачу пула.
+
+    Вся пачка выполняется на одном соединении-читателе, а одинаковые вызовы
+    (та же функция с теми же аргументами) выполняются один раз. Неизменяемый
+    результат (Trip, кортеж, число) ожидающие получают общий, а список, словарь
+    или множество — каждый свою копию, чтобы изменения одного обработчика не
+    видели другие.
+    """
+
+    def __init__(self, executor):
+        self._executor = executor
+        self._pending = {}
+        self._scheduled = False
+        self.batches = 0
+        self.calls = 0
+        self.deduplicated = 0
+
+    def submit(self, func, args, kwargs=None):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        kwargs = kwargs or {}
+        try:
+            key = (func, args, frozenset(kwargs.items()))
+            hash(key)
+        except TypeError:
+            key = (func, object())
+        entry = self._pending.get(key)
+        if entry:
+            entry[3].append(future)
+            self.deduplicated += 1
+        else:
+            self._pending[key] = (func, args, kwargs, [future])
+        self.calls += 1
+        if not self._scheduled:
+            self._scheduled = True
+            loop.call_soon(self._flush, loop)
+        return future
+
+    def _flush(self, loop):
+        batch, self._pending = self._pending, {}
+        self._scheduled = False
+        self.batches += 1
+        entries = list(batch.values())
+        try:
+            done = loop.run_in_executor(self._executor, self._run_batch, loop, entries)
+        except Exception as e:
+            # Пул уже остановлен — иначе ожидающие пачку зависли бы навсегда
+            self._fail(entries, e)
+            return
+        done.add_done_callback(functools.partial(self._check_batch, entries))
+
+    @staticmethod
+    def _check_batch(entries, done):
+        if not done.cancelled() and done.exception() is not None:
+            ReadBatcher._fail(entries, done.exception())
+
+    @staticmethod
+    def _fail(entries, error):
+        ReadBatcher._resolve([(futures, None, error) for *_, futures in entries])
+
+    @staticmethod
+    def _run_batch(loop, batch):
+        # Исключение вне отдельного вызова (например, не выдано соединение)
+        # уходит в future пула, а _flush передаёт его всем ожидающим
+        results = []
+        with db_utils.reader():
+            for func, args, kwargs, futures in batch:
+                try:
+                    results.append((futures, func(*args, **kwargs), None))
+                except Exception as e:
+                    results.append((futures, None, e))
+        loop.call_soon_threadsafe(ReadBatcher._resolve, results)
+
+    @staticmethod
+    def _resolve(results):
+        for futures, result, error in results:
+            shared = not isinstance(result, _MUTABLE)
+            for i, future in enumerate(futures):
+                if future.done():
+                    continue
+                if error is not None:
+                    future.set_exception(error)
+                else:
+                    future.set_result(result if shared or i == 0 else copy.deepcopy(result))
+
+    def stats(self):
+        return {"batches": self.batches, "calls": self.calls, "deduplicated": self.deduplicated}
+
+
+class AsyncDB:
+    """Асинхронное зеркало db_utils: await adb.get_trip(trip_id).
+
+    Функции, помеченные @reads, уходят в ReadBatcher, @writes — прямо в очередь
+    GroupCommitWriter (ожидание без занятого потока), остальные составные хелперы
+    — в отдельный поток. С другим хранилищем (attach) его методы вызываются в
+    своём пуле потоков.
+    """
+
+    def __init__(self):
+        self.batcher = ReadBatcher(READ_EXECUTOR)
+        self.identity_hits = 0
+        self.storage = None
+        self._storage_executor = None
+
+    def attach(self, storage):
+        """Переключает вызовы на storage; SQLiteStorage — это и есть db_utils, путь не меняется."""
+        if storage.name == "sqlite":
+            return
+        self.storage = storage
+        self._storage_executor = ThreadPoolExecutor(
+            max_workers=getattr(storage, "max_connections", DB_READ_WORKERS), thread_name_prefix="db-storage")
+
+    async def _call_storage(self, name, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        func = functools.partial(getattr(self.storage, name), *args, **kwargs)
+        return await loop.run_in_executor(self._storage_executor, func)
+
+    @contextmanager
+    def identity_scope(self):
+        """Внутри блока каждая поездка читается из БД не больше одного раза."""
+        token = _TRIPS.set({})
+        try:
+            yield
+        finally:
+            _TRIPS.reset(token)
+
+    async def get_trip(self, trip_id):
+        trips = _TRIPS.get()
+        if trips is not None and trip_id in trips:
+            self.identity_hits += 1
+            return trips[trip_id]
+        if self.storage is not None:
+            trip = await self._call_storage("get_trip", trip_id)
+        elif DB_ASYNC:
+            trip = await self.batcher.submit(db_utils.get_trip, (trip_id,))
+        else:
+            trip = db_utils.get_trip(trip_id)
+        if trips is not None and trip is not None:
+            trips[trip_id] = trip
+        return trip
+
+    async def get_user_context(self, telegram_id):
+        if self.storage is not None:
+            return await self._call_storage("get_user_context", telegram_id)
+        # Попадание в кэш отдаём прямо в цикле, без похода в пул потоков;
+        # бан берётся из памяти BanExpiryEngine
+        role = db_utils.USER_CACHE.get(telegram_id, _MISSING)
+        if role is _MISSING:
+            if DB_ASYNC:
+                role = await self.batcher.submit(db_utils.load_user_role, (telegram_id,))
+            else:
+                role = db_utils.load_user_role(telegram_id)
+        return db_utils.UserContext(role, *db_utils.BANS.status(telegram_id))
+
+    async def get_user_role(self, telegram_id):
+        return (await self.get_user_context(telegram_id)).role
+
+    async def is_user_banned(self, telegram_id):
+        if self.storage is not None:
+            return await self._call_storage("is_user_banned", telegram_id)
+        return db_utils.BANS.is_banned(telegram_id)
+
+    @staticmethod
+    def _remember(result):
+        # Изменяющие поездку функции возвращают свежую строку — она и попадает в карту
+        trips = _TRIPS.get()
+        if trips is not None and isinstance(result, db_utils.Trip):
+            trips[result.id] = result
+        return result
+
+    def __getattr__(self, name):
+        if self.storage is not None and name in self.storage.OPERATIONS:
+            async def call(*args, **kwargs):
+                return self._remember(await self._call_storage(name, *args, **kwargs))
+            call.__name__ = name
+            setattr(self, name, call)
+            return call
+        func = getattr(db_utils, name)
+        if not callable(func) or name.startswith('_'):
+            raise AttributeError(name)
+        call = self.wrap(func)
+        setattr(self, name, call)
+        return call
+
+    def wrap(self, func):
+        """Асинхронная обёртка функции с @reads/@writes (или составного хелпера) — как у функций db_utils."""
+        kind = getattr(func, 'db_kind', None)
+        if kind == 'read':
+            async def call(*args, **kwargs):
+                if not DB_ASYNC:
+                    return func(*args, **kwargs)
+                return await self.batcher.submit(func, args, kwargs)
+        elif kind == 'write':
+            async def call(*args, **kwargs):
+                if not DB_ASYNC:
+                    return self._remember(func(*args, **kwargs))
+                return self._remember(await asyncio.wrap_future(func.submit(*args, **kwargs)))
+        else:
+            async def call(*args, **kwargs):
+                if not DB_ASYNC:
+                    return func(*args, **kwargs)
+                loop = asyncio.get_running_loop()
+                return await loop.run_in_executor(WRITE_EXECUTOR, functools.partial(func, *args, **kwargs))
+        call.__name__ = func.__name__
+        return call
+
+
+class LoopLagMonitor:
+    """Измеряет задержку цикла событий: насколько позже просыпается sleep(interval)."""
+
+    def __init__(self, interval=0.1, window=3000):
+        self.interval = interval
+        self.samples = deque(maxlen=window)
+
+    async def run(self, report_every=None):
+        loop = asyncio.get_running_loop()
+        last_report = loop.time()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(self.interval)
+            now = loop.time()
+            self.samples.append(max(0.0, now - start - self.interval))
+            if report_every and now - last_report >= report_every:
+                last_report = now
+                print(f"Задержка цикла событий: {self.stats()}")
+
+    def stats(self):
+        if not self.samples:
+            return {"samples": 0}
+        ordered = sorted(self.samples)
+        n = len(ordered)
+        return {
+            "samples": n,
+            "avg_ms": round(sum(ordered) / n * 1000, 2),
+            "p50_ms": round(ordered[n // 2] * 1000, 2),
+            "p99_ms": round(ordered[min(n - 1, int(n * 0.99))] * 1000, 2),
+            "max_ms": round(ordered[-1] * 1000, 2),
+            "db_async": DB_ASYNC,
+        }
+
+
+adb = AsyncDB()
+LOOP_LAG = LoopLagMonitor()
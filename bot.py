@@ -3,37 +3,44 @@ import asyncio
 import threading
 import os
 import queue
-from datetime import datetime
 from aiogram import Bot, Dispatcher, types
+from aiogram.exceptions import TelegramAPIError
 from aiogram.filters import Command
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
 from aiogram.fsm.storage.memory import MemoryStorage
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.context import FSMContext
-from db_utils import (
-    init_db, get_user_role, save_user, create_trip, get_trip, assign_driver_to_trip,
-    mark_arrived, complete_trip, get_all_drivers, get_tariffs, get_driver_rating,
-    save_rating, get_cancellation_reasons, ban_user, unban_user, is_user_banned,
-    update_passenger_message_id, update_driver_message_id, update_driver_card_message_id,
-    update_passenger_fare_message_id, update_passenger_eta_message_id,
-    update_driver_fare_message_id, update_driver_eta_message_id,
-    update_driver_control_message_id, update_passenger_arrival_message_id,
-    update_driver_tariff_message_id, update_driver_eta_select_message_id,
-    get_ban_info, BROADCAST_QUEUE
-)
-
-# Инициализация БД
-DB = init_db()
+from async_db import adb, LOOP_LAG
+from storage import get_storage
+import archive
+import broadcasts
+import db_utils
+import deadlines
+import fanout
+import outbox
+import snapshot
+import timeutil
+
+# Инициализация БД: хранилище выбирается DB_BACKEND (sqlite | postgres)
+STORAGE = get_storage()
+adb.attach(STORAGE)
 
 # Конфигурация
 BOT_TOKEN = os.getenv("BOT_TOKEN", "your_bot_token")
-ORDER_TIMEOUT = 10  # минут
+ORDER_TIMEOUT = deadlines.ORDER_TIMEOUT  # минут на принятие заказа
+CONFIRM_TIMEOUT = deadlines.CONFIRM_TIMEOUT  # минут водителю на выбор цены
+LOOP_LAG_REPORT_INTERVAL = int(os.getenv("LOOP_LAG_REPORT_INTERVAL", "300"))  # секунд, 0 — не печатать
+BACKFILL_BATCH = int(os.getenv("BACKFILL_BATCH", "1000"))  # строк в пакете дозаполнения *_ts
+BACKFILL_PAUSE = float(os.getenv("BACKFILL_PAUSE", "0.05"))  # секунд между пакетами
 
 ACTIVE_ORDER_MESSAGES = {}
 ACTIVE_DRIVERS = set()  # Множество активных водителей
+_BACKGROUND_TASKS = set()  # ссылки на фоновые рассылки, чтобы их не собрал GC
 
 # Инициализация бота
 bot = Bot(token=BOT_TOKEN)
+# Все исходящие запросы — через планировщик: приоритеты, лимиты, RetryAfter
+outbox.install(bot)
 dp = Dispatcher(storage=MemoryStorage())
 
 # Состояния для FSM
@@ -44,76 +51,98 @@ class OrderState(StatesGroup):
 class ManualFareState(StatesGroup):
     waiting_for_fare = State()
 
+# Одна карта идентичности поездок на каждый апдейт
+@dp.update.outer_middleware()
+async def trip_identity_map(handler, event, data):
+    with adb.identity_scope():
+        return await handler(event, data)
+
 # Вспомогательные функции
 async def check_ban(user_id):
-    if is_user_banned(user_id):
-        ban_info = get_ban_info(user_id)
-        if ban_info:
-            reason, banned_until = ban_info
-            if banned_until:
-                banned_until_date = datetime.strptime(banned_until, '%Y-%m-%d %H:%M:%S')
-                days_left = (banned_until_date - datetime.now()).days
-                duration_text = f"на {days_left} дней"
-            else:
-                duration_text = "навсегда"
-            try:
+    context = await adb.get_user_context(user_id)
+    if context.is_banned:
+        if context.banned_until:
+            days_left = timeutil.days_left(timeutil.to_ts(context.banned_until, local=True))
+            duration_text = f"на {days_left} дней"
+        else:
+            duration_text = "навсегда"
+        try:
+            with outbox.priority(outbox.NOTICE):
                 await bot.send_message(
                     user_id, 
-                    f"🚫 Вы забанены по причине: {reason}, {duration_text}."
+                    f"🚫 Вы забанены по причине: {context.ban_reason}, {duration_text}."
                 )
-            except:
-                pass
+        except TelegramAPIError:
+            pass
         return True
     return False
 
-async def cancel_trip_cleanup(trip_id, cancelled_by, reason_text=None):
-    trip = get_trip(trip_id)
-    if not trip:
-        return
-    passenger_id = trip[1]
-    driver_id = trip[2]
-    messages_to_delete = [
-        (passenger_id, trip[11]), (driver_id, trip[12]), (passenger_id, trip[13]),
-        (passenger_id, trip[14]), (passenger_id, trip[15]), (driver_id, trip[16]),
-        (driver_id, trip[17]), (driver_id, trip[18]), (passenger_id, trip[19]),
-        (driver_id, trip[21]), (driver_id, trip[22])
-    ]
-    for chat_id, msg_id in messages_to_delete:
-        if msg_id:
+async def delete_trip_messages(trip_id):
+    """Удаляет все сообщения поездки: одно чтение из БД и пачки delete_messages по чатам."""
+    messages = await adb.get_trip_messages(trip_id)
+    for chat_id, message_ids in messages.items():
+        # Telegram принимает не больше 100 ID за вызов
+        for i in range(0, len(message_ids), 100):
             try:
-                await bot.delete_message(chat_id=chat_id, message_id=msg_id)
-            except:
+                await bot.delete_messages(chat_id=chat_id, message_ids=message_ids[i:i + 100])
+            except TelegramAPIError:
                 pass
-    if trip_id in ACTIVE_ORDER_MESSAGES:
-        for drv_id, msg_id in ACTIVE_ORDER_MESSAGES[trip_id].items():
-            try:
-                await bot.delete_message(chat_id=drv_id, message_id=msg_id)
-            except:
-                pass
-        del ACTIVE_ORDER_MESSAGES[trip_id]
+    if messages:
+        await adb.delete_trip_messages(trip_id)
+
+async def withdraw_offers(trip_id, keep=None):
+    """Удаляет у водителей предложения заказа (кроме водителя keep)."""
+    offers = ACTIVE_ORDER_MESSAGES.pop(trip_id, None) or {}
+    for drv_id, msg_id in offers.items():
+        if drv_id == keep:
+            continue
+        try:
+            await bot.delete_message(chat_id=drv_id, message_id=msg_id)
+        except TelegramAPIError:
+            pass
+
+CANCEL_STATUSES = {'admin': 'cancelled', 'driver': 'cancelled_by_driver', 'passenger': 'cancelled_by_passenger'}
+
+async def cancel_trip_cleanup(trip_id, cancelled_by, reason_text=None, trip=None, user_id=None):
+    """Отменяет поездку и уведомляет участников; trip — строка, если отмена уже записана.
+
+    user_id — кто отменяет; водитель отменяет только свою поездку.
+    Возвращает отменённую поездку или None, если отменять уже нечего.
+    """
+    if trip is None:
+        # Отмена — переход состояния: уже завершённую или отменённую поездку
+        # повторное нажатие не трогает, и отмена не засчитывается дважды
+        trip = await adb.cancel_trip(trip_id, CANCEL_STATUSES[cancelled_by], reason_text,
+                                     user_id if cancelled_by == 'driver' else None)
+        if not trip:
+            return None
+        cancelled_by_id = {'driver': trip.driver_id, 'passenger': trip.passenger_id}.get(cancelled_by)
+        if cancelled_by_id:
+            await adb.increment_cancel_count(cancelled_by_id)
+    deadlines.DEADLINES.disarm_all(trip_id)
+    passenger_id = trip.passenger_id
+    driver_id = trip.driver_id
+    await delete_trip_messages(trip_id)
+    await withdraw_offers(trip_id)
     if cancelled_by == 'driver':
-        if driver_id: 
-            await bot.send_message(driver_id, f"✅ Вы отменили заказ по причине: {reason_text}")
-        if passenger_id: 
-            await bot.send_message(passenger_id, f"❌ Водитель отменил заказ по причине: {reason_text}")
+        notices = [(driver_id, f"✅ Вы отменили заказ по причине: {reason_text}"),
+                   (passenger_id, f"❌ Водитель отменил заказ по причине: {reason_text}")]
     elif cancelled_by == 'passenger':
-        if passenger_id: 
-            await bot.send_message(passenger_id, f"✅ Вы отменили заказ по причине: {reason_text}")
-        if driver_id: 
-            await bot.send_message(driver_id, f"❌ Пассажир отменил заказ по причине: {reason_text}")
-    elif cancelled_by == 'admin':
-        # Отправляем сообщение всем участникам о отмене диспетчером
-        if passenger_id:
-            await bot.send_message(passenger_id, f"❌ Заказ отменен диспетчером. Причина: {reason_text or 'не указана'}")
-        if driver_id:
-            await bot.send_message(driver_id, f"❌ Заказ отменен диспетчером. Причина: {reason_text or 'не указана'}")
-    cur = DB.cursor()
-    if cancelled_by == 'admin':
-        status = 'cancelled'
+        notices = [(passenger_id, f"✅ Вы отменили заказ по причине: {reason_text}"),
+                   (driver_id, f"❌ Пассажир отменил заказ по причине: {reason_text}")]
     else:
-        status = 'cancelled_by_driver' if cancelled_by == 'driver' else 'cancelled_by_passenger'
-    cur.execute("UPDATE trips SET status = ?, cancellation_reason = ? WHERE id = ?", (status, reason_text, trip_id))
-    DB.commit()
+        # Отмена диспетчером — сообщение всем участникам
+        text = f"❌ Заказ отменен диспетчером. Причина: {reason_text or 'не указана'}"
+        notices = [(passenger_id, text), (driver_id, text)]
+    # Отмена уже записана: заблокированный бот или удалённый чат не должны прерывать обработчик
+    for chat_id, text in notices:
+        if not chat_id:
+            continue
+        try:
+            await bot.send_message(chat_id, text)
+        except TelegramAPIError:
+            pass
+    return trip
 
 def get_main_menu():
     """Главное меню с inline-кнопками для пассажиров"""
@@ -145,12 +174,12 @@ def get_back_menu():
 async def cmd_start(message: types.Message):
     if await check_ban(message.from_user.id):
         return
-    save_user(message.from_user.id, message.from_user.username, message.from_user.first_name)
+    await adb.save_user(message.from_user.id, message.from_user.username, message.from_user.first_name)
     welcome_text = (
         "🚕 Добро пожаловать в службу такси!\n"
         "Выберите действие:"
     )
-    user_role = get_user_role(message.from_user.id) or "passenger"
+    user_role = await adb.get_user_role(message.from_user.id) or "passenger"
     if user_role == "driver":
         await message.answer(welcome_text, reply_markup=get_driver_menu())
     else:
@@ -160,7 +189,7 @@ async def cmd_start(message: types.Message):
 async def cmd_menu(message: types.Message):
     if await check_ban(message.from_user.id):
         return
-    user_role = get_user_role(message.from_user.id) or "passenger"
+    user_role = await adb.get_user_role(message.from_user.id) or "passenger"
     if user_role == "driver":
         await message.answer("Главное меню:", reply_markup=get_driver_menu())
     else:
@@ -171,7 +200,7 @@ async def cmd_menu(message: types.Message):
 async def main_menu_callback(callback: types.CallbackQuery):
     if await check_ban(callback.from_user.id):
         return
-    user_role = get_user_role(callback.from_user.id) or "passenger"
+    user_role = await adb.get_user_role(callback.from_user.id) or "passenger"
     if user_role == "driver":
         await callback.message.edit_text("Главное меню:", reply_markup=get_driver_menu())
     else:
@@ -182,7 +211,7 @@ async def main_menu_callback(callback: types.CallbackQuery):
 async def order_taxi_callback(callback: types.CallbackQuery, state: FSMContext):
     if await check_ban(callback.from_user.id):
         return
-    if get_user_role(callback.from_user.id) != "passenger":
+    if await adb.get_user_role(callback.from_user.id) != "passenger":
         await callback.answer("❌ Только пассажиры могут заказывать такси.", show_alert=True)
         return
     await callback.message.edit_text(
@@ -198,7 +227,7 @@ async def order_taxi_callback(callback: types.CallbackQuery, state: FSMContext):
 async def become_available_callback(callback: types.CallbackQuery):
     if await check_ban(callback.from_user.id):
         return
-    if get_user_role(callback.from_user.id) != "driver":
+    if await adb.get_user_role(callback.from_user.id) != "driver":
         await callback.answer("❌ Только водители могут становиться доступными.", show_alert=True)
         return
     ACTIVE_DRIVERS.add(callback.from_user.id)
@@ -215,7 +244,7 @@ async def become_available_callback(callback: types.CallbackQuery):
 async def stop_accepting_callback(callback: types.CallbackQuery):
     if await check_ban(callback.from_user.id):
         return
-    if get_user_role(callback.from_user.id) != "driver":
+    if await adb.get_user_role(callback.from_user.id) != "driver":
         await callback.answer("❌ Только водители могут использовать эту функцию.", show_alert=True)
         return
     if callback.from_user.id in ACTIVE_DRIVERS:
@@ -232,21 +261,10 @@ async def stop_accepting_callback(callback: types.CallbackQuery):
 async def my_stats_callback(callback: types.CallbackQuery):
     if await check_ban(callback.from_user.id):
         return
-    user_role = get_user_role(callback.from_user.id)
+    user_role = await adb.get_user_role(callback.from_user.id)
     if user_role == "driver":
         # Статистика для водителя - ТОЛЬКО завершенные поездки
-        cur = DB.cursor()
-        cur.execute('''
-            SELECT 
-                COUNT(DISTINCT t.id) as completed_orders,
-                SUM(t.fare) as total_earnings,
-                AVG(r.rating) as avg_rating
-            FROM users u
-            LEFT JOIN trips t ON u.telegram_id = t.driver_id AND t.status = 'completed'
-            LEFT JOIN ratings r ON t.id = r.trip_id
-            WHERE u.telegram_id = ?
-        ''', (callback.from_user.id,))
-        stats = cur.fetchone()
+        stats = await adb.get_driver_stats(callback.from_user.id)
         completed_orders = stats[0] or 0
         total_earnings = stats[1] or 0
         avg_rating = round(stats[2], 1) if stats[2] else "еще нет"
@@ -259,13 +277,7 @@ async def my_stats_callback(callback: types.CallbackQuery):
         )
     else:
         # Статистика для пассажира
-        cur = DB.cursor()
-        cur.execute('''
-            SELECT COUNT(*) 
-            FROM trips 
-            WHERE passenger_id = ? AND status = 'completed'
-        ''', (callback.from_user.id,))
-        completed_trips = cur.fetchone()[0] or 0
+        completed_trips = await adb.get_passenger_completed_count(callback.from_user.id)
         stats_text = (
             f"📊 <b>Ваша статистика:</b>\n"
             f"🚕 Совершено поездок: <b>{completed_trips}</b>\n"
@@ -301,7 +313,7 @@ async def contacts_callback(callback: types.CallbackQuery):
 async def help_callback(callback: types.CallbackQuery):
     if await check_ban(callback.from_user.id):
         return
-    user_role = get_user_role(callback.from_user.id) or "passenger"
+    user_role = await adb.get_user_role(callback.from_user.id) or "passenger"
     if user_role == "driver":
         help_text = (
             "ℹ️ <b>Помощь для водителей</b>\n"
@@ -379,7 +391,8 @@ async def process_destination(message: types.Message, state: FSMContext):
     pickup = data["pickup"]
     destination = message.text
     # Создаем заказ
-    trip_id = create_trip(message.from_user.id, pickup, destination)
+    trip_id = await adb.create_trip(message.from_user.id, pickup, destination)
+    deadlines.DEADLINES.arm(deadlines.EXPIRE, trip_id, timeutil.from_now(minutes=ORDER_TIMEOUT))
     sent_passenger = await message.answer(
         "🚕 <b>Ваш заказ принят в обработку</b>\n"
         f"📍 <b>Откуда:</b> {pickup}\n"
@@ -390,31 +403,68 @@ async def process_destination(message: types.Message, state: FSMContext):
             [InlineKeyboardButton(text="❌ Отменить заказ", callback_data=f"cancel_passenger_{trip_id}")]
         ])
     )
-    update_passenger_message_id(trip_id, sent_passenger.message_id)
-    # Рассылка только активным водителям
-    active_drivers = [driver_id for driver_id in ACTIVE_DRIVERS if not is_user_banned(driver_id)]
-    if not active_drivers:
+    await adb.add_trip_message(trip_id, message.from_user.id, sent_passenger.message_id, 'passenger_order')
+    if not await publish_order(trip_id, pickup, destination):
         await message.answer("❌ В данный момент нет активных водителей.")
-    else:
-        ACTIVE_ORDER_MESSAGES[trip_id] = {}
-        for driver_id in active_drivers:
-            sent_driver = await bot.send_message(
-                driver_id,
-                "🚕 <b>Новый заказ!</b>\n"
-                f"📍 <b>Откуда:</b> {pickup}\n"
-                f"📍 <b>Куда:</b> {destination}\n"
-                "Нажмите «✅ Принять», чтобы взять заказ.",
-                reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-                    [
-                        InlineKeyboardButton(text="✅ Принять", callback_data=f"accept_{trip_id}"),
-                        InlineKeyboardButton(text="❌ Отказаться", callback_data=f"reject_{trip_id}")
-                    ]
-                ]),
-                parse_mode="HTML"
-            )
-            ACTIVE_ORDER_MESSAGES[trip_id][driver_id] = sent_driver.message_id
     await state.clear()
 
+async def publish_order(trip_id, pickup, destination, exclude=()):
+    """Начинает рассылку заказа активным водителям (кроме exclude). False — рассылать некому."""
+    # Рассылка только активным водителям; проверки бана идут одновременно
+    drivers = [driver_id for driver_id in ACTIVE_DRIVERS if driver_id not in exclude]
+    banned = await asyncio.gather(*(adb.is_user_banned(driver_id) for driver_id in drivers))
+    active_drivers = [driver_id for driver_id, is_banned in zip(drivers, banned) if not is_banned]
+    if not active_drivers:
+        return False
+    # Рассылка идёт в фоне: обработчик пассажира не ждёт, пока её получат все водители
+    ACTIVE_ORDER_MESSAGES[trip_id] = {}
+    task = asyncio.create_task(offer_order(trip_id, pickup, destination, active_drivers))
+    _BACKGROUND_TASKS.add(task)
+    task.add_done_callback(_BACKGROUND_TASKS.discard)
+    return True
+
+async def offer_order(trip_id, pickup, destination, driver_ids):
+    """Рассылает заказ водителям; ID предложений попадают в ACTIVE_ORDER_MESSAGES по мере отправки."""
+    offers = ACTIVE_ORDER_MESSAGES.get(trip_id)
+    if offers is None:
+        return
+
+    def is_open():
+        # Принятие, отмена и просрочка заказа убирают его из ACTIVE_ORDER_MESSAGES
+        return ACTIVE_ORDER_MESSAGES.get(trip_id) is offers
+
+    async def on_sent(driver_id, sent):
+        if is_open():
+            offers[driver_id] = sent.message_id
+            return
+        # Заказ закрыли, пока предложение было в пути
+        try:
+            await bot.delete_message(chat_id=driver_id, message_id=sent.message_id)
+        except TelegramAPIError:
+            pass
+
+    text = (
+        "🚕 <b>Новый заказ!</b>\n"
+        f"📍 <b>Откуда:</b> {pickup}\n"
+        f"📍 <b>Куда:</b> {destination}\n"
+        "Нажмите «✅ Принять», чтобы взять заказ."
+    )
+    markup = InlineKeyboardMarkup(inline_keyboard=[
+        [
+            InlineKeyboardButton(text="✅ Принять", callback_data=f"accept_{trip_id}"),
+            InlineKeyboardButton(text="❌ Отказаться", callback_data=f"reject_{trip_id}")
+        ]
+    ])
+    try:
+        stats = await fanout.FANOUT.run(
+            trip_id, driver_ids,
+            lambda driver_id: bot.send_message(driver_id, text, reply_markup=markup, parse_mode="HTML"),
+            on_sent, is_open)
+        print(f"Заказ {trip_id}: предложение получили {stats['sent']}/{stats['recipients']} водителей "
+              f"за {stats['seconds']} с (первый — через {stats['first_seconds']} с)")
+    except Exception as e:
+        print(f"Ошибка рассылки заказа {trip_id}: {e}")
+
 # Callback-хендлеры для заказов
 @dp.callback_query(lambda c: c.data.startswith("accept_"))
 async def accept_trip(callback: types.CallbackQuery):
@@ -425,31 +475,29 @@ async def accept_trip(callback: types.CallbackQuery):
         await callback.answer("❌ Сначала станьте доступным для получения заказов.", show_alert=True)
         return
     trip_id = int(callback.data.split("_")[1])
-    if assign_driver_to_trip(trip_id, callback.from_user.id):
-        if trip_id in ACTIVE_ORDER_MESSAGES:
-            for drv_id, msg_id in ACTIVE_ORDER_MESSAGES[trip_id].items():
-                if drv_id != callback.from_user.id:
-                    try:
-                        await bot.delete_message(chat_id=drv_id, message_id=msg_id)
-                    except:
-                        pass
-            del ACTIVE_ORDER_MESSAGES[trip_id]
-        trip = get_trip(trip_id)
+    # Водитель должен назначить цену за CONFIRM_TIMEOUT минут, иначе заказ вернётся в пул
+    confirm_by = timeutil.from_now(minutes=CONFIRM_TIMEOUT) if CONFIRM_TIMEOUT else None
+    trip = await adb.assign_driver_to_trip(trip_id, callback.from_user.id, confirm_by)
+    if trip:
+        deadlines.DEADLINES.disarm(deadlines.EXPIRE, trip_id)
+        if confirm_by:
+            deadlines.DEADLINES.arm(deadlines.CONFIRM, trip_id, confirm_by)
+        await withdraw_offers(trip_id, keep=callback.from_user.id)
         # Улучшенное сообщение для водителя
         await callback.message.edit_text(
             f"✅ <b>Заказ принят!</b>\n"
             f"📋 <b>Заказ №{trip_id}</b>\n"
-            f"📍 <b>Откуда:</b> {trip[4]}\n"
-            f"📍 <b>Куда:</b> {trip[5]}\n"
+            f"📍 <b>Откуда:</b> {trip.pickup}\n"
+            f"📍 <b>Куда:</b> {trip.destination}\n"
             f"Выберите тариф или укажите свою стоимость:",
             parse_mode="HTML",
             reply_markup=InlineKeyboardMarkup(inline_keyboard=[
                 [InlineKeyboardButton(text="❌ Отменить заказ", callback_data=f"cancel_driver_{trip_id}")]
             ])
         )
-        update_driver_message_id(trip_id, callback.message.message_id)
+        trip_messages = [(callback.from_user.id, callback.message.message_id, 'driver_order')]
         # Тарифы + кнопка ручного ввода
-        tariffs = get_tariffs()
+        tariffs = await adb.get_tariffs()
         kb_rows = []
         for _, name, price in tariffs:
             kb_rows.append([InlineKeyboardButton(text=f"{name} — {price} ₽", callback_data=f"setfare_{trip_id}_{price}")])
@@ -460,14 +508,10 @@ async def accept_trip(callback: types.CallbackQuery):
             "Выберите тариф для поездки:", 
             reply_markup=InlineKeyboardMarkup(inline_keyboard=kb_rows)
         )
-        update_driver_tariff_message_id(trip_id, tariff_message.message_id)
+        trip_messages.append((callback.from_user.id, tariff_message.message_id, 'driver_tariff'))
         # Отправляем информацию о водителе пассажиру
-        cur = DB.cursor()
-        driver = cur.execute("""
-            SELECT full_name, car_brand, car_model, license_plate, phone_number, payment_number, bank_name
-            FROM users WHERE telegram_id = ?
-        """, (callback.from_user.id,)).fetchone()
-        driver_rating = get_driver_rating(callback.from_user.id)
+        driver = await adb.get_driver_profile(callback.from_user.id)
+        driver_rating = await adb.get_driver_rating(callback.from_user.id)
         if driver:
             full_name, car_brand, car_model, license_plate, phone_number, payment_number, bank_name = driver
             car_info = f"{car_brand} {car_model}".strip()
@@ -488,16 +532,17 @@ async def accept_trip(callback: types.CallbackQuery):
                 driver_card += f"\n⭐ <b>Рейтинг:</b> {driver_rating}/5"
         try:
             sent_card = await bot.send_message(
-                trip[1], 
+                trip.passenger_id, 
                 driver_card, 
                 parse_mode="HTML",
                 reply_markup=InlineKeyboardMarkup(inline_keyboard=[
                     [InlineKeyboardButton(text="❌ Отменить заказ", callback_data=f"cancel_passenger_{trip_id}")]
                 ])
             )
-            update_driver_card_message_id(trip_id, sent_card.message_id)
-        except:
+            trip_messages.append((trip.passenger_id, sent_card.message_id, 'driver_card'))
+        except TelegramAPIError:
             pass
+        await adb.add_trip_messages(trip_id, trip_messages)
     else:
         await callback.message.edit_text("⚠️ Заказ уже принят другим водителем.")
     await callback.answer()
@@ -533,11 +578,13 @@ async def process_manual_fare(message: types.Message, state: FSMContext):
     data = await state.get_data()
     trip_id = data["trip_id"]
     # Сохраняем стоимость
-    cur = DB.cursor()
-    cur.execute("UPDATE trips SET fare = ? WHERE id = ?", (fare, trip_id))
-    DB.commit()
-    trip = get_trip(trip_id)
-    passenger_id = trip[1]
+    trip = await adb.set_trip_fare(trip_id, fare, message.from_user.id)
+    if not trip:
+        await message.answer("Заказ не найден или уже завершён.")
+        await state.clear()
+        return
+    deadlines.DEADLINES.disarm(deadlines.CONFIRM, trip_id)
+    passenger_id = trip.passenger_id
     # Обновляем сообщение для водителя
     await message.answer(
         f"✅ <b>Стоимость установлена:</b> {fare:.2f} ₽",
@@ -553,7 +600,6 @@ async def process_manual_fare(message: types.Message, state: FSMContext):
             [InlineKeyboardButton(text="❌ Отменить заказ", callback_data=f"cancel_passenger_{trip_id}")]
         ])
     )
-    update_passenger_fare_message_id(trip_id, sent_fare.message_id)
     # Предлагаем выбрать время прибытия
     time_kb = InlineKeyboardMarkup(inline_keyboard=[
         [
@@ -573,7 +619,10 @@ async def process_manual_fare(message: types.Message, state: FSMContext):
         parse_mode="HTML",
         reply_markup=time_kb
     )
-    update_driver_eta_select_message_id(trip_id, eta_select_message.message_id)
+    await adb.add_trip_messages(trip_id, [
+        (passenger_id, sent_fare.message_id, 'passenger_fare'),
+        (message.from_user.id, eta_select_message.message_id, 'driver_eta_select'),
+    ])
     await state.clear()
 
 @dp.callback_query(lambda c: c.data.startswith("reject_"))
@@ -583,7 +632,7 @@ async def reject_trip(callback: types.CallbackQuery):
     trip_id = int(callback.data.split("_")[1])
     try:
         await callback.message.delete()
-    except:
+    except TelegramAPIError:
         pass
     if trip_id in ACTIVE_ORDER_MESSAGES and callback.from_user.id in ACTIVE_ORDER_MESSAGES[trip_id]:
         del ACTIVE_ORDER_MESSAGES[trip_id][callback.from_user.id]
@@ -596,12 +645,12 @@ async def set_fare(callback: types.CallbackQuery):
     _, trip_id_str, fare_str = callback.data.split("_")
     trip_id = int(trip_id_str)
     fare = float(fare_str)
-    cur = DB.cursor()
-    cur.execute("UPDATE trips SET fare = ? WHERE id = ?", (fare, trip_id))
-    DB.commit()
-    trip = get_trip(trip_id)
-    passenger_id = trip[1]
-    update_driver_fare_message_id(trip_id, callback.message.message_id)
+    trip = await adb.set_trip_fare(trip_id, fare, callback.from_user.id)
+    if not trip:
+        await callback.answer("Заказ не найден или уже завершён.", show_alert=True)
+        return
+    deadlines.DEADLINES.disarm(deadlines.CONFIRM, trip_id)
+    passenger_id = trip.passenger_id
     # Улучшенное сообщение для водителя
     await callback.message.edit_text(
         f"✅ <b>Стоимость установлена:</b> {fare:.2f} ₽",
@@ -617,7 +666,6 @@ async def set_fare(callback: types.CallbackQuery):
             [InlineKeyboardButton(text="❌ Отменить заказ", callback_data=f"cancel_passenger_{trip_id}")]
         ])
     )
-    update_passenger_fare_message_id(trip_id, sent_fare.message_id)
     time_kb = InlineKeyboardMarkup(inline_keyboard=[
         [
             InlineKeyboardButton(text="5 мин", callback_data=f"eta_{trip_id}_5"),
@@ -636,7 +684,11 @@ async def set_fare(callback: types.CallbackQuery):
         parse_mode="HTML",
         reply_markup=time_kb
     )
-    update_driver_eta_select_message_id(trip_id, eta_select_message.message_id)
+    await adb.add_trip_messages(trip_id, [
+        (callback.from_user.id, callback.message.message_id, 'driver_fare'),
+        (passenger_id, sent_fare.message_id, 'passenger_fare'),
+        (callback.from_user.id, eta_select_message.message_id, 'driver_eta_select'),
+    ])
 
 @dp.callback_query(lambda c: c.data.startswith("eta_"))
 async def set_eta(callback: types.CallbackQuery):
@@ -645,11 +697,11 @@ async def set_eta(callback: types.CallbackQuery):
     _, trip_id_str, minutes_str = callback.data.split("_")
     trip_id = int(trip_id_str)
     minutes = int(minutes_str)
-    trip = get_trip(trip_id)
-    if not trip or not trip[1]:
+    trip = await adb.get_trip(trip_id)
+    if not trip or not trip.passenger_id:
         await callback.answer("Заказ не найден.", show_alert=True)
         return
-    passenger_id = trip[1]
+    passenger_id = trip.passenger_id
     text = f"Водитель прибудет на место через {minutes} минут" if minutes != 60 else "Водитель прибудет на место более чем через 30 минут"
     sent_eta = await bot.send_message(
         passenger_id, 
@@ -659,8 +711,6 @@ async def set_eta(callback: types.CallbackQuery):
             [InlineKeyboardButton(text="❌ Отменить заказ", callback_data=f"cancel_passenger_{trip_id}")]
         ])
     )
-    update_passenger_eta_message_id(trip_id, sent_eta.message_id)
-    update_driver_eta_message_id(trip_id, callback.message.message_id)
     ride_kb = InlineKeyboardMarkup(inline_keyboard=[
         [
             InlineKeyboardButton(text="🚗 Я на месте", callback_data=f"arrived_{trip_id}"),
@@ -677,7 +727,11 @@ async def set_eta(callback: types.CallbackQuery):
         parse_mode="HTML",
         reply_markup=ride_kb
     )
-    update_driver_control_message_id(trip_id, control_message.message_id)
+    await adb.add_trip_messages(trip_id, [
+        (passenger_id, sent_eta.message_id, 'passenger_eta'),
+        (callback.from_user.id, callback.message.message_id, 'driver_eta'),
+        (callback.from_user.id, control_message.message_id, 'driver_control'),
+    ])
     await callback.answer()
 
 @dp.callback_query(lambda c: c.data.startswith("arrived_"))
@@ -685,19 +739,22 @@ async def confirm_arrival(callback: types.CallbackQuery):
     if await check_ban(callback.from_user.id):
         return
     trip_id = int(callback.data.split("_")[1])
-    mark_arrived(trip_id)
-    trip = get_trip(trip_id)
+    trip = await adb.mark_arrived(trip_id, callback.from_user.id)
+    if not trip:
+        # Повторное нажатие или заказ уже отменён — переход не выполнен
+        await callback.answer("Заказ не найден или уже не ожидает водителя.", show_alert=True)
+        return
     try:
         arrival_message = await bot.send_message(
-            trip[1], 
+            trip.passenger_id, 
             "🚗 <b>Водитель подтвердил прибытие! Поездка началась.</b>",
             parse_mode="HTML",
             reply_markup=InlineKeyboardMarkup(inline_keyboard=[
                 [InlineKeyboardButton(text="❌ Отменить заказ", callback_data=f"cancel_passenger_{trip_id}")]
             ])
         )
-        update_passenger_arrival_message_id(trip_id, arrival_message.message_id)
-    except:
+        await adb.add_trip_message(trip_id, trip.passenger_id, arrival_message.message_id, 'passenger_arrival')
+    except TelegramAPIError:
         pass
     complete_kb = InlineKeyboardMarkup(inline_keyboard=[
         [InlineKeyboardButton(text="✅ Завершить поездку", callback_data=f"complete_{trip_id}")],
@@ -716,7 +773,7 @@ async def cancel_by_driver(callback: types.CallbackQuery):
     if await check_ban(callback.from_user.id):
         return
     trip_id = int(callback.data.split("_")[2])
-    reasons = get_cancellation_reasons('driver')
+    reasons = await adb.get_cancellation_reasons('driver')
     if not reasons:
         await callback.answer("Нет доступных причин отмены")
         return
@@ -731,10 +788,10 @@ async def cancel_driver_reason(callback: types.CallbackQuery):
     parts = callback.data.split("_")
     trip_id = int(parts[3])
     reason_id = int(parts[4])
-    cur = DB.cursor()
-    reason = cur.execute("SELECT reason_text FROM cancellation_reasons WHERE id = ?", (reason_id,)).fetchone()
-    reason_text = reason[0] if reason else "Не указана"
-    await cancel_trip_cleanup(trip_id, 'driver', reason_text)
+    reason_text = await adb.get_cancellation_reason_text(reason_id) or "Не указана"
+    if not await cancel_trip_cleanup(trip_id, 'driver', reason_text, user_id=callback.from_user.id):
+        await callback.answer("Заказ уже завершён или отменён.", show_alert=True)
+        return
     await callback.answer()
 
 @dp.callback_query(lambda c: c.data.startswith("cancel_passenger_") and not c.data.startswith("cancel_passenger_reason_"))
@@ -742,7 +799,7 @@ async def cancel_by_passenger(callback: types.CallbackQuery):
     if await check_ban(callback.from_user.id):
         return
     trip_id = int(callback.data.split("_")[2])
-    reasons = get_cancellation_reasons('passenger')
+    reasons = await adb.get_cancellation_reasons('passenger')
     if not reasons:
         await callback.answer("Нет доступных причин отмены")
         return
@@ -757,10 +814,10 @@ async def cancel_passenger_reason(callback: types.CallbackQuery):
     parts = callback.data.split("_")
     trip_id = int(parts[3])
     reason_id = int(parts[4])
-    cur = DB.cursor()
-    reason = cur.execute("SELECT reason_text FROM cancellation_reasons WHERE id = ?", (reason_id,)).fetchone()
-    reason_text = reason[0] if reason else "Не указана"
-    await cancel_trip_cleanup(trip_id, 'passenger', reason_text)
+    reason_text = await adb.get_cancellation_reason_text(reason_id) or "Не указана"
+    if not await cancel_trip_cleanup(trip_id, 'passenger', reason_text):
+        await callback.answer("Заказ уже завершён или отменён.", show_alert=True)
+        return
     await callback.answer()
 
 @dp.callback_query(lambda c: c.data.startswith("complete_"))
@@ -768,28 +825,19 @@ async def complete_ride(callback: types.CallbackQuery):
     if await check_ban(callback.from_user.id):
         return
     trip_id = int(callback.data.split("_")[1])
-    trip = get_trip(trip_id)
+    # Завершение — сразу переход состояния: повторное нажатие вернёт None и ничего не разошлёт
+    trip = await adb.complete_trip(trip_id, callback.from_user.id)
     if not trip:
-        await callback.answer("Заказ не найден.", show_alert=True)
+        await callback.answer("Заказ не найден или уже завершён.", show_alert=True)
         return
-    passenger_id = trip[1]
-    driver_id = trip[2]
-    fare = trip[6] or 0
-    messages_to_delete = [
-        (passenger_id, trip[11]), (driver_id, trip[12]), (passenger_id, trip[13]),
-        (passenger_id, trip[14]), (passenger_id, trip[15]), (driver_id, trip[16]),
-        (driver_id, trip[17]), (driver_id, trip[18]), (passenger_id, trip[19]),
-        (driver_id, trip[21]), (driver_id, trip[22])
-    ]
-    for chat_id, msg_id in messages_to_delete:
-        if msg_id:
-            try:
-                await bot.delete_message(chat_id=chat_id, message_id=msg_id)
-            except:
-                pass
+    deadlines.DEADLINES.disarm_all(trip_id)
+    passenger_id = trip.passenger_id
+    driver_id = trip.driver_id
+    fare = trip.fare or 0
+    await delete_trip_messages(trip_id)
     try:
         await callback.message.delete()
-    except:
+    except TelegramAPIError:
         pass
     try:
         await bot.send_message(
@@ -807,7 +855,7 @@ async def complete_ride(callback: types.CallbackQuery):
                 ]
             ])
         )
-    except: 
+    except TelegramAPIError:
         pass
     try:
         await bot.send_message(
@@ -817,9 +865,8 @@ async def complete_ride(callback: types.CallbackQuery):
             f"Ожидайте оценку от пассажира...",
             parse_mode="HTML"
         )
-    except: 
+    except TelegramAPIError:
         pass
-    complete_trip(trip_id)
     await callback.answer()
 
 @dp.callback_query(lambda c: c.data.startswith("rate_"))
@@ -828,14 +875,14 @@ async def rate_driver(callback: types.CallbackQuery):
         _, trip_id_str, rating_str = callback.data.split("_")
         trip_id = int(trip_id_str)
         rating = int(rating_str)
-        trip = get_trip(trip_id)
-        if not trip or trip[1] != callback.from_user.id:
+        trip = await adb.get_trip(trip_id)
+        if not trip or trip.passenger_id != callback.from_user.id:
             await callback.answer("Ошибка оценки.", show_alert=True)
             return
         if rating < 1 or rating > 5:
             await callback.answer("Некорректная оценка.", show_alert=True)
             return
-        save_rating(trip_id, trip[2], callback.from_user.id, rating)
+        await adb.save_rating(trip_id, trip.driver_id, callback.from_user.id, rating)
         await callback.message.edit_text(
             f"✅ <b>Спасибо за оценку!</b>\n"
             f"Вы поставили {rating} ⭐\n"
@@ -843,20 +890,21 @@ async def rate_driver(callback: types.CallbackQuery):
             parse_mode="HTML"
         )
         # После оценки показываем главное меню
-        user_role = get_user_role(callback.from_user.id) or "passenger"
+        user_role = await adb.get_user_role(callback.from_user.id) or "passenger"
         if user_role == "driver":
             await callback.message.answer("Главное меню:", reply_markup=get_driver_menu())
         else:
             await callback.message.answer("Главное меню:", reply_markup=get_main_menu())
-        driver_rating = get_driver_rating(trip[2])
+        driver_rating = await adb.get_driver_rating(trip.driver_id)
         try:
-            await bot.send_message(
-                trip[2],
-                f"⭐ <b>Пассажир оценил вашу работу:</b> {rating}/5\n"
-                f"📊 <b>Ваш текущий рейтинг:</b> {driver_rating or 'еще нет оценок'}",
-                parse_mode="HTML"
-            )
-        except:
+            with outbox.priority(outbox.NOTICE):
+                await bot.send_message(
+                    trip.driver_id,
+                    f"⭐ <b>Пассажир оценил вашу работу:</b> {rating}/5\n"
+                    f"📊 <b>Ваш текущий рейтинг:</b> {driver_rating or 'еще нет оценок'}",
+                    parse_mode="HTML"
+                )
+        except TelegramAPIError:
             pass
     except Exception as e:
         print(f"Ошибка в оценке: {e}")
@@ -864,71 +912,114 @@ async def rate_driver(callback: types.CallbackQuery):
     await callback.answer()
 
 # Фоновые задачи
-async def process_broadcast_queue():
+async def process_broadcasts():
+    # Задания рассылок из базы; рассылки идут низшим классом — запросы поездок
+    # планировщик отправляет раньше
+    with outbox.priority(outbox.BULK):
+        await broadcasts.BROADCASTER.run(lambda user_id, text: bot.send_message(chat_id=user_id, text=text))
+
+async def expire_orders(trip_ids):
+    # Все заказы, срок которых наступил одновременно, закрываются одним запросом;
+    # уже принятые или отменённые условие запроса пропустит
+    expired = await adb.expire_trips(trip_ids, ORDER_TIMEOUT)
+    await asyncio.gather(*(notify_expired(trip_id, passenger_id) for trip_id, passenger_id in expired))
+
+async def notify_expired(trip_id, passenger_id):
+    await withdraw_offers(trip_id)
+    # Удаляем карточку заказа у пассажира
+    await delete_trip_messages(trip_id)
+    # Отправляем уведомление пассажиру
+    try:
+        await bot.send_message(
+            passenger_id,
+            f"❌ <b>Заказ автоматически отменён</b>\n"
+            f"Никто не принял его в течение {ORDER_TIMEOUT} минут.",
+            parse_mode="HTML"
+        )
+    except TelegramAPIError:
+        pass
+
+async def return_stalled_orders(trip_ids):
+    # Водитель принял заказ, но не назначил цену — заказ снова ищет водителя
+    returned = await adb.release_stalled_trips(trip_ids, ORDER_TIMEOUT)
+    await asyncio.gather(*(return_to_pool(trip, driver_id) for trip, driver_id in returned))
+
+async def return_to_pool(trip, driver_id):
+    trip_id = trip.id
+    deadlines.DEADLINES.arm(deadlines.EXPIRE, trip_id, trip.confirm_timeout_ts)
+    await delete_trip_messages(trip_id)
+    # Ввод своей цены прежним водителем больше не ждём (set_trip_fare его и так не примет)
+    state = dp.fsm.get_context(bot, chat_id=driver_id, user_id=driver_id)
+    if (await state.get_data()).get("trip_id") == trip_id:
+        await state.clear()
+    try:
+        await bot.send_message(
+            driver_id,
+            f"⌛ Вы не указали стоимость заказа №{trip_id} за {CONFIRM_TIMEOUT} мин. — заказ передан другим водителям."
+        )
+    except TelegramAPIError:
+        pass
+    try:
+        sent_passenger = await bot.send_message(
+            trip.passenger_id,
+            "⚠️ <b>Водитель не подтвердил заказ</b>\n"
+            f"📍 <b>Откуда:</b> {trip.pickup}\n"
+            f"📍 <b>Куда:</b> {trip.destination}\n"
+            "⏳ Ищем другого водителя...",
+            parse_mode="HTML",
+            reply_markup=InlineKeyboardMarkup(inline_keyboard=[
+                [InlineKeyboardButton(text="❌ Отменить заказ", callback_data=f"cancel_passenger_{trip_id}")]
+            ])
+        )
+        await adb.add_trip_message(trip_id, trip.passenger_id, sent_passenger.message_id, 'passenger_order')
+    except TelegramAPIError:
+        pass
+    # Тот же водитель заказ повторно не получит
+    await publish_order(trip_id, trip.pickup, trip.destination, exclude={driver_id})
+
+async def load_deadlines():
+    kinds = {'requested': deadlines.EXPIRE, 'accepted': deadlines.CONFIRM}
+    rows = await adb.get_trip_deadlines(ORDER_TIMEOUT)
+    return [(kinds[status], trip_id, deadline) for trip_id, status, deadline in rows]
+
+async def track_deadlines():
+    # Сроки заказов: истечение без водителя и возврат в пул без подтверждения цены.
+    # При старте сроки берутся из базы, просроченные за время простоя срабатывают сразу
+    deadlines.DEADLINES.on(deadlines.EXPIRE, expire_orders)
+    deadlines.DEADLINES.on(deadlines.CONFIRM, return_stalled_orders)
+    await deadlines.DEADLINES.run(load_deadlines)
+
+async def archive_closed_trips():
+    # Перенос старых закрытых поездок в архив; сами пакеты выполняет писатель
+    loop = asyncio.get_running_loop()
     while True:
+        await asyncio.sleep(archive.ARCHIVE_INTERVAL_HOURS * 3600)
         try:
-            if not BROADCAST_QUEUE.empty():
-                task = BROADCAST_QUEUE.get()
-                user_ids = task["user_ids"]
-                message_text = task["message_text"]
-                success_count = 0
-                for user_id in user_ids:
-                    try:
-                        await bot.send_message(chat_id=user_id, text=message_text)
-                        success_count += 1
-                    except Exception as e:
-                        print(f"Ошибка отправки {user_id}: {e}")
-                print(f"Рассылка завершена: {success_count}/{len(user_ids)}")
-            await asyncio.sleep(1)
+            moved = await loop.run_in_executor(None, archive.run)
+            if moved:
+                print(f"В архив перенесено поездок: {moved}")
         except Exception as e:
-            print(f"Ошибка в фоновой рассылке: {e}")
-            await asyncio.sleep(5)
+            print(f"Ошибка при архивации поездок: {e}")
 
-async def cancel_expired_orders():
+async def backfill_timestamps():
+    # Колонки *_ts истории, оставшейся от старых версий: без них диапазоны заказов,
+    # экспорт, сегменты рассылок и архивация такие поездки не видят.
+    # На уже сконвертированной базе проход ничего не пишет
+    loop = asyncio.get_running_loop()
+    try:
+        await loop.run_in_executor(None, db_utils.backfill_timestamps, BACKFILL_BATCH, BACKFILL_PAUSE)
+    except Exception as e:
+        print(f"Ошибка при заполнении колонок времени: {e}")
+
+async def refresh_snapshot():
+    # Реплика для аналитики дашборда: первый снимок сразу, дальше по расписанию
+    loop = asyncio.get_running_loop()
     while True:
         try:
-            cur = DB.cursor()
-            cur.execute("""
-                SELECT id, passenger_id
-                FROM trips
-                WHERE status = 'requested'
-                  AND datetime(created_at) < datetime('now', '-{} minutes')
-            """.format(ORDER_TIMEOUT))
-            expired = cur.fetchall()
-            for trip_id, passenger_id in expired:
-                cur2 = DB.cursor()
-                cur2.execute("UPDATE trips SET status = 'expired' WHERE id = ?", (trip_id,))
-                DB.commit()
-                # Удаляем карточку у пассажира
-                if trip_id in ACTIVE_ORDER_MESSAGES:
-                    for drv_id, msg_id in ACTIVE_ORDER_MESSAGES[trip_id].items():
-                        try:
-                            await bot.delete_message(chat_id=drv_id, message_id=msg_id)
-                        except:
-                            pass
-                    del ACTIVE_ORDER_MESSAGES[trip_id]
-                # Получаем ID сообщения пассажира из БД
-                cur3 = DB.cursor()
-                cur3.execute("SELECT passenger_message_id FROM trips WHERE id = ?", (trip_id,))
-                passenger_msg_id = cur3.fetchone()
-                if passenger_msg_id and passenger_msg_id[0]:
-                    try:
-                        await bot.delete_message(chat_id=passenger_id, message_id=passenger_msg_id[0])
-                    except:
-                        pass
-                # Отправляем уведомление пассажиру
-                try:
-                    await bot.send_message(
-                        passenger_id,
-                        f"❌ <b>Заказ автоматически отменён</b>\n"
-                        f"Никто не принял его в течение {ORDER_TIMEOUT} минут.",
-                        parse_mode="HTML"
-                    )
-                except:
-                    pass
+            await loop.run_in_executor(None, snapshot.refresh)
         except Exception as e:
-            print(f"Ошибка в cancel_expired_orders: {e}")
-        await asyncio.sleep(30)
+            print(f"Ошибка при снятии снимка базы: {e}")
+        await asyncio.sleep(snapshot.SNAPSHOT_INTERVAL)
 
 # Запуск дашборда
 import dashboard
@@ -937,11 +1028,23 @@ def run_flask():
     flask_app.run(host="0.0.0.0", port=5000, debug=False, use_reloader=False)
 
 async def main():
-    flask_thread = threading.Thread(target=run_flask, daemon=True)
-    flask_thread.start()
-    print("🚀 Flask дашборд запущен на http://0.0.0.0:5000")
-    asyncio.create_task(process_broadcast_queue())
-    asyncio.create_task(cancel_expired_orders())
+    # Дашборд, рассылки и архивация пока работают только с SQLite-базой
+    if STORAGE.name == "sqlite":
+        dashboard.attach_bot(asyncio.get_running_loop(), cancel_trip_cleanup)
+        flask_thread = threading.Thread(target=run_flask, daemon=True)
+        flask_thread.start()
+        print("🚀 Flask дашборд запущен на http://0.0.0.0:5000")
+    else:
+        print(f"Хранилище {STORAGE.name}: дашборд не запускается")
+    asyncio.create_task(track_deadlines())
+    asyncio.create_task(LOOP_LAG.run(report_every=LOOP_LAG_REPORT_INTERVAL))
+    if STORAGE.name == "sqlite":
+        asyncio.create_task(backfill_timestamps())
+        asyncio.create_task(process_broadcasts())
+    if archive.ARCHIVE_INTERVAL_HOURS > 0 and STORAGE.name == "sqlite":
+        asyncio.create_task(archive_closed_trips())
+    if snapshot.SNAPSHOT_INTERVAL > 0 and STORAGE.name == "sqlite":
+        asyncio.create_task(refresh_snapshot())
     await dp.start_polling(bot)
 
 if __name__ == "__main__":
@@ -0,0 +1,214 @@
+# broadcasts.py
+# Рассылки из дашборда — задания в базе. broadcast_jobs хранит текст, аудиторию
+# (сегмент из segments.py), курсор (ключ последнего получателя, которому
+# отправка уже начата), границу аудитории (последний ключ на момент создания)
+# и счётчики;
+# broadcast_inflight — получателей взятой страницы, чей результат ещё не записан.
+#
+# Бот берёт получателей страницами по ключу после курсора: страница попадает в
+# broadcast_inflight, а курсор сдвигается одной транзакцией ДО отправки; каждый
+# результат убирает получателя из inflight и увеличивает sent или failed. После
+# перезапуска задание продолжается с курсора, а получатели, оставшиеся в
+# inflight, считаются потерянными (lost): повторно им не отправляется ничего —
+# лучше недоставить одно сообщение, чем прислать его дважды.
+#
+# Новое задание будит рассыльщика сразу после COMMIT (notify), без опроса.
+# Страница отправляется параллельно; лимиты и приоритет (BULK) — у outbox.
+import asyncio
+import os
+import time
+from collections import deque
+
+import db_utils
+import segments
+import timeutil
+from async_db import adb
+
+BROADCAST_PAGE = int(os.getenv("BROADCAST_PAGE", "100"))  # получателей в странице
+# Окно, по которому считается текущая скорость отправки, секунд
+_RATE_WINDOW = 10
+
+ACTIVE_STATUSES = ('queued', 'running')
+JOB_COLUMNS = ("id", "audience", "message_text", "status", "cursor", "last_user_id", "total", "sent", "failed", "lost",
+               "created_ts", "started_ts", "finished_ts")
+
+
+@db_utils.writes
+def create_job(cur, audience, message_text):
+    """Ставит рассылку сегменту audience (см. segments.py) в очередь.
+
+    Возвращает (id задания, число получателей); без получателей — (None, 0).
+    ValueError — неизвестный сегмент или неверный параметр.
+    """
+    audience = segments.canonical(audience)
+    now = timeutil.now_ts()
+    total = segments.size(cur, audience, now)
+    if not total:
+        return None, 0
+    last_user_id = cur.execute("SELECT MAX(telegram_id) FROM users").fetchone()[0]
+    cur.execute("INSERT INTO broadcast_jobs (audience, message_text, last_user_id, total, created_ts) "
+                "VALUES (?, ?, ?, ?, ?)", (audience, message_text, last_user_id, total, now))
+    db_utils.POOL.after_commit(BROADCASTER.notify)
+    return cur.lastrowid, total
+
+
+@db_utils.writes
+def cancel_job(cur, job_id):
+    """Останавливает задание: уже взятая страница дойдёт, новых не будет. True, если было что отменять."""
+    cur.execute(f"UPDATE broadcast_jobs SET status = 'cancelled', finished_ts = ? "
+                f"WHERE id = ? AND status IN ({', '.join('?' * len(ACTIVE_STATUSES))})",
+                (timeutil.now_ts(), job_id, *ACTIVE_STATUSES))
+    return cur.rowcount > 0
+
+
+@db_utils.writes
+def recover(cur):
+    """После перезапуска: получатели незавершённых страниц переходят в lost. Возвращает их число."""
+    lost = cur.execute("SELECT COUNT(*) FROM broadcast_inflight").fetchone()[0]
+    if lost:
+        cur.execute("""
+            UPDATE broadcast_jobs SET lost = lost + (SELECT COUNT(*) FROM broadcast_inflight i WHERE i.job_id = broadcast_jobs.id)
+            WHERE id IN (SELECT DISTINCT job_id FROM broadcast_inflight)
+        """)
+        cur.execute("DELETE FROM broadcast_inflight")
+    return lost
+
+
+@db_utils.reads
+def next_job(cur):
+    row = cur.execute(f"SELECT id FROM broadcast_jobs WHERE status IN ({', '.join('?' * len(ACTIVE_STATUSES))}) "
+                      "ORDER BY id LIMIT 1", ACTIVE_STATUSES).fetchone()
+    return row[0] if row else None
+
+
+@db_utils.writes
+def claim_page(cur, job_id, limit=BROADCAST_PAGE):
+    """Следующая страница получателей: (текст, [user_id]) или None, если задание завершено или отменено.
+
+    Страница записывается в broadcast_inflight, а курсор сдвигается в той же транзакции.
+    """
+    row = cur.execute("SELECT audience, message_text, status, cursor, last_user_id, created_ts FROM broadcast_jobs "
+                      "WHERE id = ?", (job_id,)).fetchone()
+    if row is None or row[2] not in ACTIVE_STATUSES:
+        return None
+    audience, message_text, _, cursor, last_user_id, created_ts = row
+    # Сегмент считается на момент создания задания: «за 7 дней» не сдвигается между страницами
+    user_ids = segments.page(cur, audience, cursor, limit, until=last_user_id, now=created_ts)
+    now = timeutil.now_ts()
+    if not user_ids:
+        cur.execute("UPDATE broadcast_jobs SET status = 'done', finished_ts = ? WHERE id = ?", (now, job_id))
+        return None
+    cur.executemany("INSERT OR IGNORE INTO broadcast_inflight (job_id, user_id) VALUES (?, ?)",
+                    [(job_id, user_id) for user_id in user_ids])
+    cur.execute("UPDATE broadcast_jobs SET cursor = ?, status = 'running', started_ts = COALESCE(started_ts, ?) "
+                "WHERE id = ?", (user_ids[-1], now, job_id))
+    return message_text, user_ids
+
+
+@db_utils.writes
+def record_result(cur, job_id, user_id, ok):
+    cur.execute("DELETE FROM broadcast_inflight WHERE job_id = ? AND user_id = ?", (job_id, user_id))
+    if cur.rowcount:
+        column = "sent" if ok else "failed"
+        cur.execute(f"UPDATE broadcast_jobs SET {column} = {column} + 1 WHERE id = ?", (job_id,))
+
+
+@db_utils.reads
+def get_jobs(cur, job_id=None, limit=20):
+    """Задания (последние сначала) с прогрессом; job_id — только одно."""
+    where, params = ("WHERE j.id = ?", (job_id,)) if job_id is not None else ("", ())
+    rows = cur.execute(f"""
+        SELECT {', '.join('j.' + c for c in JOB_COLUMNS)},
+               (SELECT COUNT(*) FROM broadcast_inflight i WHERE i.job_id = j.id)
+        FROM broadcast_jobs j {where} ORDER BY j.id DESC LIMIT ?
+    """, (*params, limit)).fetchall()
+    return [_progress(dict(zip(JOB_COLUMNS, row[:-1])), row[-1]) for row in rows]
+
+
+def _progress(job, in_flight):
+    now = timeutil.now_ts()
+    done = job["sent"] + job["failed"] + job["lost"]
+    started, finished = job["started_ts"], job["finished_ts"]
+    elapsed = ((finished or now) - started) if started else 0
+    job["in_flight"] = in_flight
+    job["audience_title"] = segments.title(job["audience"])
+    job["remaining"] = 0 if job["status"] not in ACTIVE_STATUSES else max(job["total"] - done - in_flight, 0)
+    job["per_second"] = round(done / elapsed, 2) if elapsed > 0 else None
+    job["recent_per_second"] = BROADCASTER.recent_rate(job["id"])
+    job["eta_seconds"] = round(job["remaining"] / job["per_second"]) if job["per_second"] and job["remaining"] else None
+    for column in ("created_ts", "started_ts", "finished_ts"):
+        job[column.replace("_ts", "_at")] = timeutil.to_text(job[column]) if job[column] else None
+    return job
+
+
+class Broadcaster:
+    """Выполняет задания рассылок по очереди, пока бот работает."""
+
+    def __init__(self, page=BROADCAST_PAGE):
+        self.page = page
+        self._loop = None
+        self._wakeup = None
+        self._job = None
+        self._completed = deque(maxlen=10000)  # время каждой отправки текущего задания
+
+    def notify(self):
+        """Будит рассыльщика; можно вызывать из любого потока (например, из дашборда)."""
+        loop, wakeup = self._loop, self._wakeup
+        if loop is not None and not loop.is_closed():
+            loop.call_soon_threadsafe(wakeup.set)
+
+    def recent_rate(self, job_id):
+        """Скорость отправки текущего задания за последние секунды; None для остальных."""
+        if job_id != self._job:
+            return None
+        horizon = time.monotonic() - _RATE_WINDOW
+        return round(sum(1 for t in list(self._completed) if t > horizon) / _RATE_WINDOW, 2)
+
+    async def run(self, send):
+        """send(user_id, text) — корутина отправки одного сообщения."""
+        self._loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        lost = await adb.wrap(recover)()
+        if lost:
+            print(f"Рассылки: {lost} получателей прерванных страниц отмечены как lost")
+        while True:
+            # Сброс до запроса: задание, созданное во время запроса, разбудит снова
+            self._wakeup.clear()
+            job_id = await adb.wrap(next_job)()
+            if job_id is None:
+                await self._wakeup.wait()
+                continue
+            try:
+                await self._run_job(job_id, send)
+            except Exception as e:
+                print(f"Ошибка в рассылке №{job_id}: {e}")
+                await asyncio.sleep(5)
+
+    async def _run_job(self, job_id, send):
+        self._job = job_id
+        self._completed.clear()
+        claim, record = adb.wrap(claim_page), adb.wrap(record_result)
+
+        async def deliver(user_id, text):
+            try:
+                await send(user_id, text)
+                ok = True
+            except Exception:
+                # Ошибку уже записал планировщик outbox
+                ok = False
+            self._completed.append(time.monotonic())
+            await record(job_id, user_id, ok)
+
+        while True:
+            page = await claim(job_id, self.page)
+            if page is None:
+                break
+            text, user_ids = page
+            await asyncio.gather(*(deliver(user_id, text) for user_id in user_ids))
+        self._job = None
+        job, = await adb.wrap(get_jobs)(job_id, 1)
+        print(f"Рассылка №{job_id} ({job['status']}): отправлено {job['sent']}/{job['total']}, "
+              f"ошибок {job['failed']}, потеряно {job['lost']}, {job['per_second']} сообщ./с")
+
+
+BROADCASTER = Broadcaster()
@@ -0,0 +1,318 @@
+# conformance.py
+# Общий набор проверок для реализаций Storage: одинаковые вызовы должны давать
+# одинаковые результаты на SQLite и на PostgreSQL.
+# Запуск: python manage.py conformance --backend sqlite
+#         python manage.py conformance --backend postgres --dsn postgresql://localhost/taxi_test
+# Те же проверки гоняет python -m pytest (tests/test_conformance.py): SQLite всегда,
+# PostgreSQL — если задан TEST_DATABASE_URL.
+#
+# Проверки пишут в базу и переводят в 'expired' все ожидающие заказы, поэтому
+# запускать их можно только на отдельной, тестовой базе.
+import random
+import threading
+import time
+
+from db_utils import Trip
+
+# Параллельные вызовы в проверках гонок
+RACE_THREADS = 8
+
+
+class ConformanceError(AssertionError):
+    pass
+
+
+def _expect(condition, message):
+    if not condition:
+        raise ConformanceError(message)
+
+
+def _user_ids(count=2):
+    # Случайная база id, чтобы повторные прогоны на той же базе не пересекались
+    base = random.randint(10**12, 10**13)
+    return [base + i for i in range(count)]
+
+
+def _race(func, args_list):
+    """Запускает func(*args) для каждого набора args одновременно; результаты в том же порядке."""
+    results = [None] * len(args_list)
+    errors = []
+    barrier = threading.Barrier(len(args_list))
+
+    def worker(i, args):
+        barrier.wait()
+        try:
+            results[i] = func(*args)
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=worker, args=(i, args)) for i, args in enumerate(args_list)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    if errors:
+        raise errors[0]
+    return results
+
+
+def check_users(storage):
+    uid, = _user_ids(1)
+    _expect(storage.get_user_role(uid) is None, "незарегистрированный пользователь без роли")
+    storage.save_user(uid, "user", "Имя")
+    storage.save_user(uid, "renamed", "Имя")
+    _expect(storage.get_user_role(uid) == "passenger", "новый пользователь — пассажир")
+    context = storage.get_user_context(uid)
+    _expect((context.role, context.is_banned) == ("passenger", False), f"контекст: {context}")
+
+
+def check_bans(storage):
+    uid, other = _user_ids(2)
+    storage.save_user(uid, "u", "U")
+    storage.ban_user(uid, "спам", 1)
+    _expect(storage.is_user_banned(uid), "бан на сутки действует")
+    context = storage.get_user_context(uid)
+    _expect(context.is_banned and context.ban_reason == "спам" and context.banned_until, f"контекст бана: {context}")
+    storage.ban_user(uid, "навсегда")
+    context = storage.get_user_context(uid)
+    _expect(context.ban_reason == "навсегда" and context.banned_until is None, "новый бан заменяет прежний")
+    storage.unban_user(uid)
+    _expect(not storage.is_user_banned(uid), "разбан снимает бан")
+    _expect(not storage.is_user_banned(other), "чужой бан не виден")
+
+
+def check_dictionaries(storage):
+    tariffs = storage.get_tariffs()
+    _expect(tariffs and all(len(row) == 3 for row in tariffs), "тарифы — (id, name, price)")
+    reasons = storage.get_cancellation_reasons("passenger")
+    _expect(reasons and all(len(row) == 2 for row in reasons), "причины — (id, reason_text)")
+    _expect(storage.get_cancellation_reason_text(reasons[0][0]) == reasons[0][1], "текст причины по id")
+    _expect(storage.get_cancellation_reason_text(-1) is None, "неизвестная причина — None")
+
+
+def check_trip_lifecycle(storage):
+    passenger, driver = _user_ids(2)
+    trip_id = storage.create_trip(passenger, "Откуда", "Куда")
+    _expect(isinstance(trip_id, int), "create_trip возвращает id")
+    _expect(storage.has_active_order(passenger), "заказ активен")
+    trip = storage.get_trip(trip_id)
+    _expect(isinstance(trip, Trip) and trip.status == "requested" and trip.created_ts, f"новая поездка: {trip}")
+
+    trip = storage.assign_driver_to_trip(trip_id, driver)
+    _expect(trip and trip.status == "accepted" and trip.driver_id == driver and trip.accepted_ts, "водитель назначен")
+    _expect(storage.assign_driver_to_trip(trip_id, driver + 1) is None, "принятый заказ второй раз не забрать")
+    _expect(storage.set_trip_fare(trip_id, 700, driver + 1) is None, "чужой водитель цену не назначает")
+    _expect(storage.set_trip_fare(trip_id, 500, driver).fare == 500, "цена сохранена")
+    _expect(storage.mark_arrived(trip_id, driver + 1) is None, "чужой водитель не отмечает прибытие")
+    _expect(storage.mark_arrived(trip_id, driver).status == "in_progress", "водитель на месте")
+    _expect(storage.mark_arrived(trip_id, driver) is None, "повторное «на месте» ничего не меняет")
+    _expect(storage.complete_trip(trip_id, driver + 1) is None, "чужой водитель не завершает поездку")
+    _expect(storage.cancel_trip(trip_id, "cancelled_by_driver", None, driver + 1) is None,
+            "чужой водитель не отменяет поездку")
+    trip = storage.complete_trip(trip_id, driver)
+    _expect(trip.status == "completed" and trip.completed_ts, "поездка завершена")
+    _expect(storage.complete_trip(trip_id, driver) is None, "повторное завершение ничего не меняет")
+    _expect(storage.set_trip_fare(trip_id, 900, driver) is None, "цену завершённой поездки не изменить")
+    _expect(storage.cancel_trip(trip_id, "cancelled", "поздно") is None, "завершённую поездку не отменить")
+    _expect(not storage.has_active_order(passenger), "завершённый заказ не активен")
+
+    _expect(storage.get_passenger_completed_count(passenger) == 1, "счётчик поездок пассажира")
+    completed, earnings, _ = storage.get_driver_stats(driver)
+    _expect((completed, earnings) == (1, 500), f"статистика водителя: {completed}, {earnings}")
+
+    cancelled = storage.create_trip(passenger, "A", "B")
+    trip = storage.cancel_trip(cancelled, "cancelled_by_passenger", "Передумал")
+    _expect(trip.status == "cancelled_by_passenger" and trip.cancellation_reason == "Передумал", "отмена с причиной")
+    _expect(storage.complete_trip(cancelled, driver) is None, "отменённую поездку не завершить")
+    requested = storage.create_trip(passenger, "A", "B")
+    _expect(storage.complete_trip(requested, driver) is None, "без водителя поездку не завершить")
+    _expect(storage.cancel_trip(requested, "cancelled_by_driver", None, driver) is None, "водитель не отменяет чужой заказ")
+    _expect(storage.get_trip(requested).status == "requested", "отвергнутый переход не меняет статус")
+    _expect(storage.get_trip(-1) is None, "несуществующая поездка — None")
+    _expect(storage.expire_trip(-1) is None, "несуществующую поездку не просрочить")
+
+
+def check_ratings(storage):
+    passenger, driver = _user_ids(2)
+    trips = [storage.create_trip(passenger, "A", "B") for _ in range(2)]
+    _expect(storage.get_driver_rating(driver) is None, "без оценок рейтинга нет")
+    storage.save_rating(trips[0], driver, passenger, 5)
+    storage.save_rating(trips[1], driver, passenger, 4)
+    _expect(storage.get_driver_rating(driver) == 4.5, "средняя оценка")
+    storage.save_rating(trips[1], driver, passenger, 1)
+    _expect(storage.get_driver_rating(driver) == 3.0, "повторная оценка заменяет прежнюю")
+
+
+def check_cancellations(storage):
+    import db_utils
+    policy = min(db_utils.CANCELS.policies, key=lambda p: p.threshold, default=None)
+    if policy is None:
+        return
+    uid, = _user_ids(1)
+    storage.save_user(uid, "u", "U")
+    for _ in range(policy.threshold - 1):
+        _expect(storage.increment_cancel_count(uid) is None, "до порога бана нет")
+    _expect(storage.increment_cancel_count(uid) == policy, "на пороге срабатывает правило")
+    _expect(storage.is_user_banned(uid), "сработавшее правило банит")
+    storage.unban_user(uid)
+    _expect(storage.increment_cancel_count(uid) is None, "после бана счёт отмен начинается заново")
+
+
+def check_trip_messages(storage):
+    trip_id = storage.create_trip(_user_ids(1)[0], "A", "B")
+    storage.add_trip_messages(trip_id, [(1, 10, "passenger"), (1, 11, "fare"), (2, 20, "driver"), (None, 5, "x")])
+    storage.add_trip_message(trip_id, 1, 10, "passenger")
+    messages = storage.get_trip_messages(trip_id)
+    _expect({k: sorted(v) for k, v in messages.items()} == {1: [10, 11], 2: [20]}, f"сообщения: {messages}")
+    storage.delete_trip_messages(trip_id)
+    _expect(storage.get_trip_messages(trip_id) == {}, "сообщения удалены")
+
+
+def check_iter_trips(storage):
+    start = int(time.time()) - 1
+    passenger, = _user_ids(1)
+    created = [storage.create_trip(passenger, "A", str(i)) for i in range(7)]
+    seen = [trip.id for trip in storage.iter_trips(start, None, 3) if trip.passenger_id == passenger]
+    _expect(seen == created, f"iter_trips отдаёт все поездки по порядку: {seen} != {created}")
+
+
+def check_trip_deadlines(storage):
+    """Сроки заказов: просрочка и возврат в пул срабатывают только по наступившему сроку."""
+    passenger, driver = _user_ids(2)
+    waiting = storage.create_trip(passenger, "A", "B")
+    deadlines = {trip_id: (status, deadline) for trip_id, status, deadline in storage.get_trip_deadlines(10)}
+    trip = storage.get_trip(waiting)
+    _expect(deadlines.get(waiting) == ("requested", trip.created_ts + 600), f"срок ожидания: {deadlines.get(waiting)}")
+    _expect(storage.expire_trips([waiting], 10) == [], "срок не наступил — заказ не просрочен")
+    _expect(storage.expire_trips([], 10) == [], "пустая пачка")
+
+    stalled = storage.create_trip(passenger, "A", "B")
+    past = int(time.time()) - 1
+    storage.assign_driver_to_trip(stalled, driver, past)
+    _expect((stalled, "accepted", past) in [tuple(row) for row in storage.get_trip_deadlines(10)],
+            "срок подтверждения цены в списке")
+    released = storage.release_stalled_trips([stalled, waiting], 10)
+    _expect(len(released) == 1 and released[0][1] == driver, f"в пул возвращён один заказ: {released}")
+    trip = released[0][0]
+    _expect(trip.status == "requested" and trip.driver_id is None and trip.return_count == 1
+            and trip.confirm_timeout_ts >= past + 600, "заказ снова ждёт водителя")
+    _expect(storage.release_stalled_trips([stalled], 10) == [], "повторный возврат ничего не меняет")
+    _expect(storage.expire_trips([stalled], 0) == [], "срок после возврата отсчитывается заново")
+
+    confirmed = storage.create_trip(passenger, "A", "B")
+    storage.assign_driver_to_trip(confirmed, driver, past)
+    _expect(storage.set_trip_fare(confirmed, 300, driver).confirm_timeout_ts is None, "цена снимает срок подтверждения")
+    _expect(storage.release_stalled_trips([confirmed], 10) == [], "подтверждённый заказ не возвращается")
+
+    # У возвращённого заказа срок свой, таймаут от создания к нему не применяется
+    expired = storage.expire_trips([waiting, stalled, confirmed], -1)
+    _expect([tuple(row) for row in expired] == [(waiting, passenger)], f"просрочен ожидающий заказ: {expired}")
+
+
+def check_released_driver(storage):
+    """Заказ вернулся в пул и достался другому водителю — кнопки прежнего ничего не меняют."""
+    passenger, driver, other = _user_ids(3)
+    trip_id = storage.create_trip(passenger, "A", "B")
+    storage.assign_driver_to_trip(trip_id, driver, int(time.time()) - 1)
+    _expect(len(storage.release_stalled_trips([trip_id], 10)) == 1, "заказ возвращён в пул")
+    _expect(storage.assign_driver_to_trip(trip_id, other) is not None, "заказ принял другой водитель")
+    _expect(storage.set_trip_fare(trip_id, 100, driver) is None, "прежний водитель не назначает цену")
+    _expect(storage.mark_arrived(trip_id, driver) is None, "прежний водитель не отмечает прибытие")
+    _expect(storage.complete_trip(trip_id, driver) is None, "прежний водитель не завершает поездку")
+    _expect(storage.cancel_trip(trip_id, "cancelled_by_driver", None, driver) is None, "прежний водитель не отменяет")
+    trip = storage.get_trip(trip_id)
+    _expect(trip.status == "accepted" and trip.driver_id == other and trip.fare is None,
+            "заказ нового водителя не изменился")
+    _expect(storage.set_trip_fare(trip_id, 300, other).fare == 300, "новый водитель назначает цену")
+
+
+def check_claim_race(storage):
+    """Один заказ одновременно забирают несколько водителей — побеждает ровно один."""
+    drivers = _user_ids(RACE_THREADS)
+    trip_id = storage.create_trip(_user_ids(1)[0], "A", "B")
+    results = _race(storage.assign_driver_to_trip, [(trip_id, d) for d in drivers])
+    winners = [trip for trip in results if trip is not None]
+    _expect(len(winners) == 1, f"заказ забрали {len(winners)} водителей")
+    _expect(storage.get_trip(trip_id).driver_id == winners[0].driver_id, "в базе записан победитель")
+
+
+def check_expire_race(storage):
+    """Параллельные expire_due_trips не отдают один заказ дважды."""
+    passenger, = _user_ids(1)
+    created = {storage.create_trip(passenger, "A", "B") for _ in range(RACE_THREADS * 3)}
+    # Отрицательный таймаут — просрочены все ожидающие заказы базы
+    results = _race(storage.expire_due_trips, [(-1, 5)] * RACE_THREADS)
+    while True:
+        rest = storage.expire_due_trips(-1, 100)
+        if not rest:
+            break
+        results.append(rest)
+    expired = [row[0] for rows in results for row in rows]
+    _expect(len(expired) == len(set(expired)), "заказ просрочен больше одного раза")
+    _expect(created <= set(expired), "просрочены не все заказы")
+    _expect(all(storage.get_trip(t).status == "expired" for t in created), "статус expired сохранён")
+
+
+def check_accept_expire_race(storage):
+    """Принятие и просрочка одного заказа одновременно: выигрывает ровно один переход."""
+    passenger, = _user_ids(1)
+    drivers = _user_ids(RACE_THREADS)
+    created = [storage.create_trip(passenger, "A", "B") for _ in range(RACE_THREADS)]
+    calls = [(storage.assign_driver_to_trip, (trip_id, d)) for trip_id, d in zip(created, drivers)]
+    # Отрицательный таймаут — срок у всех заказов уже наступил
+    calls += [(storage.expire_trips, (created, -1))] * 2
+    results = _race(lambda func, args: func(*args), calls)
+    accepted = {trip.id for trip in results[:RACE_THREADS] if trip is not None}
+    expired = [row[0] for rows in results[RACE_THREADS:] for row in rows]
+    _expect(len(expired) == len(set(expired)), "заказ просрочен больше одного раза")
+    _expect(accepted.isdisjoint(expired), "заказ и принят, и просрочен")
+    _expect(accepted | set(expired) == set(created), "заказ ни принят, ни просрочен")
+    for trip_id in created:
+        _expect(storage.get_trip(trip_id).status == ("accepted" if trip_id in accepted else "expired"),
+                f"статус заказа {trip_id} не совпадает с победившим переходом")
+
+
+def check_trip_changes(storage):
+    """Каждое изменение поездки попадает в журнал; отвергнутый переход — нет."""
+    head = storage.get_trip_changes(0, 0)["cursor"]
+    passenger, driver = _user_ids(2)
+    trip_id = storage.create_trip(passenger, "A", "B")
+    storage.assign_driver_to_trip(trip_id, driver)
+    storage.set_trip_fare(trip_id, 300, driver)
+    storage.mark_arrived(trip_id, driver)
+    storage.mark_arrived(trip_id, driver)
+    storage.complete_trip(trip_id, driver)
+    seen, cursor = [], head
+    while True:
+        changes = storage.get_trip_changes(cursor, 2)
+        _expect(not changes["reset"], "свежий курсор не требует перечитывания")
+        seen += [event for event in changes["events"] if event["trip_id"] == trip_id]
+        cursor = changes["cursor"]
+        if not changes["has_more"]:
+            break
+    steps = [(e["prev_status"], e["status"], e["fare"]) for e in seen]
+    _expect(steps == [(None, "requested", None), ("requested", "accepted", None), ("accepted", "accepted", 300),
+                      ("accepted", "in_progress", 300), ("in_progress", "completed", 300)], f"журнал: {steps}")
+    _expect(all(a["seq"] < b["seq"] for a, b in zip(seen, seen[1:])), "seq растёт")
+    _expect(storage.get_trip_changes(cursor)["events"] == [], "после курсора новых событий нет")
+
+
+CHECKS = [
+    check_users, check_bans, check_dictionaries, check_trip_lifecycle, check_ratings,
+    check_cancellations, check_trip_messages, check_iter_trips, check_trip_changes, check_trip_deadlines,
+    check_released_driver, check_claim_race, check_expire_race, check_accept_expire_race,
+]
+
+
+def run(storage, report=print):
+    """Прогоняет все проверки; возвращает число неудачных."""
+    failed = 0
+    for check in CHECKS:
+        try:
+            check(storage)
+        except Exception as e:
+            failed += 1
+            report(f"FAIL {check.__name__}: {type(e).__name__}: {e}")
+        else:
+            report(f"OK   {check.__name__}")
+    return failed
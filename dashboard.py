@@ -1,16 +1,54 @@
 # dashboard.py
+import asyncio
 import secrets
 import sqlite3
-from flask import Flask, render_template_string, jsonify, request, session
+from datetime import date, timedelta
+from flask import Flask, Response, render_template_string, jsonify, request, session
 from db_utils import (
-    DB, get_all_drivers, get_tariffs, get_trip, get_user_role,
+    reader, get_all_drivers, get_tariffs, get_trip, get_user_role,
     add_cancellation_reason, update_cancellation_reason, delete_cancellation_reason,
-    ban_user, unban_user, get_cancellation_reasons, get_ban_info
+    ban_user, unban_user, get_cancellation_reasons, get_ban_info,
+    add_tariff, update_tariff, delete_tariff, save_driver_profile, delete_driver_profile,
+    cancel_trip, user_cache_stats, _revenue_rows, REVENUE_GRANULARITIES, trips_source,
+    get_trip_changes
 )
+import broadcasts
+import deadlines
+import export
+import fanout
+import outbox
+import querylog
+import segments
+import snapshot
+import timeutil
 
 ADMIN_USERNAME = "admin"
 ADMIN_PASSWORD = "admin123"
 
+# Уведомления об отменах из дашборда отправляет бот в своём цикле событий:
+# bot.main() передаёт сюда цикл и корутину через attach_bot()
+_BOT_LOOP = None
+_CANCEL_CLEANUP = None
+
+
+def attach_bot(loop, cancel_cleanup):
+    """cancel_cleanup(trip_id, cancelled_by, reason, trip) — корутина бота, выполняется в loop."""
+    global _BOT_LOOP, _CANCEL_CLEANUP
+    _BOT_LOOP, _CANCEL_CLEANUP = loop, cancel_cleanup
+
+
+def _notify_cancelled(order_id, reason, trip):
+    loop = _BOT_LOOP
+    if loop is None or loop.is_closed():
+        print(f"Бот не запущен: участники заказа #{order_id} не уведомлены об отмене")
+        return
+    future = asyncio.run_coroutine_threadsafe(_CANCEL_CLEANUP(order_id, 'admin', reason, trip), loop)
+
+    def report(future):
+        if not future.cancelled() and future.exception() is not None:
+            print(f"Ошибка при отправке уведомлений: {future.exception()}")
+    future.add_done_callback(report)
+
 DASHBOARD_HTML = r"""
 <!DOCTYPE html>
 <html lang="ru">
@@ -526,7 +564,7 @@ DASHBOARD_HTML = r"""
                                 <th>Имя</th>
                                 <th>Завершено</th>
                                 <th>Заработок</th>
-                                <th>Рейтинг</th>
+                                <th title="Средняя по всем оценкам водителя (driver_rating_stats), как рейтинг в боте">Рейтинг (все оценки)</th>
                             </tr>
                         </thead>
                         <tbody></tbody>
@@ -829,7 +867,12 @@ DASHBOARD_HTML = r"""
                         <label><input type="radio" name="broadcast-type" value="drivers" checked> Водителям</label>
                         <label><input type="radio" name="broadcast-type" value="passengers"> Пассажирам</label>
                         <label><input type="radio" name="broadcast-type" value="all"> Всем пользователям</label>
+                        <label><input type="radio" name="broadcast-type" value="active"> Активным за
+                            <input type="number" id="broadcast-days" value="7" min="1" max="365" style="width: 60px"> дн.</label>
+                        <label><input type="radio" name="broadcast-type" value="idle_drivers"> Водителям без поездок на этой неделе</label>
+                        <label><input type="radio" name="broadcast-type" value="waiting_passengers"> Пассажирам с активным заказом</label>
                     </div>
+                    <div id="broadcast-estimate"></div>
                 </div>
                 <div class="form-group">
                     <label>Текст сообщения *</label>
@@ -868,6 +911,7 @@ DASHBOARD_HTML = r"""
         else if (tabName === 'tariffs') loadTariffs();
         else if (tabName === 'cancellation-reasons') loadCancellationReasons();
         else if (tabName === 'bans') loadBans();
+        else if (tabName === 'broadcast') estimateBroadcast();
     }
     // Аутентификация
     async function checkAuth() {
@@ -1453,32 +1497,71 @@ DASHBOARD_HTML = r"""
             alert('❌ Ошибка: ' + e.message);
         }
     }
+    function broadcastAudience() {
+        const type = document.querySelector('input[name="broadcast-type"]:checked').value;
+        return type === 'active' ? `active:${qs('#broadcast-days').value}` : type;
+    }
+    async function estimateBroadcast() {
+        // Размер аудитории до отправки
+        const estimateEl = qs('#broadcast-estimate');
+        try {
+            const estimate = await apiCall(`/api/admin/segments/estimate?audience=${encodeURIComponent(broadcastAudience())}`);
+            estimateEl.textContent = `${estimate.title}: ${estimate.size} получателей`;
+            return estimate;
+        } catch (e) {
+            estimateEl.textContent = '❌ ' + e.message;
+            return null;
+        }
+    }
+    qsa('input[name="broadcast-type"], #broadcast-days').forEach(el =>
+        el.addEventListener('change', estimateBroadcast));
     async function sendBroadcast() {
         const message = qs('#broadcast-message').value.trim();
         if (!message) {
             alert('Введите текст сообщения');
             return;
         }
-        const type = document.querySelector('input[name="broadcast-type"]:checked').value;
+        const estimate = await estimateBroadcast();
+        if (!estimate) return;
+        if (!confirm(`Отправить рассылку: ${estimate.title}, ${estimate.size} получателей?`)) return;
         try {
             const result = await apiCall('/api/admin/send_message', {
                 method: 'POST',
                 headers: { 'Content-Type': 'application/json' },
                 body: JSON.stringify({ 
                     message_text: message,
-                    broadcast_type: type  // 'drivers', 'passengers', 'all'
+                    broadcast_type: estimate.audience  // сегмент: 'drivers', 'active:7', ...
                 })
             });
             const resultEl = qs('#broadcast-result');
             resultEl.className = 'message success';
             resultEl.textContent = result.message;
             qs('#broadcast-message').value = '';
+            if (result.job_id) watchBroadcast(result.job_id);
         } catch (e) {
             const resultEl = qs('#broadcast-result');
             resultEl.className = 'message error';
             resultEl.textContent = '❌ Ошибка: ' + e.message;
         }
     }
+    async function watchBroadcast(jobId) {
+        // Прогресс рассылки раз в 2 секунды, пока она не завершится
+        const resultEl = qs('#broadcast-result');
+        try {
+            const job = await apiCall(`/api/admin/broadcasts/${jobId}`);
+            const rate = job.recent_per_second ?? job.per_second;
+            resultEl.textContent = `Рассылка №${job.id}: отправлено ${job.sent} из ${job.total}, ` +
+                `ошибок ${job.failed + job.lost}, осталось ${job.remaining}` +
+                (rate ? `, ${rate} сообщ./с` : '') +
+                (job.status === 'done' ? ' — завершена' : job.status === 'cancelled' ? ' — остановлена' : '');
+            if (job.status === 'queued' || job.status === 'running') {
+                setTimeout(() => watchBroadcast(jobId), 2000);
+            }
+        } catch (e) {
+            resultEl.className = 'message error';
+            resultEl.textContent = '❌ Ошибка: ' + e.message;
+        }
+    }
     async function deleteDriver(id) {
         if (!confirm('Удалить водителя? Профиль станет пассажиром.')) return;
         try {
@@ -1507,6 +1590,15 @@ def create_app():
     app = Flask(__name__)
     app.secret_key = secrets.token_hex(16)
 
+    # Запросы маршрута учитываются в querylog под его именем
+    @app.before_request
+    def label_queries():
+        querylog.set_operation(f"dashboard.{request.endpoint}")
+
+    @app.teardown_request
+    def unlabel_queries(error):
+        querylog.set_operation(None)
+
     @app.route('/')
     def dashboard():
         return render_template_string(DASHBOARD_HTML)
@@ -1531,37 +1623,47 @@ def create_app():
         return jsonify({"success": True})
 
     # === API ENDPOINTS ===
+    # Аналитика (/api/dashboard, /api/drivers, /api/financial) читает реплику
+    # snapshot.py; возраст снимка — в поле "snapshot" и заголовке X-Snapshot-Age
+    def with_snapshot(response, snap):
+        response.headers["X-Snapshot-Age"] = str(snap["age_seconds"])
+        return response
+
     @app.route('/api/dashboard')
     def api_dashboard():
-        cur = DB.cursor()
-        users = cur.execute("SELECT * FROM users").fetchall()
-        orders = cur.execute("SELECT * FROM trips").fetchall()
-        drivers = [u for u in users if u[3] == 'driver']
+        with snapshot.reader() as (cur, snap):
+            role_counts = dict(cur.execute("SELECT role, COUNT(*) FROM users GROUP BY role").fetchall())
+            # Итоги по заказам: у каждой поездки есть пассажир, поэтому суммы по пассажирам — это суммы по trips
+            totals = cur.execute('''
+                SELECT COALESCE(SUM(passenger_trips), 0), COALESCE(SUM(passenger_completed), 0),
+                       COALESCE(SUM(passenger_cancelled), 0), COALESCE(SUM(passenger_spent), 0)
+                FROM user_stats_rollup
+            ''').fetchone()
+            # === ТОП ВОДИТЕЛЕЙ: ТОЛЬКО ЗАВЕРШЁННЫЕ ЗАКАЗЫ, ИЗ user_stats_rollup ===
+            # Рейтинг — по всем оценкам водителя из driver_rating_stats (как в боте),
+            # а не только по оценкам завершённых поездок, как считалось раньше
+            top_drivers = cur.execute('''
+                SELECT 
+                    u.telegram_id, 
+                    u.full_name, 
+                    u.first_name,
+                    COALESCE(r.driver_completed, 0) as total_orders,
+                    COALESCE(r.driver_earnings, 0) as total_earnings,
+                    COALESCE(s.rating_sum * 1.0 / NULLIF(s.rating_count, 0), 0) as avg_rating
+                FROM users u
+                LEFT JOIN user_stats_rollup r ON r.user_id = u.telegram_id
+                LEFT JOIN driver_rating_stats s ON s.driver_id = u.telegram_id
+                WHERE u.role = 'driver'
+                ORDER BY total_earnings DESC
+                LIMIT 5
+            ''').fetchall()
         total_stats = {
-            "total_orders": len(orders),
-            "completed_orders": len([o for o in orders if o[3] == 'completed']),
-            "canceled_orders": len([o for o in orders if o[3] in ('cancelled', 'cancelled_by_passenger', 'cancelled_by_driver', 'expired')]),
-            "total_earnings": sum(o[6] or 0 for o in orders if o[3] == 'completed')
+            "total_orders": totals[0],
+            "completed_orders": totals[1],
+            "canceled_orders": totals[2],
+            "total_earnings": totals[3]
         }
         
-        # === ИСПРАВЛЕННЫЙ ЗАПРОС: ТОЛЬКО ЗАВЕРШЁННЫЕ ЗАКАЗЫ, БЕЗ ДУБЛИРОВАНИЯ ===
-        cur.execute('''
-            SELECT 
-                u.telegram_id, 
-                u.full_name, 
-                u.first_name,
-                COUNT(t.id) as total_orders,
-                COALESCE(SUM(t.fare), 0) as total_earnings,
-                COALESCE(AVG(r.rating), 0) as avg_rating
-            FROM users u
-            LEFT JOIN trips t ON u.telegram_id = t.driver_id AND t.status = 'completed'
-            LEFT JOIN ratings r ON t.id = r.trip_id
-            WHERE u.role = 'driver'
-            GROUP BY u.telegram_id, u.full_name, u.first_name
-            ORDER BY total_earnings DESC
-            LIMIT 5
-        ''')
-        top_drivers = cur.fetchall()
         top_drivers_list = []
         for d in top_drivers:
             user_id, full_name, first_name, total_orders, total_earnings, avg_rating = d
@@ -1573,11 +1675,11 @@ def create_app():
                 "avg_rating": round(avg_rating, 1) if avg_rating > 0 else None
             })
         
-        return jsonify({
+        return with_snapshot(jsonify({
             "users": {
                 "role_stats": {
-                    "passenger": len([u for u in users if u[3] == 'passenger']),
-                    "driver": len(drivers)
+                    "passenger": role_counts.get('passenger', 0),
+                    "driver": role_counts.get('driver', 0)
                 }
             },
             "orders": {
@@ -1586,49 +1688,50 @@ def create_app():
             "financial": {
                 "daily_earnings": [],
                 "top_drivers": top_drivers_list
-            }
-        })
+            },
+            "snapshot": snap
+        }), snap)
 
     @app.route('/api/admin/users')
     def api_users():
-        cur = DB.cursor()
-        cur.execute('''
-            SELECT u.*, b.reason as ban_reason, b.banned_until, b.banned_at
-            FROM users u 
-            LEFT JOIN bans b ON u.telegram_id = b.user_id
-        ''')
-        users = cur.fetchall()
+        with reader() as cur:
+            users = cur.execute('''
+                SELECT u.telegram_id, u.username, u.first_name, u.role, u.is_banned, u.registration_date,
+                       b.reason as ban_reason, b.banned_until, b.banned_at
+                FROM users u 
+                LEFT JOIN bans b ON u.telegram_id = b.user_id
+            ''').fetchall()
         return jsonify([{
             "user_id": u[0], "username": u[1], "first_name": u[2], "role": u[3],
-            "is_banned": bool(u[4]), "registration_date": u[13],
-            "ban_reason": u[14], "banned_until": u[15], "banned_at": u[16]
+            "is_banned": bool(u[4]), "registration_date": u[5],
+            "ban_reason": u[6], "banned_until": u[7], "banned_at": u[8]
         } for u in users])
 
     @app.route('/api/admin/passengers')
     def api_passengers():
-        cur = DB.cursor()
-        cur.execute('''
-            SELECT u.*, b.reason as ban_reason, b.banned_until, b.banned_at
-            FROM users u 
-            LEFT JOIN bans b ON u.telegram_id = b.user_id
-            WHERE u.role = 'passenger'
-        ''')
-        passengers = cur.fetchall()
+        with reader() as cur:
+            passengers = cur.execute('''
+                SELECT u.telegram_id, u.username, u.first_name, u.role, u.is_banned, u.registration_date,
+                       b.reason as ban_reason, b.banned_until, b.banned_at
+                FROM users u 
+                LEFT JOIN bans b ON u.telegram_id = b.user_id
+                WHERE u.role = 'passenger'
+            ''').fetchall()
         return jsonify([{
             "user_id": p[0],
             "username": p[1],
             "first_name": p[2],
             "is_banned": bool(p[4]),
-            "registration_date": p[13],
-            "ban_reason": p[14],
-            "banned_until": p[15],
-            "banned_at": p[16]
+            "registration_date": p[5],
+            "ban_reason": p[6],
+            "banned_until": p[7],
+            "banned_at": p[8]
         } for p in passengers])
 
     @app.route('/api/admin/drivers_for_messaging')
     def api_drivers_for_messaging():
-        cur = DB.cursor()
-        drivers = cur.execute("SELECT * FROM users WHERE role = 'driver' AND is_banned = 0").fetchall()
+        with reader() as cur:
+            drivers = cur.execute("SELECT * FROM users WHERE role = 'driver' AND is_banned = 0").fetchall()
         return jsonify([{
             "user_id": d[0], "username": d[1], "first_name": d[2],
             "is_banned": bool(d[4])
@@ -1636,30 +1739,30 @@ def create_app():
 
     @app.route('/api/drivers')
     def api_drivers():
-        cur = DB.cursor()
-        cur.execute('''
-            SELECT 
-                u.telegram_id,
-                u.full_name,
-                u.first_name,
-                u.username,
-                u.is_banned,
-                u.car_brand,
-                u.car_model,
-                u.license_plate,
-                COUNT(DISTINCT t.id) as total_orders,
-                SUM(CASE WHEN t.status = 'completed' THEN 1 ELSE 0 END) as completed_orders,
-                SUM(CASE WHEN t.status IN ('cancelled', 'cancelled_by_passenger', 'cancelled_by_driver', 'expired') THEN 1 ELSE 0 END) as canceled_orders,
-                SUM(CASE WHEN t.status = 'completed' THEN t.fare ELSE 0 END) as total_earnings,
-                AVG(r.rating) as avg_rating
-            FROM users u
-            LEFT JOIN trips t ON u.telegram_id = t.driver_id
-            LEFT JOIN ratings r ON t.id = r.trip_id
-            WHERE u.role = 'driver'
-            GROUP BY u.telegram_id
-        ''')
-        rows = cur.fetchall()
-        return jsonify([{
+        # Ответ — список (его ждёт страница), поэтому возраст снимка только в заголовке
+        with snapshot.reader() as (cur, snap):
+            rows = cur.execute('''
+                SELECT 
+                    u.telegram_id,
+                    u.full_name,
+                    u.first_name,
+                    u.username,
+                    u.is_banned,
+                    u.car_brand,
+                    u.car_model,
+                    u.license_plate,
+                    r.driver_trips as total_orders,
+                    r.driver_completed as completed_orders,
+                    r.driver_cancelled as canceled_orders,
+                    r.driver_earnings as total_earnings,
+                    s.rating_sum * 1.0 / NULLIF(s.rating_count, 0) as avg_rating,
+                    COALESCE(s.rating_count, 0) as rating_count
+                FROM users u
+                LEFT JOIN user_stats_rollup r ON r.user_id = u.telegram_id
+                LEFT JOIN driver_rating_stats s ON s.driver_id = u.telegram_id
+                WHERE u.role = 'driver'
+            ''').fetchall()
+        return with_snapshot(jsonify([{
             "user_id": row[0],
             "name": row[1],
             "first_name": row[2],
@@ -1672,22 +1775,39 @@ def create_app():
             "completed_orders": row[9] or 0,
             "canceled_orders": row[10] or 0,
             "total_earnings": row[11] or 0,
-            "avg_rating": round(row[12], 1) if row[12] else None
-        } for row in rows])
+            "avg_rating": round(row[12], 1) if row[12] else None,
+            "rating_count": row[13]
+        } for row in rows]), snap)
 
     @app.route('/api/orders')
     def api_orders():
-        cur = DB.cursor()
-        cur.execute('''
-            SELECT 
-                t.id, t.passenger_id, t.driver_id, t.status, t.pickup, t.destination, t.fare, t.created_at, t.cancellation_reason,
-                u.full_name, u.license_plate
-            FROM trips t
-            LEFT JOIN users u ON t.driver_id = u.telegram_id
-            ORDER BY t.created_at DESC
-            LIMIT 50
-        ''')
-        orders = cur.fetchall()
+        # ?from=YYYY-MM-DD&to=YYYY-MM-DD (UTC, включительно); если диапазон заходит
+        # в архив, trips_source() объединяет живую таблицу с archive.trips
+        try:
+            start = date.fromisoformat(request.args['from']) if request.args.get('from') else None
+            end = date.fromisoformat(request.args['to']) if request.args.get('to') else None
+            limit = min(int(request.args.get('limit', 50)), 500)
+        except ValueError:
+            return jsonify({"success": False, "message": "Даты в формате YYYY-MM-DD"}), 400
+        where, params = [], []
+        if start:
+            where.append("t.created_ts >= ?")
+            params.append(timeutil.to_ts(start.isoformat()))
+        if end:
+            where.append("t.created_ts < ?")
+            params.append(timeutil.to_ts((end + timedelta(days=1)).isoformat()))
+        with reader() as cur:
+            source = trips_source(cur, params[0] if start else None) if where else "trips"
+            orders = cur.execute(f'''
+                SELECT 
+                    t.id, t.passenger_id, t.driver_id, t.status, t.pickup, t.destination, t.fare, t.created_at, t.cancellation_reason,
+                    u.full_name, u.license_plate
+                FROM {source} t
+                LEFT JOIN users u ON t.driver_id = u.telegram_id
+                {"WHERE " + " AND ".join(where) if where else ""}
+                ORDER BY t.id DESC
+                LIMIT ?
+            ''', (*params, limit)).fetchall()
         return jsonify({"recent_orders": [
             {
                 "order_id": o[0],
@@ -1705,14 +1825,26 @@ def create_app():
             for o in orders
         ]})
 
+    @app.route('/api/trip_changes')
+    def api_trip_changes():
+        """Изменения поездок после курсора: ?after=<seq>&limit=N (limit=0 — только текущий курсор).
+
+        Клиент один раз читает поездки целиком вместе с курсором (limit=0), дальше
+        запрашивает только новые события с after=cursor; при reset перечитывает всё.
+        """
+        if 'user_id' not in session:
+            return jsonify({"success": False, "message": "Требуется авторизация"}), 401
+        after = request.args.get('after', 0, type=int)
+        limit = min(max(request.args.get('limit', 500, type=int), 0), 5000)
+        return jsonify(get_trip_changes(after, limit))
+
     @app.route('/api/tariffs')
     def api_tariffs():
-        cur = DB.cursor()
-        tariffs = cur.execute("SELECT id, name, price FROM tariffs").fetchall()
+        tariffs = get_tariffs()
         return jsonify([{"id": t[0], "name": t[1], "price": t[2]} for t in tariffs])
 
     @app.route('/api/tariffs', methods=['POST'])
-    def create_tariff():
+    def create_tariff_api():
         data = request.get_json()
         name = data.get('name')
         price = data.get('price')
@@ -1720,9 +1852,7 @@ def create_app():
             return jsonify({"success": False, "message": "Название и цена обязательны"}), 400
         try:
             price = float(price)
-            cur = DB.cursor()
-            cur.execute("INSERT INTO tariffs (name, price) VALUES (?, ?)", (name, price))
-            DB.commit()
+            add_tariff(name, price)
             return jsonify({"success": True, "message": "Тариф добавлен"})
         except ValueError:
             return jsonify({"success": False, "message": "Цена должна быть числом"}), 400
@@ -1730,7 +1860,7 @@ def create_app():
             return jsonify({"success": False, "message": "Тариф с таким названием уже существует"}), 400
 
     @app.route('/api/tariffs/<int:tariff_id>', methods=['PUT'])
-    def update_tariff(tariff_id):
+    def update_tariff_api(tariff_id):
         data = request.get_json()
         name = data.get('name')
         price = data.get('price')
@@ -1738,52 +1868,46 @@ def create_app():
             return jsonify({"success": False, "message": "Название и цена обязательны"}), 400
         try:
             price = float(price)
-            cur = DB.cursor()
-            cur.execute("UPDATE tariffs SET name = ?, price = ? WHERE id = ?", (name, price, tariff_id))
-            DB.commit()
-            if cur.rowcount == 0:
+            if not update_tariff(tariff_id, name, price):
                 return jsonify({"success": False, "message": "Тариф не найден"}), 404
             return jsonify({"success": True, "message": "Тариф обновлён"})
         except ValueError:
             return jsonify({"success": False, "message": "Цена должна быть числом"}), 400
 
     @app.route('/api/tariffs/<int:tariff_id>', methods=['DELETE'])
-    def delete_tariff(tariff_id):
-        cur = DB.cursor()
-        cur.execute("DELETE FROM tariffs WHERE id = ?", (tariff_id,))
-        DB.commit()
-        if cur.rowcount == 0:
+    def delete_tariff_api(tariff_id):
+        if not delete_tariff(tariff_id):
             return jsonify({"success": False, "message": "Тариф не найден"}), 404
         return jsonify({"success": True, "message": "Тариф удалён"})
 
     @app.route('/api/financial')
     def api_financial():
-        cur = DB.cursor()
-        cur.execute('''
-            SELECT 
-                date(created_at) as day,
-                SUM(fare) as earnings
-            FROM trips
-            WHERE status = 'completed'
-            GROUP BY date(created_at)
-            ORDER BY day DESC
-            LIMIT 7
-        ''')
-        rows = cur.fetchall()
-        daily_earnings = [
-            {"day": row[0], "earnings": row[1] or 0}
-            for row in rows
-        ]
-        return jsonify({"daily_earnings": daily_earnings})
+        # ?from=YYYY-MM-DD&to=YYYY-MM-DD&granularity=hour|day|month; без диапазона — последние 7 корзин
+        granularity = request.args.get('granularity', 'day')
+        if granularity not in REVENUE_GRANULARITIES:
+            return jsonify({"success": False, "message": "granularity: hour, day или month"}), 400
+        try:
+            start = date.fromisoformat(request.args['from']) if request.args.get('from') else None
+            end = date.fromisoformat(request.args['to']) if request.args.get('to') else None
+        except ValueError:
+            return jsonify({"success": False, "message": "Даты в формате YYYY-MM-DD"}), 400
+        limit = None if start or end else 7
+        with snapshot.reader() as (cur, snap):
+            rows = _revenue_rows(cur, granularity, start, end, limit)
+        buckets = [{"bucket": b, "orders": orders, "earnings": revenue or 0} for b, orders, revenue in rows]
+        response = {"granularity": granularity, "buckets": buckets, "snapshot": snap}
+        if granularity == 'day':
+            response["daily_earnings"] = [{"day": b["bucket"], "earnings": b["earnings"]} for b in buckets]
+        return with_snapshot(jsonify(response), snap)
 
     @app.route('/api/cancellation_reasons')
     def api_cancellation_reasons():
         user_type = request.args.get('user_type', 'all')
-        cur = DB.cursor()
-        if user_type == 'all':
-            reasons = cur.execute("SELECT id, user_type, reason_text FROM cancellation_reasons").fetchall()
-        else:
-            reasons = cur.execute("SELECT id, user_type, reason_text FROM cancellation_reasons WHERE user_type = ?", (user_type,)).fetchall()
+        with reader() as cur:
+            if user_type == 'all':
+                reasons = cur.execute("SELECT id, user_type, reason_text FROM cancellation_reasons").fetchall()
+            else:
+                reasons = cur.execute("SELECT id, user_type, reason_text FROM cancellation_reasons WHERE user_type = ?", (user_type,)).fetchall()
         return jsonify([{
             "id": r[0],
             "user_type": r[1],
@@ -1851,6 +1975,74 @@ def create_app():
         except Exception as e:
             return jsonify({"success": False, "message": f"Ошибка: {str(e)}"}), 500
 
+    @app.route('/api/admin/cache_stats')
+    def api_cache_stats():
+        if 'user_id' not in session:
+            return jsonify({"success": False, "message": "Требуется авторизация"}), 401
+        return jsonify(user_cache_stats())
+
+    @app.route('/api/admin/export/<table>')
+    def api_export(table):
+        """Потоковая выгрузка: ?format=csv|ndjson&from=&to=&status=a,b&gzip=0|1 (по умолчанию gzip)."""
+        if 'user_id' not in session:
+            return jsonify({"success": False, "message": "Требуется авторизация"}), 401
+        if table not in export.TABLES:
+            return jsonify({"success": False, "message": f"Неизвестная таблица {table}"}), 404
+        fmt = request.args.get('format', 'csv')
+        compress = request.args.get('gzip', '1') != '0'
+        statuses = request.args['status'].split(',') if request.args.get('status') else None
+        try:
+            start = date.fromisoformat(request.args['from']) if request.args.get('from') else None
+            end = date.fromisoformat(request.args['to']) if request.args.get('to') else None
+        except ValueError:
+            return jsonify({"success": False, "message": "Даты в формате YYYY-MM-DD"}), 400
+        if fmt not in export.FORMATS or (statuses and not export.TABLES[table][2]):
+            return jsonify({"success": False, "message": "Неверный формат или фильтр статуса"}), 400
+        body = export.chunks(
+            table, fmt,
+            timeutil.to_ts(start.isoformat()) if start else None,
+            timeutil.to_ts((end + timedelta(days=1)).isoformat()) if end else None,
+            statuses)
+        filename = f"{table}.{'csv' if fmt == 'csv' else 'ndjson'}{'.gz' if compress else ''}"
+        return Response(
+            export.gzip_stream(body) if compress else body,
+            mimetype="application/gzip" if compress else ("text/csv" if fmt == "csv" else "application/x-ndjson"),
+            headers={"Content-Disposition": f"attachment; filename={filename}"})
+
+    @app.route('/api/admin/query_stats')
+    def api_query_stats():
+        """Горячие запросы (sort — поле сортировки, по умолчанию total_ms) и последние медленные."""
+        if 'user_id' not in session:
+            return jsonify({"success": False, "message": "Требуется авторизация"}), 401
+        if request.args.get('reset') == '1':
+            querylog.STATS.reset()
+        limit = request.args.get('limit', 50, type=int)
+        stats = querylog.STATS.snapshot(request.args.get('sort', 'total_ms'), limit)
+        stats["enabled"] = querylog.QUERY_LOG
+        stats["slow"] = querylog.STATS.slow(limit)
+        return jsonify(stats)
+
+    @app.route('/api/admin/fanout_stats')
+    def api_fanout_stats():
+        """Последние рассылки заказов водителям: сколько получили и за сколько секунд."""
+        if 'user_id' not in session:
+            return jsonify({"success": False, "message": "Требуется авторизация"}), 401
+        return jsonify({"recent": fanout.FANOUT.recent(request.args.get('limit', 50, type=int))})
+
+    @app.route('/api/admin/outbox_stats')
+    def api_outbox_stats():
+        """Очереди исходящих запросов к Telegram по классам приоритета: глубина, отправлено, задержка."""
+        if 'user_id' not in session:
+            return jsonify({"success": False, "message": "Требуется авторизация"}), 401
+        return jsonify(outbox.OUTBOX.stats())
+
+    @app.route('/api/admin/deadline_stats')
+    def api_deadline_stats():
+        """Сроки заказов: сколько ожидают, сработало, пачек и опоздание срабатывания (мс)."""
+        if 'user_id' not in session:
+            return jsonify({"success": False, "message": "Требуется авторизация"}), 401
+        return jsonify(deadlines.DEADLINES.stats())
+
     @app.route('/api/admin/send_message', methods=['POST'])
     def api_send_message():
         if 'user_id' not in session:
@@ -1858,39 +2050,69 @@ def create_app():
 
         data = request.get_json()
         message_text = data.get('message_text', '').strip()
-        broadcast_type = data.get('broadcast_type', 'all')  # 'drivers', 'passengers', 'all'
+        broadcast_type = data.get('broadcast_type', 'all')  # сегмент: 'drivers', 'active:7', ... (segments.py)
 
         if not message_text:
             return jsonify({"success": False, "message": "Текст сообщения не может быть пустым"}), 400
 
-        # Получаем только НЕЗАБАНЕННЫХ пользователей нужной роли
-        cur = DB.cursor()
-        if broadcast_type == 'drivers':
-            cur.execute("SELECT telegram_id FROM users WHERE role = 'driver' AND is_banned = 0")
-        elif broadcast_type == 'passengers':
-            cur.execute("SELECT telegram_id FROM users WHERE role = 'passenger' AND is_banned = 0")
-        else:  # 'all'
-            cur.execute("SELECT telegram_id FROM users WHERE is_banned = 0")
-        
-        user_ids = [row[0] for row in cur.fetchall()]
-
-        if not user_ids:
-            return jsonify({"success": False, "message": "Нет активных получателей для рассылки"}), 400
-
         full_message = f"📢 От руководства службы такси:\n{message_text}"
 
-        # Отправляем в очередь из db_utils
-        from db_utils import BROADCAST_QUEUE
-        BROADCAST_QUEUE.put({
-            "user_ids": user_ids,
-            "message_text": full_message
-        })
+        # Задание сохраняется в базе (только НЕЗАБАНЕННЫЕ пользователи сегмента);
+        # бот подхватывает его сразу после записи и переживает перезапуск
+        try:
+            job_id, total = broadcasts.create_job(broadcast_type, full_message)
+        except ValueError as e:
+            return jsonify({"success": False, "message": str(e)}), 400
+        if not job_id:
+            return jsonify({"success": False, "message": "Нет активных получателей для рассылки"}), 400
 
         return jsonify({
             "success": True,
-            "message": f"Рассылка поставлена в очередь для {len(user_ids)} пользователей"
+            "job_id": job_id,
+            "message": f"Рассылка №{job_id} поставлена в очередь для {total} пользователей"
         })
 
+    @app.route('/api/admin/segments')
+    def api_segments():
+        """Аудитории рассылок: имя, название и параметр (например, число дней)."""
+        if 'user_id' not in session:
+            return jsonify({"success": False, "message": "Требуется авторизация"}), 401
+        return jsonify({"segments": segments.describe()})
+
+    @app.route('/api/admin/segments/estimate')
+    def api_segment_estimate():
+        """Сколько пользователей получат рассылку сегменту ?audience=... — до подтверждения отправки."""
+        if 'user_id' not in session:
+            return jsonify({"success": False, "message": "Требуется авторизация"}), 401
+        try:
+            return jsonify(segments.estimate(request.args.get('audience', 'all')))
+        except ValueError as e:
+            return jsonify({"success": False, "message": str(e)}), 400
+
+    @app.route('/api/admin/broadcasts')
+    def api_broadcasts():
+        """Последние рассылки: отправлено, ошибок, осталось, скорость (сообщ./с) и оценка времени до конца."""
+        if 'user_id' not in session:
+            return jsonify({"success": False, "message": "Требуется авторизация"}), 401
+        return jsonify({"jobs": broadcasts.get_jobs(None, request.args.get('limit', 20, type=int))})
+
+    @app.route('/api/admin/broadcasts/<int:job_id>')
+    def api_broadcast(job_id):
+        if 'user_id' not in session:
+            return jsonify({"success": False, "message": "Требуется авторизация"}), 401
+        jobs = broadcasts.get_jobs(job_id, 1)
+        if not jobs:
+            return jsonify({"success": False, "message": "Рассылка не найдена"}), 404
+        return jsonify(jobs[0])
+
+    @app.route('/api/admin/broadcasts/<int:job_id>/cancel', methods=['POST'])
+    def api_cancel_broadcast(job_id):
+        if 'user_id' not in session:
+            return jsonify({"success": False, "message": "Требуется авторизация"}), 401
+        if not broadcasts.cancel_job(job_id):
+            return jsonify({"success": False, "message": "Рассылка уже завершена или не найдена"}), 409
+        return jsonify({"success": True, "message": f"Рассылка №{job_id} остановлена"})
+
 
     @app.route('/api/admin/create_driver', methods=['POST'])
     def create_driver():
@@ -1907,24 +2129,11 @@ def create_app():
             contact_phone = driver_data.get('contact_phone')
             payment_phone = driver_data.get('payment_phone')
             bank = driver_data.get('bank')
-            cur = DB.cursor()
-            cur.execute('''
-                UPDATE users SET
-                    role = 'driver',
-                    full_name = ?,
-                    car_brand = ?,
-                    car_model = ?,
-                    license_plate = ?,
-                    phone_number = ?,
-                    payment_number = ?,
-                    bank_name = ?
-                WHERE telegram_id = ?
-            ''', (
-                full_name, car_brand, car_model, license_plate,
-                contact_phone, payment_phone, bank, user_id
-            ))
-            DB.commit()
-            if cur.rowcount == 0:
+            updated = save_driver_profile(
+                user_id, full_name, car_brand, car_model, license_plate,
+                contact_phone, payment_phone, bank
+            )
+            if not updated:
                 return jsonify({"success": False, "message": "Пользователь не найден"}), 404
             return jsonify({"success": True, "message": "Водитель успешно создан!"})
         except Exception as e:
@@ -1938,10 +2147,7 @@ def create_app():
             user_id = data.get('user_id')
             if not user_id:
                 return jsonify({"success": False, "message": "Не указан ID пользователя"}), 400
-            cur = DB.cursor()
-            cur.execute("UPDATE users SET role = 'passenger', full_name = NULL, car_brand = NULL, car_model = NULL, license_plate = NULL, car_color = NULL, phone_number = NULL, payment_number = NULL, bank_name = NULL WHERE telegram_id = ? AND role = 'driver'", (user_id,))
-            DB.commit()
-            if cur.rowcount == 0:
+            if not delete_driver_profile(user_id):
                 return jsonify({"success": False, "message": "Водитель не найден"}), 404
             return jsonify({"success": True, "message": "Водитель удалён"})
         except Exception as e:
@@ -1956,21 +2162,13 @@ def create_app():
             reason = data.get('reason', 'Отменено диспетчером')
             if not order_id:
                 return jsonify({"success": False, "message": "Не указан ID заказа"}), 400
-            cur = DB.cursor()
-            trip = cur.execute("SELECT * FROM trips WHERE id = ?", (order_id,)).fetchone()
+            trip = cancel_trip(order_id, 'cancelled', reason)
             if not trip:
+                if get_trip(order_id):
+                    return jsonify({"success": False, "message": "Заказ уже завершён или отменён"}), 409
                 return jsonify({"success": False, "message": "Заказ не найден"}), 404
-            cur.execute("UPDATE trips SET status = 'cancelled', cancellation_reason = ? WHERE id = ?", (reason, order_id))
-            DB.commit()
-            try:
-                from bot import cancel_trip_cleanup
-                import threading
-                # Запускаем в фоне через поток (не асинхронно)
-                def notify():
-                    cancel_trip_cleanup(order_id, 'admin', reason)
-                threading.Thread(target=notify, daemon=True).start()
-            except Exception as e:
-                print(f"Ошибка при отправке уведомлений: {e}")
+            deadlines.DEADLINES.disarm_all(order_id)
+            _notify_cancelled(order_id, reason, trip)
             return jsonify({"success": True, "message": "Заказ отменён"})
         except Exception as e:
             print(f"Ошибка при отмене заказа: {e}")
@@ -1,24 +1,357 @@
 # db_utils.py
+import os
 import sqlite3
 import queue
-from datetime import datetime, timedelta
+import threading
+import functools
+import time
+import heapq
+from concurrent.futures import Future
+from collections import OrderedDict, namedtuple, deque
+from contextlib import contextmanager
+from datetime import timedelta
 
-# Глобальная очередь для рассылки
-BROADCAST_QUEUE = queue.Queue()
+import migrations
+import querylog
+import timeutil
+import trip_states
 
-DB = None
+# Настройки пула соединений
+DB_PATH = os.getenv("DB_PATH", "taxi.db")
+DB_READERS = int(os.getenv("DB_READERS", "4"))
+DB_BUSY_TIMEOUT_MS = int(os.getenv("DB_BUSY_TIMEOUT_MS", "5000"))
+DB_CACHE_SIZE_KB = int(os.getenv("DB_CACHE_SIZE_KB", "16384"))
+DB_SYNCHRONOUS = os.getenv("DB_SYNCHRONOUS", "FULL")
+# Групповая фиксация: сколько ждать попутных записей и сколько брать за раз.
+# При окне 0 в группу попадает всё, что накопилось, пока шёл предыдущий COMMIT;
+# на медленных дисках имеет смысл окно в несколько миллисекунд.
+DB_COMMIT_WINDOW_MS = float(os.getenv("DB_COMMIT_WINDOW_MS", "0"))
+DB_COMMIT_MAX_BATCH = int(os.getenv("DB_COMMIT_MAX_BATCH", "256"))
 
-def init_db(db_path='taxi.db'):
-    global DB
-    if DB is None:
-        DB = sqlite3.connect(db_path, check_same_thread=False)
+# Кэш контекста пользователя (роль и бан)
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "10000"))
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", "60"))  # секунд
+# Снятие истёкших банов: сколько за одну транзакцию и через сколько секунд повторить при ошибке
+BAN_EXPIRY_BATCH = int(os.getenv("BAN_EXPIRY_BATCH", "500"))
+BAN_EXPIRY_RETRY = float(os.getenv("BAN_EXPIRY_RETRY", "5"))
+# Автобан за частые отмены: "окно_часов:порог:дней_бана" через запятую.
+# По умолчанию — бан на сутки за 4-ю отмену за 24 часа
+CANCEL_POLICIES = os.getenv("CANCEL_POLICIES", "24:4:1")
+
+# Архив закрытых поездок (см. archive.py): пусто — taxi_archive.db рядом с основной базой,
+# "off" — без архива
+ARCHIVE_DB_PATH = os.getenv("ARCHIVE_DB_PATH", "")
+
+POOL = None
+WRITER = None
+TRIP_COLUMNS = []  # колонки trips после миграций; по ним строится объединение с архивом
+
+# === ПУЛ СОЕДИНЕНИЙ ===
+class ConnectionPool:
+    """Одно соединение-писатель и N соединений только для чтения поверх WAL.
+
+    Читатели не блокируют писателя и друг друга: каждый SELECT видит последний
+    зафиксированный снимок. Все записи сериализуются через единственного писателя,
+    вложенные write() выполняются в транзакции внешнего вызова, вложенные read()
+    в том же потоке переиспользуют уже взятое соединение-читатель.
+    """
+
+    def __init__(self, db_path=DB_PATH, readers=DB_READERS,
+                 busy_timeout_ms=DB_BUSY_TIMEOUT_MS, cache_size_kb=DB_CACHE_SIZE_KB, archive_path=None):
+        self.db_path = db_path
+        self.archive_path = archive_path
+        self.busy_timeout_ms = busy_timeout_ms
+        self.cache_size_kb = cache_size_kb
+        self._write_lock = threading.RLock()
+        self._write_depth = 0
+        self._write_owner = None
+        self._on_commit = []
+        self._on_rollback = []
+        self._held = threading.local()
+        self._writer = self._connect()
+        if db_path == ':memory:':
+            # In-memory базу нельзя открыть вторым соединением — читаем через писателя
+            readers = 0
+        else:
+            self._writer.execute("PRAGMA journal_mode = WAL")
+            self._writer.execute(f"PRAGMA synchronous = {DB_SYNCHRONOUS}")
+            if archive_path:
+                self._writer.execute("PRAGMA archive.journal_mode = WAL")
+                self._writer.execute(f"PRAGMA archive.synchronous = {DB_SYNCHRONOUS}")
+        self.readers_count = readers
+        self._readers = queue.Queue()
+        for _ in range(readers):
+            self._readers.put(self._connect(read_only=True))
+
+    def _connect(self, read_only=False):
+        if read_only:
+            uri = f"file:{os.path.abspath(self.db_path)}?mode=ro"
+            conn = sqlite3.connect(uri, uri=True, check_same_thread=False, isolation_level=None,
+                                   factory=querylog.connection_factory())
+            conn.execute("PRAGMA query_only = 1")
+        else:
+            conn = sqlite3.connect(self.db_path, check_same_thread=False, isolation_level=None,
+                                   factory=querylog.connection_factory())
+        conn.execute(f"PRAGMA busy_timeout = {int(self.busy_timeout_ms)}")
+        conn.execute(f"PRAGMA cache_size = -{int(self.cache_size_kb)}")
+        if self.archive_path:
+            # Писатель подключается первым и создаёт файл архива, читатели — только чтение
+            target = f"file:{os.path.abspath(self.archive_path)}?mode=ro" if read_only else self.archive_path
+            conn.execute("ATTACH DATABASE ? AS archive", (target,))
+        return conn
+
+    def _owns_writer(self):
+        return self._write_owner == threading.get_ident()
+
+    @contextmanager
+    def read(self):
+        # Внутри транзакции записи читаем через писателя, чтобы видеть свои изменения
+        if self.readers_count == 0 or self._owns_writer():
+            with self._write_lock:
+                cur = self._writer.cursor()
+                try:
+                    yield cur
+                finally:
+                    cur.close()
+            return
+        held = getattr(self._held, 'conn', None)
+        if held is None:
+            with querylog.timed_wait("reader"):
+                conn = self._readers.get()
+        else:
+            conn = held
+        self._held.conn = conn
+        cur = conn.cursor()
+        try:
+            yield cur
+        finally:
+            cur.close()
+            if held is None:
+                self._held.conn = None
+                self._readers.put(conn)
+
+    @contextmanager
+    def write(self):
+        with self._write_lock:
+            cur = self._writer.cursor()
+            if self._write_depth:
+                self._write_depth += 1
+                try:
+                    yield cur
+                finally:
+                    self._write_depth -= 1
+                return
+            with querylog.timed_wait("begin"):
+                self._writer.execute("BEGIN IMMEDIATE")
+            self._write_depth = 1
+            self._write_owner = threading.get_ident()
+            try:
+                yield cur
+            except BaseException:
+                self._writer.rollback()
+                self._on_commit.clear()
+                self.undo()
+                raise
+            else:
+                try:
+                    with querylog.timed_wait("commit"):
+                        self._writer.commit()
+                except BaseException:
+                    self._writer.rollback()
+                    self._on_commit.clear()
+                    self.undo()
+                    raise
+                self._on_rollback.clear()
+                callbacks, self._on_commit = self._on_commit, []
+                for callback in callbacks:
+                    callback()
+            finally:
+                self._write_depth = 0
+                self._write_owner = None
+                cur.close()
+
+    def after_commit(self, callback):
+        """Вызвать callback после фиксации текущей транзакции записи (или сразу, если её нет)."""
+        if self._owns_writer():
+            self._on_commit.append(callback)
+        else:
+            callback()
+
+    def on_rollback(self, callback):
+        """Вызвать callback, если текущая транзакция записи (или точка сохранения операции) откатится."""
+        if self._owns_writer():
+            self._on_rollback.append(callback)
+
+    def undo(self, mark=0):
+        """Выполняет в обратном порядке откаты, зарегистрированные после mark."""
+        callbacks = self._on_rollback[mark:]
+        del self._on_rollback[mark:]
+        for callback in reversed(callbacks):
+            callback()
+
+    def close(self):
+        while not self._readers.empty():
+            self._readers.get_nowait().close()
+        self._writer.close()
+
+# === ГРУППОВАЯ ФИКСАЦИЯ ===
+class GroupCommitWriter:
+    """Единственный поток-писатель с групповой фиксацией.
+
+    Запросы на запись из цикла бота и потоков Flask попадают в одну очередь.
+    Поток забирает всё, что пришло за окно window_ms (но не больше max_batch),
+    выполняет каждую операцию в своей точке сохранения и делает один COMMIT
+    на всю группу. Future каждого запроса завершается только после COMMIT,
+    то есть когда данные уже на диске; ошибка одной операции откатывает только её.
+    """
+
+    def __init__(self, pool, window_ms=DB_COMMIT_WINDOW_MS, max_batch=DB_COMMIT_MAX_BATCH):
+        self.pool = pool
+        self.window = window_ms / 1000.0
+        self.max_batch = max_batch
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name="db-writer", daemon=True)
+        self.commits = 0
+        self.operations = 0
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._queue.put(None)
+        self._thread.join()
+
+    def in_writer_thread(self):
+        return threading.current_thread() is self._thread
+
+    def submit(self, func, *args, **kwargs):
+        """Ставит func(cur, *args, **kwargs) в очередь, возвращает concurrent.futures.Future."""
+        future = Future()
+        future.queued_at = time.perf_counter()
+        self._queue.put((func, args, kwargs, future))
+        return future
+
+    def _collect(self, first):
+        batch = [first]
+        deadline = time.monotonic() + self.window
+        while len(batch) < self.max_batch:
+            try:
+                timeout = deadline - time.monotonic()
+                item = self._queue.get(timeout=timeout) if timeout > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is None:
+                self._queue.put(None)
+                break
+            batch.append(item)
+        return batch
+
+    def _run(self):
+        while True:
+            first = self._queue.get()
+            if first is None:
+                return
+            batch = [op for op in self._collect(first) if op[3].set_running_or_notify_cancel()]
+            if batch:
+                self._commit(batch)
+
+    def _commit(self, batch):
+        results = []
+        try:
+            with querylog.operation("group_commit"), self.pool.write() as cur:
+                for func, args, kwargs, future in batch:
+                    with querylog.operation(func.__name__):
+                        querylog.record_wait("writer_queue", future.queued_at)
+                        cur.execute("SAVEPOINT op")
+                        callbacks_mark = len(self.pool._on_commit)
+                        undo_mark = len(self.pool._on_rollback)
+                        try:
+                            result = func(cur, *args, **kwargs)
+                        except Exception as e:
+                            cur.execute("ROLLBACK TO op")
+                            del self.pool._on_commit[callbacks_mark:]
+                            self.pool.undo(undo_mark)
+                            results.append((future, None, e))
+                        else:
+                            results.append((future, result, None))
+                        cur.execute("RELEASE op")
+        except Exception as e:
+            for _, _, _, future in batch:
+                future.set_exception(e)
+            return
+        self.commits += 1
+        self.operations += len(batch)
+        for future, result, error in results:
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+    def stats(self):
+        return {
+            "commits": self.commits,
+            "operations": self.operations,
+            "avg_batch": round(self.operations / self.commits, 2) if self.commits else 0,
+            "queued": self._queue.qsize(),
+        }
+
+def init_db(db_path=DB_PATH, readers=DB_READERS,
+            busy_timeout_ms=DB_BUSY_TIMEOUT_MS, cache_size_kb=DB_CACHE_SIZE_KB, migrate=True):
+    global POOL, WRITER
+    if POOL is None:
+        POOL = ConnectionPool(db_path, readers, busy_timeout_ms, cache_size_kb, _archive_path(db_path))
         _create_tables()
         _insert_defaults()
-        _update_schema()
-    return DB
+        if migrate:
+            _update_schema()
+            _sync_archive_schema()
+        WRITER = GroupCommitWriter(POOL).start()
+        if migrate:
+            # Без миграций (manage.py migrate) нужных колонок может ещё не быть
+            BANS.load(_load_bans())
+            BANS.start()
+            CANCELS.load(_load_cancellations())
+    return POOL
+
+def _archive_path(db_path):
+    if db_path == ':memory:' or ARCHIVE_DB_PATH == 'off':
+        return None
+    return ARCHIVE_DB_PATH or os.path.join(os.path.dirname(os.path.abspath(db_path)), 'taxi_archive.db')
+
+def reader():
+    """Курсор соединения-читателя (контекстный менеджер)."""
+    return POOL.read()
+
+def writer():
+    """Курсор писателя внутри транзакции (контекстный менеджер)."""
+    return POOL.write()
+
+def reads(func):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with querylog.operation(func.__name__), POOL.read() as cur:
+            return func(cur, *args, **kwargs)
+    wrapper.db_kind = 'read'
+    return wrapper
 
-def _create_tables():
-    c = DB.cursor()
+def writes(func):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        # До запуска писателя (создание схемы) и внутри него самого — выполняем сразу
+        if WRITER is None or WRITER.in_writer_thread():
+            with querylog.operation(func.__name__), POOL.write() as cur:
+                return func(cur, *args, **kwargs)
+        return WRITER.submit(func, *args, **kwargs).result()
+
+    def submit(*args, **kwargs):
+        return WRITER.submit(func, *args, **kwargs)
+    wrapper.db_kind = 'write'
+    wrapper.submit = submit
+    return wrapper
+
+@writes
+def _create_tables(c):
     c.execute('''
         CREATE TABLE IF NOT EXISTS users (
             telegram_id INTEGER PRIMARY KEY,
@@ -64,18 +397,7 @@ def _create_tables():
             accepted_at TEXT,
             arrived_at TEXT,
             completed_at TEXT,
-            passenger_message_id INTEGER,
-            driver_message_id INTEGER,
-            driver_card_message_id INTEGER,
-            passenger_fare_message_id INTEGER,
-            passenger_eta_message_id INTEGER,
-            driver_fare_message_id INTEGER,
-            driver_eta_message_id INTEGER,
-            driver_control_message_id INTEGER,
-            passenger_arrival_message_id INTEGER,
             cancellation_reason TEXT,
-            driver_tariff_message_id INTEGER,
-            driver_eta_select_message_id INTEGER,
             confirm_timeout_at TEXT,
             return_count INTEGER DEFAULT 0
         )
@@ -114,253 +436,993 @@ def _create_tables():
             last_cancel_reset TEXT DEFAULT (datetime('now', '-1 day'))
         )
     ''')
-    DB.commit()
 
-def _insert_defaults():
-    c = DB.cursor()
+# Начальные данные пустой базы (общие для всех хранилищ, см. storage.py)
+DEFAULT_TARIFFS = [('300 ₽', 300.0), ('500 ₽', 500.0), ('700 ₽', 700.0), ('1000 ₽', 1000.0)]
+DEFAULT_ETA_OPTIONS = [('5 мин', 5), ('10 мин', 10), ('15 мин', 15), ('20 мин', 20), ('25 мин', 25), ('30 мин', 30), ('>30 мин', 60)]
+DEFAULT_CANCELLATION_REASONS = [
+    # Причины для водителя
+    ('driver', 'Отменён водителем'),
+    ('driver', 'Не договорились о цене'),
+    ('driver', 'Долгое ожидание'),
+    ('driver', 'Отменён пассажиром'),
+    # Причины для пассажира
+    ('passenger', 'Передумал'),
+    ('passenger', 'Не устраивает водитель'),
+    ('passenger', 'Не устраивает машина'),
+    ('passenger', 'Долгое ожидание'),
+]
+
+@writes
+def _insert_defaults(c):
     c.execute("SELECT COUNT(*) FROM tariffs")
     if c.fetchone()[0] == 0:
-        c.execute("INSERT INTO tariffs (name, price) VALUES ('300 ₽', 300.0), ('500 ₽', 500.0), ('700 ₽', 700.0), ('1000 ₽', 1000.0)")
+        c.executemany("INSERT INTO tariffs (name, price) VALUES (?, ?)", DEFAULT_TARIFFS)
 
     c.execute("SELECT COUNT(*) FROM eta_options")
     if c.fetchone()[0] == 0:
-        c.execute("INSERT INTO eta_options (text, minutes) VALUES ('5 мин', 5), ('10 мин', 10), ('15 мин', 15), ('20 мин', 20), ('25 мин', 25), ('30 мин', 30), ('>30 мин', 60)")
+        c.executemany("INSERT INTO eta_options (text, minutes) VALUES (?, ?)", DEFAULT_ETA_OPTIONS)
 
     c.execute("SELECT COUNT(*) FROM cancellation_reasons")
     if c.fetchone()[0] == 0:
-        # Причины для водителя
-        c.execute("INSERT INTO cancellation_reasons (user_type, reason_text) VALUES ('driver', 'Отменён водителем')")
-        c.execute("INSERT INTO cancellation_reasons (user_type, reason_text) VALUES ('driver', 'Не договорились о цене')")
-        c.execute("INSERT INTO cancellation_reasons (user_type, reason_text) VALUES ('driver', 'Долгое ожидание')")
-        c.execute("INSERT INTO cancellation_reasons (user_type, reason_text) VALUES ('driver', 'Отменён пассажиром')")
-        # Причины для пассажира
-        c.execute("INSERT INTO cancellation_reasons (user_type, reason_text) VALUES ('passenger', 'Передумал')")
-        c.execute("INSERT INTO cancellation_reasons (user_type, reason_text) VALUES ('passenger', 'Не устраивает водитель')")
-        c.execute("INSERT INTO cancellation_reasons (user_type, reason_text) VALUES ('passenger', 'Не устраивает машина')")
-        c.execute("INSERT INTO cancellation_reasons (user_type, reason_text) VALUES ('passenger', 'Долгое ожидание')")
-
-    DB.commit()
-
-def _update_schema():
-    cur = DB.cursor()
-    # Добавляем новые поля, если их нет
-    for col in [
-        "confirm_timeout_at",
-        "return_count"
-    ]:
-        try:
-            cur.execute(f"ALTER TABLE trips ADD COLUMN {col} TEXT")
-        except sqlite3.OperationalError:
-            pass
-    try:
-        cur.execute("ALTER TABLE users ADD COLUMN is_banned INTEGER DEFAULT 0")
-    except sqlite3.OperationalError:
-        pass
-    DB.commit()
+        c.executemany("INSERT INTO cancellation_reasons (user_type, reason_text) VALUES (?, ?)", DEFAULT_CANCELLATION_REASONS)
+
+@writes
+def _update_schema(cur, dry_run=False):
+    return migrations.migrate(cur, dry_run=dry_run)
+
+# Горячие запросы и индекс, который каждый из них обязан использовать.
+# Проверяется командой `python manage.py check-plans`.
+HOT_QUERIES = {
+    "has_active_order": (
+        "SELECT 1 FROM trips WHERE passenger_id = ? AND status IN ('requested', 'accepted', 'in_progress')",
+        (0,), "idx_trips_passenger_status"),
+    "get_driver_active_orders_count": (
+        "SELECT COUNT(*) FROM trips WHERE driver_id = ? AND status IN ('accepted', 'in_progress')",
+        (0,), "idx_trips_driver_status"),
+    "get_driver_rating": (
+        "SELECT rating_sum, rating_count FROM driver_rating_stats WHERE driver_id = ?",
+        (0,), "INTEGER PRIMARY KEY"),
+    "get_ban_info": (
+        "SELECT reason, banned_until FROM bans WHERE user_id = ?",
+        (0,), "idx_bans_user"),
+    "get_expired_trips": (
+        "SELECT id, passenger_id FROM trips WHERE status = 'requested' AND created_ts < ?",
+        (0,), "idx_trips_status_created_ts"),
+}
+
+@reads
+def explain_hot_queries(cur):
+    """Для каждого горячего запроса: (имя, индекс найден в плане, план)."""
+    report = []
+    for name, (sql, params, index) in HOT_QUERIES.items():
+        plan = [row[3] for row in cur.execute("EXPLAIN QUERY PLAN " + sql, params)]
+        uses_index = any(index in step for step in plan)
+        report.append((name, uses_index, plan))
+    return report
+
+# === КЭШ КОНТЕКСТА ПОЛЬЗОВАТЕЛЯ ===
+UserContext = namedtuple('UserContext', 'role is_banned banned_until ban_reason')
+
+_MISSING = object()
+
+class UserContextCache:
+    """LRU с TTL: telegram_id -> роль.
+
+    Записи сбрасываются после фиксации любой записи, меняющей роль,
+    TTL страхует от изменений в обход db_utils. Баны живут в BanExpiryEngine.
+    """
+
+    def __init__(self, max_size=USER_CACHE_SIZE, ttl=USER_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        # Растёт при каждом сбросе: значение, прочитанное до сброса, в кэш не попадёт
+        self.version = 0
+
+    def get(self, user_id, default=None):
+        with self._lock:
+            item = self._items.get(user_id)
+            if item is None or item[0] < time.monotonic():
+                if item is not None:
+                    del self._items[user_id]
+                self.misses += 1
+                return default
+            self._items.move_to_end(user_id)
+            self.hits += 1
+            return item[1]
+
+    def put(self, user_id, value, version):
+        with self._lock:
+            if version != self.version:
+                return
+            self._items[user_id] = (time.monotonic() + self.ttl, value)
+            self._items.move_to_end(user_id)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._items.pop(user_id, None)
+            self.invalidations += 1
+            self.version += 1
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "size": len(self._items),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / total, 3) if total else None,
+                "invalidations": self.invalidations,
+            }
+
+USER_CACHE = UserContextCache()
+
+def _invalidate_user(user_id):
+    POOL.after_commit(lambda: USER_CACHE.invalidate(user_id))
+
+@reads
+def _load_user_role(cur, telegram_id):
+    row = cur.execute("SELECT role FROM users WHERE telegram_id = ?", (telegram_id,)).fetchone()
+    return row[0] if row else None
+
+def load_user_role(telegram_id):
+    """Промах кэша: читает роль из БД и кладёт её в кэш."""
+    version = USER_CACHE.version
+    role = _load_user_role(telegram_id)
+    USER_CACHE.put(telegram_id, role, version)
+    return role
+
+def get_user_context(telegram_id):
+    role = USER_CACHE.get(telegram_id, _MISSING)
+    if role is _MISSING:
+        role = load_user_role(telegram_id)
+    return UserContext(role, *BANS.status(telegram_id))
+
+def user_cache_stats():
+    return dict(USER_CACHE.stats(), bans=BANS.stats())
+
+# === ИСТЕЧЕНИЕ БАНОВ ===
+class BanExpiryEngine:
+    """Активные баны в памяти: user_id -> (reason, banned_until, banned_until_ts).
+
+    Проверка бана — поиск в словаре и одно сравнение. Сроки лежат в min-куче,
+    фоновый поток снимает все наступившие баны одной транзакцией. Словарь
+    меняется только после фиксации ban_user/unban_user, поэтому не расходится с БД.
+    """
+
+    def __init__(self, batch=BAN_EXPIRY_BATCH):
+        self.batch = batch
+        self._bans = {}
+        self._heap = []
+        self._cond = threading.Condition()
+        self._thread = None
+        self._stopping = False
+        self.sweeps = 0
+        self.lifted = 0
+
+    def load(self, rows):
+        """rows — (user_id, reason, banned_until, banned_until_ts) в порядке выдачи банов."""
+        bans, heap = {}, []
+        for user_id, reason, banned_until, deadline in rows:
+            bans[user_id] = (reason, banned_until, deadline)
+        for user_id, (_, _, deadline) in bans.items():
+            if deadline is not None:
+                heap.append((deadline, user_id))
+        heapq.heapify(heap)
+        with self._cond:
+            self._bans, self._heap = bans, heap
+            self._cond.notify()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="ban-expiry", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        with self._cond:
+            self._stopping = True
+            self._cond.notify()
+        if self._thread:
+            self._thread.join()
+
+    def is_banned(self, user_id):
+        ban = self._bans.get(user_id)
+        return ban is not None and (ban[2] is None or ban[2] > time.time())
+
+    def status(self, user_id):
+        """(is_banned, banned_until, reason) без обращения к БД."""
+        ban = self._bans.get(user_id)
+        if ban is None or (ban[2] is not None and ban[2] <= time.time()):
+            return False, None, None
+        return True, ban[1], ban[0]
+
+    def banned(self, user_id, reason, banned_until, deadline):
+        with self._cond:
+            self._bans[user_id] = (reason, banned_until, deadline)
+            if deadline is not None:
+                heapq.heappush(self._heap, (deadline, user_id))
+                if self._heap[0] == (deadline, user_id):
+                    self._cond.notify()
+
+    def unbanned(self, user_id, deadline=_MISSING):
+        # Запись в куче остаётся и будет пропущена при извлечении.
+        # С deadline снимаем только тот бан, который истёк, а не выданный заново
+        with self._cond:
+            ban = self._bans.get(user_id)
+            if ban is not None and (deadline is _MISSING or ban[2] == deadline):
+                del self._bans[user_id]
+
+    def _pop_due(self):
+        now = time.time()
+        due = {}
+        while self._heap and self._heap[0][0] <= now and len(due) < self.batch:
+            _, user_id = heapq.heappop(self._heap)
+            ban = self._bans.get(user_id)
+            # Устаревшие записи кучи (бан снят или продлён) пропускаем
+            if ban is not None and ban[2] is not None and ban[2] <= now:
+                due[user_id] = ban[2]
+        return list(due.items())
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._stopping:
+                    if self._heap and self._heap[0][0] <= time.time():
+                        break
+                    self._cond.wait(self._heap[0][0] - time.time() if self._heap else None)
+                if self._stopping:
+                    return
+                due = self._pop_due()
+            if not due:
+                continue
+            try:
+                _lift_expired_bans(due)
+            except Exception as e:
+                print(f"Ошибка при снятии истёкших банов: {e}")
+                retry_at = time.time() + BAN_EXPIRY_RETRY
+                with self._cond:
+                    for user_id, _ in due:
+                        heapq.heappush(self._heap, (retry_at, user_id))
+                continue
+            self.sweeps += 1
+            self.lifted += len(due)
+
+    def stats(self):
+        with self._cond:
+            return {
+                "active": len(self._bans),
+                "scheduled": len(self._heap),
+                "next_expiry_in": round(self._heap[0][0] - time.time(), 1) if self._heap else None,
+                "sweeps": self.sweeps,
+                "lifted": self.lifted,
+            }
+
+BANS = BanExpiryEngine()
+
+@reads
+def _load_bans(cur):
+    return cur.execute("SELECT user_id, reason, banned_until, banned_until_ts FROM bans ORDER BY id").fetchall()
+
+@writes
+def _lift_expired_bans(cur, expired):
+    """Снимает наступившие баны одной транзакцией; expired — [(user_id, banned_until_ts)]."""
+    cur.executemany("DELETE FROM bans WHERE user_id = ? AND banned_until_ts = ?", expired)
+    cur.executemany(
+        "UPDATE users SET is_banned = 0 WHERE telegram_id = ? "
+        "AND NOT EXISTS (SELECT 1 FROM bans WHERE user_id = ?)",
+        [(user_id, user_id) for user_id, _ in expired])
+    def forget():
+        for user_id, deadline in expired:
+            BANS.unbanned(user_id, deadline)
+    POOL.after_commit(forget)
 
 # === ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ ===
 def get_user_role(telegram_id):
-    cur = DB.cursor()
-    res = cur.execute("SELECT role FROM users WHERE telegram_id = ?", (telegram_id,)).fetchone()
-    return res[0] if res else None
+    return get_user_context(telegram_id).role
 
-def save_user(telegram_id, username, first_name):
-    cur = DB.cursor()
+@writes
+def save_user(cur, telegram_id, username, first_name):
     cur.execute("SELECT 1 FROM users WHERE telegram_id = ?", (telegram_id,))
     if cur.fetchone():
         cur.execute("UPDATE users SET username = ?, first_name = ? WHERE telegram_id = ?", (username, first_name, telegram_id))
     else:
-        cur.execute("INSERT INTO users (telegram_id, username, first_name, role) VALUES (?, ?, ?, 'passenger')", (telegram_id, username, first_name))
-    DB.commit()
-
-def has_active_order(user_id):
-    cur = DB.cursor()
-    res = cur.execute("""
-        SELECT 1 FROM trips 
-        WHERE passenger_id = ? AND status IN ('requested', 'accepted', 'in_progress')
-    """, (user_id,)).fetchone()
+        cur.execute("INSERT INTO users (telegram_id, username, first_name, role, registration_ts) VALUES (?, ?, ?, 'passenger', ?)",
+                    (telegram_id, username, first_name, timeutil.now_ts()))
+    _invalidate_user(telegram_id)
+
+@reads
+def has_active_order(cur, user_id):
+    res = cur.execute(HOT_QUERIES["has_active_order"][0], (user_id,)).fetchone()
     return bool(res)
 
-def create_trip(passenger_id, pickup, destination):
-    cur = DB.cursor()
-    cur.execute("INSERT INTO trips (passenger_id, pickup, destination) VALUES (?, ?, ?)", (passenger_id, pickup, destination))
-    trip_id = cur.lastrowid
-    DB.commit()
-    return trip_id
-
-def get_trip(trip_id):
-    cur = DB.cursor()
-    return cur.execute("SELECT * FROM trips WHERE id = ?", (trip_id,)).fetchone()
-
-def assign_driver_to_trip(trip_id, driver_id):
-    cur = DB.cursor()
-    cur.execute("UPDATE trips SET driver_id = ?, status = 'accepted', accepted_at = datetime('now') WHERE id = ? AND status = 'requested'", (driver_id, trip_id))
-    updated = cur.rowcount
-    DB.commit()
-    return updated > 0
-
-def mark_arrived(trip_id):
-    cur = DB.cursor()
-    cur.execute("UPDATE trips SET status = 'in_progress', arrived_at = datetime('now') WHERE id = ?", (trip_id,))
-    DB.commit()
-
-def complete_trip(trip_id):
-    cur = DB.cursor()
-    cur.execute("UPDATE trips SET status = 'completed', completed_at = datetime('now') WHERE id = ?", (trip_id,))
-    DB.commit()
-
-def get_all_drivers():
-    cur = DB.cursor()
+@writes
+def create_trip(cur, passenger_id, pickup, destination):
+    cur.execute("INSERT INTO trips (passenger_id, pickup, destination, created_ts) VALUES (?, ?, ?, ?)",
+                (passenger_id, pickup, destination, timeutil.now_ts()))
+    return cur.lastrowid
+
+# === ПОЕЗДКИ ===
+class Trip:
+    """Строка trips с доступом к колонкам по имени."""
+
+    __slots__ = (
+        'id', 'passenger_id', 'driver_id', 'status', 'pickup', 'destination', 'fare',
+        'created_at', 'accepted_at', 'arrived_at', 'completed_at', 'cancellation_reason',
+        'confirm_timeout_at', 'return_count',
+        'created_ts', 'accepted_ts', 'arrived_ts', 'completed_ts', 'confirm_timeout_ts',
+    )
+
+    def __init__(self, **fields):
+        for name in self.__slots__:
+            setattr(self, name, fields.get(name))
+
+    @classmethod
+    def from_row(cls, cursor, row):
+        """row_factory для sqlite3: колонки сопоставляются по именам из cursor.description."""
+        trip = cls()
+        for column, value in zip(cursor.description, row):
+            if column[0] in _TRIP_FIELDS:
+                setattr(trip, column[0], value)
+        return trip
+
+    def __repr__(self):
+        return f"Trip(id={self.id}, status={self.status!r}, passenger_id={self.passenger_id}, driver_id={self.driver_id})"
+
+_TRIP_FIELDS = frozenset(Trip.__slots__)
+
+def _fetch_trip(cur, sql, params):
+    # Отдельный курсор: общий курсор группы записи не должен унаследовать row_factory
+    trip_cur = cur.connection.cursor()
+    trip_cur.row_factory = Trip.from_row
+    try:
+        return trip_cur.execute(sql, params).fetchone()
+    finally:
+        trip_cur.close()
+
+def _fetch_trips(cur, sql, params):
+    trip_cur = cur.connection.cursor()
+    trip_cur.row_factory = Trip.from_row
+    try:
+        return trip_cur.execute(sql, params).fetchall()
+    finally:
+        trip_cur.close()
+
+@reads
+def get_trip(cur, trip_id):
+    trip = _fetch_trip(cur, "SELECT * FROM trips WHERE id = ?", (trip_id,))
+    if trip is None and POOL.archive_path:
+        trip = _fetch_trip(cur, "SELECT * FROM archive.trips WHERE id = ?", (trip_id,))
+    return trip
+
+# === АРХИВ ПОЕЗДОК ===
+@writes
+def _sync_archive_schema(cur):
+    """Создаёт archive.trips и добавляет в неё колонки, появившиеся в trips после миграций."""
+    global TRIP_COLUMNS
+    columns = [(row[1], row[2]) for row in cur.execute("PRAGMA main.table_info(trips)")]
+    TRIP_COLUMNS = [name for name, _ in columns]
+    if not POOL.archive_path:
+        return
+    cur.execute("CREATE TABLE IF NOT EXISTS archive.trips (id INTEGER PRIMARY KEY, archived_ts INTEGER)")
+    existing = {row[1] for row in cur.execute("PRAGMA archive.table_info(trips)")}
+    for name, decl in columns:
+        if name not in existing:
+            cur.execute(f"ALTER TABLE archive.trips ADD COLUMN {name} {decl}")
+    cur.execute("CREATE INDEX IF NOT EXISTS archive.idx_archive_trips_created_ts ON trips(created_ts)")
+    cur.execute("CREATE INDEX IF NOT EXISTS archive.idx_archive_trips_passenger ON trips(passenger_id)")
+    cur.execute("CREATE INDEX IF NOT EXISTS archive.idx_archive_trips_driver ON trips(driver_id)")
+
+def trips_source(cur, start_ts=None):
+    """Откуда читать поездки, созданные не раньше start_ts (None — вся история).
+
+    Пока диапазон не заходит в архив, это просто trips; иначе — подзапрос,
+    объединяющий живую таблицу и archive.trips с одинаковым набором колонок.
+    """
+    if len(trip_tables(cur, start_ts)) == 1:
+        return "trips"
+    columns = ", ".join(TRIP_COLUMNS)
+    return f"(SELECT {columns} FROM main.trips UNION ALL SELECT {columns} FROM archive.trips)"
+
+def trip_tables(cur, start_ts=None):
+    """Таблицы с поездками, созданными не раньше start_ts: ('trips',) или ('main.trips', 'archive.trips').
+
+    Для запросов, которым удобнее проверить каждую таблицу по её индексам, чем читать объединение.
+    """
+    if not POOL.archive_path:
+        return ("trips",)
+    newest = cur.execute("SELECT MAX(created_ts) FROM archive.trips").fetchone()[0]
+    if newest is None or (start_ts is not None and start_ts > newest):
+        return ("trips",)
+    return ("main.trips", "archive.trips")
+
+# Изменяющие поездку функции — переходы trip_states: возвращают свежую строку
+# (Trip) через RETURNING, либо None, если поездки нет или её статус не допускает переход.
+def _transition(cur, name, trip_id, driver=None, **fields):
+    """driver — водитель, от имени которого выполняется переход (trip_states.DRIVER_TRANSITIONS)."""
+    return _fetch_trip(cur, trip_states.transition_sql(name, tuple(fields)),
+                       trip_states.transition_params(name, trip_id, tuple(fields.values()), driver_id=driver))
+
+def confirm_fields(deadline):
+    """Колонки срока подтверждения (текст — местное время, как в update_confirm_timeout)."""
+    return {"confirm_timeout_at": timeutil.to_text(deadline, local=True), "confirm_timeout_ts": deadline}
+
+@writes
+def assign_driver_to_trip(cur, trip_id, driver_id, confirm_by=None):
+    """confirm_by — срок (epoch), до которого водитель должен назначить цену, иначе заказ вернётся в пул."""
+    return _transition(cur, "accept", trip_id, driver_id=driver_id, **confirm_fields(confirm_by))
+
+# Переходы водителя выполняются, только если driver_id — всё ещё водитель поездки:
+# иначе None, как и для поездки в другом статусе
+
+@writes
+def mark_arrived(cur, trip_id, driver_id):
+    return _transition(cur, "arrive", trip_id, driver=driver_id)
+
+@writes
+def complete_trip(cur, trip_id, driver_id):
+    return _transition(cur, "complete", trip_id, driver=driver_id)
+
+@writes
+def set_trip_fare(cur, trip_id, fare, driver_id):
+    # Цена назначена — водитель подтвердил заказ, срок подтверждения снимается
+    return _transition(cur, "set_fare", trip_id, driver=driver_id, fare=fare, **confirm_fields(None))
+
+@writes
+def cancel_trip(cur, trip_id, status, reason_text=None, driver_id=None):
+    """status — 'cancelled' (диспетчер), 'cancelled_by_passenger' или 'cancelled_by_driver' (нужен driver_id)."""
+    return _transition(cur, trip_states.CANCEL_TRANSITIONS[status], trip_id, driver=driver_id,
+                       cancellation_reason=reason_text)
+
+@reads
+def get_expired_trips(cur, timeout_minutes):
+    return cur.execute(HOT_QUERIES["get_expired_trips"][0], (timeutil.from_now(minutes=-timeout_minutes),)).fetchall()
+
+@writes
+def expire_due_trips(cur, timeout_minutes, limit=100):
+    """Атомарно переводит просроченные заказы в 'expired': [(id, passenger_id)]."""
+    return cur.execute("""
+        UPDATE trips SET status = 'expired'
+        WHERE id IN (SELECT id FROM trips WHERE status = 'requested' AND created_ts < ? ORDER BY created_ts LIMIT ?)
+        RETURNING id, passenger_id
+    """, (timeutil.from_now(minutes=-timeout_minutes), limit)).fetchall()
+
+# Срок ожидающего заказа: явный (после возврата в пул) или от создания
+_REQUESTED_DEADLINE = "COALESCE(confirm_timeout_ts, created_ts + ?)"
+
+@reads
+def get_trip_deadlines(cur, timeout_minutes):
+    """Сроки для планировщика deadlines: [(id, status, срок epoch)].
+
+    requested — срок принятия заказа, accepted — срок назначения цены водителем.
+    """
+    return cur.execute(f"""
+        SELECT id, status, CASE status WHEN 'requested' THEN {_REQUESTED_DEADLINE} ELSE confirm_timeout_ts END
+        FROM trips WHERE status = 'requested' OR (status = 'accepted' AND confirm_timeout_ts IS NOT NULL)
+    """, (timeout_minutes * 60,)).fetchall()
+
+@writes
+def expire_trips(cur, trip_ids, timeout_minutes):
+    """Просрочивает из trip_ids заказы, срок которых наступил, одним UPDATE: [(id, passenger_id)].
+
+    Принятые, отменённые и возвращённые в пул позже заказы условие пропускает.
+    """
+    if not trip_ids:
+        return []
+    return cur.execute(f"""
+        UPDATE trips SET status = 'expired'
+        WHERE id IN ({', '.join('?' * len(trip_ids))}) AND {trip_states.status_condition("expire")}
+          AND {_REQUESTED_DEADLINE} <= ?
+        RETURNING id, passenger_id
+    """, (*trip_ids, timeout_minutes * 60, timeutil.now_ts())).fetchall()
+
+@writes
+def release_stalled_trips(cur, trip_ids, timeout_minutes):
+    """Возвращает в пул принятые заказы из trip_ids, цену которых водитель не назначил в срок.
+
+    Заказ снова ждёт водителя timeout_minutes, return_count растёт.
+    Возвращает [(Trip, id водителя, который не подтвердил)].
+    """
+    if not trip_ids:
+        return []
+    now = timeutil.now_ts()
+    drivers = dict(cur.execute(f"""
+        SELECT id, driver_id FROM trips
+        WHERE id IN ({', '.join('?' * len(trip_ids))}) AND {trip_states.status_condition("release")}
+          AND confirm_timeout_ts <= ?
+    """, (*trip_ids, now)).fetchall())
+    if not drivers:
+        return []
+    deadline = now + timeout_minutes * 60
+    trips = _fetch_trips(cur, f"""
+        UPDATE trips SET status = 'requested', driver_id = NULL, accepted_at = NULL, accepted_ts = NULL,
+            confirm_timeout_at = ?, confirm_timeout_ts = ?, return_count = return_count + 1
+        WHERE id IN ({', '.join('?' * len(drivers))})
+        RETURNING *
+    """, (timeutil.to_text(deadline, local=True), deadline, *drivers))
+    return [(trip, drivers[trip.id]) for trip in trips]
+
+def iter_trips(start_ts=None, end_ts=None, batch=1000):
+    """Поездки (Trip) с created_ts в [start_ts, end_ts) по возрастанию id, вместе с архивом.
+
+    Читает страницами по ключу id, соединение-читатель берётся на одну страницу.
+    """
+    after = 0
+    while True:
+        with reader() as cur:
+            where, params = ["id > ?"], [after]
+            if start_ts is not None:
+                where.append("created_ts >= ?")
+                params.append(start_ts)
+            if end_ts is not None:
+                where.append("created_ts < ?")
+                params.append(end_ts)
+            sql = f"SELECT * FROM {trips_source(cur, start_ts)} WHERE {' AND '.join(where)} ORDER BY id LIMIT ?"
+            page = _fetch_trips(cur, sql, (*params, batch))
+        yield from page
+        if len(page) < batch:
+            return
+        after = page[-1].id
+
+@writes
+def expire_trip(cur, trip_id):
+    return _transition(cur, "expire", trip_id)
+
+@reads
+def get_all_drivers(cur):
     return cur.execute("SELECT telegram_id FROM users WHERE role = 'driver' AND is_banned = 0").fetchall()
 
-def get_tariffs():
-    cur = DB.cursor()
+@reads
+def get_tariffs(cur):
     return cur.execute("SELECT id, name, price FROM tariffs").fetchall()
 
-def get_eta_options():
-    cur = DB.cursor()
+@writes
+def add_tariff(cur, name, price):
+    cur.execute("INSERT INTO tariffs (name, price) VALUES (?, ?)", (name, price))
+    return cur.lastrowid
+
+@writes
+def update_tariff(cur, tariff_id, name, price):
+    cur.execute("UPDATE tariffs SET name = ?, price = ? WHERE id = ?", (name, price, tariff_id))
+    return cur.rowcount > 0
+
+@writes
+def delete_tariff(cur, tariff_id):
+    cur.execute("DELETE FROM tariffs WHERE id = ?", (tariff_id,))
+    return cur.rowcount > 0
+
+@reads
+def get_eta_options(cur):
     return cur.execute("SELECT id, text, minutes FROM eta_options ORDER BY minutes").fetchall()
 
-def get_driver_rating(driver_id):
-    cur = DB.cursor()
-    res = cur.execute("SELECT AVG(rating) FROM ratings WHERE driver_id = ?", (driver_id,)).fetchone()
-    return round(res[0], 1) if res[0] else None
+@reads
+def get_driver_profile(cur, driver_id):
+    return cur.execute("""
+        SELECT full_name, car_brand, car_model, license_plate, phone_number, payment_number, bank_name
+        FROM users WHERE telegram_id = ?
+    """, (driver_id,)).fetchone()
+
+@writes
+def save_driver_profile(cur, user_id, full_name, car_brand, car_model, license_plate,
+                        phone_number, payment_number, bank_name):
+    cur.execute('''
+        UPDATE users SET
+            role = 'driver',
+            full_name = ?,
+            car_brand = ?,
+            car_model = ?,
+            license_plate = ?,
+            phone_number = ?,
+            payment_number = ?,
+            bank_name = ?
+        WHERE telegram_id = ?
+    ''', (
+        full_name, car_brand, car_model, license_plate,
+        phone_number, payment_number, bank_name, user_id
+    ))
+    _invalidate_user(user_id)
+    return cur.rowcount > 0
+
+@writes
+def delete_driver_profile(cur, user_id):
+    cur.execute("UPDATE users SET role = 'passenger', full_name = NULL, car_brand = NULL, car_model = NULL, license_plate = NULL, car_color = NULL, phone_number = NULL, payment_number = NULL, bank_name = NULL WHERE telegram_id = ? AND role = 'driver'", (user_id,))
+    _invalidate_user(user_id)
+    return cur.rowcount > 0
 
-def save_rating(trip_id, driver_id, passenger_id, rating):
-    cur = DB.cursor()
-    cur.execute("INSERT OR REPLACE INTO ratings (trip_id, driver_id, passenger_id, rating) VALUES (?, ?, ?, ?)", 
-                (trip_id, driver_id, passenger_id, rating))
-    DB.commit()
+@reads
+def get_driver_stats(cur, driver_id):
+    # Статистика водителя - ТОЛЬКО завершенные поездки; обе выборки по первичному ключу
+    return cur.execute('''
+        SELECT 
+            COALESCE(r.driver_completed, 0) as completed_orders,
+            r.driver_earnings as total_earnings,
+            s.rating_sum * 1.0 / NULLIF(s.rating_count, 0) as avg_rating
+        FROM (SELECT ? AS id) q
+        LEFT JOIN user_stats_rollup r ON r.user_id = q.id
+        LEFT JOIN driver_rating_stats s ON s.driver_id = q.id
+    ''', (driver_id,)).fetchone()
+
+@reads
+def get_passenger_completed_count(cur, passenger_id):
+    res = cur.execute("SELECT passenger_completed FROM user_stats_rollup WHERE user_id = ?", (passenger_id,)).fetchone()
+    return res[0] if res else 0
+
+@reads
+def get_user_stats(cur, user_id):
+    """Строка user_stats_rollup пользователя как dict (нули, если поездок не было)."""
+    res = cur.execute(f"SELECT {', '.join(migrations.ROLLUP_COLUMNS)} FROM user_stats_rollup WHERE user_id = ?",
+                      (user_id,)).fetchone()
+    return dict(zip(migrations.ROLLUP_COLUMNS, res or [0] * len(migrations.ROLLUP_COLUMNS)))
+
+@reads
+def verify_user_stats_rollup(cur):
+    """Сверяет user_stats_rollup с полным пересчётом по trips вместе с архивом.
+
+    Возвращает список расхождений (user_id, колонка, в таблице, по пересчёту).
+    """
+    columns = migrations.ROLLUP_COLUMNS
+    zeros = (0,) * len(columns)
+    stored = {row[0]: row[1:] for row in cur.execute(
+        f"SELECT user_id, {', '.join(columns)} FROM user_stats_rollup")}
+    expected = {row[0]: row[1:] for row in cur.execute(migrations.rollup_recompute_sql(trips_source(cur)))}
+    diffs = []
+    for user_id in sorted(stored.keys() | expected.keys()):
+        have, want = stored.get(user_id, zeros), expected.get(user_id, zeros)
+        for column, h, w in zip(columns, have, want):
+            if abs((h or 0) - (w or 0)) > 0.005:
+                diffs.append((user_id, column, h, w))
+    return diffs
+
+# Гранулярность -> (таблица, выражение ключа корзины)
+REVENUE_GRANULARITIES = {
+    "hour": ("revenue_hourly", "bucket"),
+    "day": ("revenue_daily", "bucket"),
+    "month": ("revenue_daily", "substr(bucket, 1, 7)"),
+}
+
+@reads
+def get_revenue(cur, granularity="day", start=None, end=None, limit=None):
+    """Выручка по корзинам: [(корзина, заказов, выручка)] по возрастанию.
+
+    start и end — даты (date) включительно, по UTC. Без диапазона возвращает
+    последние limit непустых корзин. Читаются только корзины из диапазона.
+    """
+    return _revenue_rows(cur, granularity, start, end, limit)
+
+def _revenue_rows(cur, granularity="day", start=None, end=None, limit=None):
+    """get_revenue на переданном курсоре — например, на снимке базы дашборда."""
+    table, key = REVENUE_GRANULARITIES[granularity]
+    where, params = [], []
+    if start is not None:
+        where.append("bucket >= ?")
+        params.append(start.isoformat())
+    if end is not None:
+        where.append("bucket < ?")
+        params.append((end + timedelta(days=1)).isoformat())
+    sql = f"SELECT {key} AS b, SUM(orders), SUM(revenue) FROM {table}"
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    # Корзины, опустевшие после отмены завершения, не показываем
+    sql += " GROUP BY b HAVING SUM(orders) != 0 ORDER BY b DESC"
+    if limit:
+        sql += f" LIMIT {int(limit)}"
+    return cur.execute(sql, params).fetchall()[::-1]
+
+@writes
+def rebuild_revenue(cur):
+    """Пересчитывает revenue_hourly и revenue_daily по trips. Возвращает число часовых корзин."""
+    return migrations.rebuild_revenue_rollups(cur, trips_source(cur))
+
+@writes
+def _convert_timestamps_batch(cur, table, after_rowid, batch):
+    return migrations.convert_timestamps_batch(cur, table, after_rowid, batch)
+
+def backfill_timestamps(batch=1000, pause=0.0, progress=None):
+    """Онлайн-конвертация текстовых времён в *_ts: каждый пакет — своя короткая транзакция.
+
+    Между пакетами писатель успевает зафиксировать обычные записи бота.
+    progress(table, rowid) вызывается после каждого пакета.
+    """
+    for table in migrations.TIMESTAMP_COLUMNS:
+        after = 0
+        while True:
+            after = _convert_timestamps_batch(table, after, batch)
+            if after is None:
+                break
+            if progress:
+                progress(table, after)
+            if pause:
+                time.sleep(pause)
+
+@writes
+def rebuild_user_stats(cur):
+    """Пересчитывает user_stats_rollup по trips. Возвращает число пользователей."""
+    return migrations.rebuild_user_stats_rollup(cur, trips_source(cur))
+
+@reads
+def get_driver_rating(cur, driver_id):
+    res = cur.execute(HOT_QUERIES["get_driver_rating"][0], (driver_id,)).fetchone()
+    return round(res[0] / res[1], 1) if res and res[1] else None
+
+@reads
+def get_driver_rating_stats(cur, driver_id):
+    """{'avg', 'count', 'histogram': {1: n1, ..., 5: n5}} или None, если оценок нет."""
+    res = cur.execute("SELECT rating_sum, rating_count, r1, r2, r3, r4, r5 FROM driver_rating_stats WHERE driver_id = ?",
+                      (driver_id,)).fetchone()
+    if not res or not res[1]:
+        return None
+    return {"avg": round(res[0] / res[1], 1), "count": res[1], "histogram": dict(zip(range(1, 6), res[2:]))}
+
+def _add_to_rating_stats(cur, driver_id, rating, sign):
+    buckets = [sign if rating == stars else 0 for stars in range(1, 6)]
+    cur.execute('''
+        INSERT INTO driver_rating_stats (driver_id, rating_sum, rating_count, r1, r2, r3, r4, r5)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT(driver_id) DO UPDATE SET
+            rating_sum = rating_sum + excluded.rating_sum,
+            rating_count = rating_count + excluded.rating_count,
+            r1 = r1 + excluded.r1, r2 = r2 + excluded.r2, r3 = r3 + excluded.r3,
+            r4 = r4 + excluded.r4, r5 = r5 + excluded.r5
+    ''', (driver_id, sign * rating, sign, *buckets))
+
+@writes
+def save_rating(cur, trip_id, driver_id, passenger_id, rating):
+    # Повторная оценка той же поездки заменяет прежнюю: её вклад вычитаем из агрегатов
+    old = cur.execute("SELECT driver_id, rating FROM ratings WHERE trip_id = ?", (trip_id,)).fetchone()
+    cur.execute("INSERT OR REPLACE INTO ratings (trip_id, driver_id, passenger_id, rating, created_ts) VALUES (?, ?, ?, ?, ?)", 
+                (trip_id, driver_id, passenger_id, rating, timeutil.now_ts()))
+    if old and old[0] is not None and old[1] is not None:
+        _add_to_rating_stats(cur, old[0], old[1], -1)
+    if driver_id is not None:
+        _add_to_rating_stats(cur, driver_id, rating, 1)
+
+@writes
+def rebuild_rating_stats(cur):
+    """Пересчитывает driver_rating_stats по таблице ratings. Возвращает число водителей."""
+    return migrations.rebuild_driver_rating_stats(cur)
 
 # === Система отмен и банов ===
-def get_cancellation_reasons(user_type):
-    cur = DB.cursor()
+@reads
+def get_cancellation_reasons(cur, user_type):
     return cur.execute("SELECT id, reason_text FROM cancellation_reasons WHERE user_type = ?", (user_type,)).fetchall()
 
-def add_cancellation_reason(user_type, reason_text):
-    cur = DB.cursor()
+@reads
+def get_cancellation_reason_text(cur, reason_id):
+    res = cur.execute("SELECT reason_text FROM cancellation_reasons WHERE id = ?", (reason_id,)).fetchone()
+    return res[0] if res else None
+
+@writes
+def add_cancellation_reason(cur, user_type, reason_text):
     cur.execute("INSERT INTO cancellation_reasons (user_type, reason_text) VALUES (?, ?)", (user_type, reason_text))
-    DB.commit()
     return cur.lastrowid
 
-def update_cancellation_reason(reason_id, reason_text):
-    cur = DB.cursor()
+@writes
+def update_cancellation_reason(cur, reason_id, reason_text):
     cur.execute("UPDATE cancellation_reasons SET reason_text = ? WHERE id = ?", (reason_text, reason_id))
-    DB.commit()
 
-def delete_cancellation_reason(reason_id):
-    cur = DB.cursor()
+@writes
+def delete_cancellation_reason(cur, reason_id):
     cur.execute("DELETE FROM cancellation_reasons WHERE id = ?", (reason_id,))
-    DB.commit()
 
-def ban_user(user_id, reason, ban_duration_days=None):
-    cur = DB.cursor()
-    banned_until = None
+@writes
+def ban_user(cur, user_id, reason, ban_duration_days=None):
+    banned_until = deadline = None
     if ban_duration_days:
-        banned_until = datetime.now() + timedelta(days=ban_duration_days)
-        banned_until = banned_until.strftime('%Y-%m-%d %H:%M:%S')
-    cur.execute("INSERT INTO bans (user_id, reason, banned_until) VALUES (?, ?, ?)", 
-                (user_id, reason, banned_until))
+        deadline = timeutil.from_now(days=ban_duration_days)
+        banned_until = timeutil.to_text(deadline, local=True)
+    user_id = int(user_id)
+    # У пользователя один действующий бан: новый заменяет прежний
+    cur.execute("DELETE FROM bans WHERE user_id = ?", (user_id,))
+    cur.execute("INSERT INTO bans (user_id, reason, banned_until, banned_until_ts, banned_at_ts) VALUES (?, ?, ?, ?, ?)", 
+                (user_id, reason, banned_until, deadline, timeutil.now_ts()))
     cur.execute("UPDATE users SET is_banned = 1 WHERE telegram_id = ?", (user_id,))
-    DB.commit()
+    POOL.after_commit(lambda: BANS.banned(user_id, reason, banned_until, deadline))
 
-def unban_user(user_id):
-    cur = DB.cursor()
+@writes
+def unban_user(cur, user_id):
+    user_id = int(user_id)
     cur.execute("UPDATE users SET is_banned = 0 WHERE telegram_id = ?", (user_id,))
     cur.execute("DELETE FROM bans WHERE user_id = ?", (user_id,))
-    DB.commit()
+    POOL.after_commit(lambda: BANS.unbanned(user_id))
 
-def get_ban_info(user_id):
-    cur = DB.cursor()
-    return cur.execute("SELECT reason, banned_until FROM bans WHERE user_id = ?", (user_id,)).fetchone()
+@reads
+def get_ban_info(cur, user_id):
+    return cur.execute(HOT_QUERIES["get_ban_info"][0], (user_id,)).fetchone()
 
 def is_user_banned(user_id):
-    cur = DB.cursor()
-    ban_info = get_ban_info(user_id)
-    if not ban_info:
-        return False
-    reason, banned_until = ban_info
-    if banned_until and datetime.now() > datetime.strptime(banned_until, '%Y-%m-%d %H:%M:%S'):
-        unban_user(user_id)
-        return False
-    return True
-
-def increment_cancel_count(user_id):
-    cur = DB.cursor()
-    now = datetime.now()
-    cur.execute("SELECT cancel_count_24h, last_cancel_reset FROM user_stats WHERE user_id = ?", (user_id,))
-    row = cur.fetchone()
-    if not row:
-        cur.execute("INSERT INTO user_stats (user_id, cancel_count_24h, last_cancel_reset) VALUES (?, 1, ?)", (user_id, now))
-    else:
-        count, last_reset = row
-        last_reset_dt = datetime.strptime(last_reset, '%Y-%m-%d %H:%M:%S')
-        if (now - last_reset_dt).days >= 1:
-            count = 0
-            cur.execute("UPDATE user_stats SET cancel_count_24h = 1, last_cancel_reset = ? WHERE user_id = ?", (now, user_id))
+    return BANS.is_banned(user_id)
+
+CancelPolicy = namedtuple('CancelPolicy', 'window threshold ban_days reason')
+
+def parse_cancel_policies(spec):
+    """'24:4:1,1:3:0.25' -> [CancelPolicy]; окно в часах, бан в днях."""
+    policies = []
+    for part in filter(None, (p.strip() for p in spec.split(','))):
+        window_hours, threshold, ban_days = part.split(':')
+        policies.append(CancelPolicy(float(window_hours) * 3600, int(threshold), float(ban_days),
+                                     "Частые отмены заказов"))
+    return policies
+
+class CancellationTracker:
+    """Скользящее окно отмен: user_id -> кольцо последних времён отмен (epoch).
+
+    Кольцо держится в памяти и целиком сохраняется в user_stats.recent_cancels
+    одним UPSERT, поэтому отмена — одна запись без предварительного чтения.
+    Кольцо меняется только в потоке записи, так что отмены одного
+    пользователя не теряются и не переупорядочиваются; если транзакция
+    откатится, прежнее кольцо восстанавливается (POOL.on_rollback).
+    """
+
+    def __init__(self, policies):
+        self.policies = policies
+        self.size = max((p.threshold for p in policies), default=1)
+        self.window = max((p.window for p in policies), default=0)
+        self._rings = {}
+
+    def load(self, rows):
+        horizon = time.time() - self.window
+        rings = {}
+        for user_id, recent in rows:
+            stamps = [int(s) for s in recent.split(',') if s and int(s) > horizon]
+            if stamps:
+                rings[user_id] = deque(stamps, maxlen=self.size)
+        self._rings = rings
+
+    def record(self, user_id, now):
+        """Добавляет отмену; возвращает (кольцо для сохранения, сработавшее правило или None)."""
+        ring = self._rings.get(user_id)
+        if ring is None:
+            ring = self._rings[user_id] = deque(maxlen=self.size)
+        while ring and ring[0] <= now - self.window:
+            ring.popleft()
+        ring.append(now)
+        policy = self.check(ring, now)
+        if policy:
+            ring.clear()
+            return '', policy
+        return ','.join(map(str, ring)), None
+
+    def snapshot(self, user_id):
+        ring = self._rings.get(user_id)
+        return None if ring is None else list(ring)
+
+    def restore(self, user_id, stamps):
+        """Возвращает кольцо к снимку snapshot() — после отката транзакции."""
+        if stamps is None:
+            self._rings.pop(user_id, None)
         else:
-            new_count = count + 1
-            cur.execute("UPDATE user_stats SET cancel_count_24h = ? WHERE user_id = ?", (new_count, user_id))
-            if new_count > 3:
-                ban_user(user_id, "Частые отмены заказов", 1)
-    DB.commit()
-
-def get_active_drivers_count():
-    cur = DB.cursor()
-    return cur.execute("SELECT COUNT(*) FROM users WHERE role = 'driver' AND is_banned = 0").fetchone()[0]
+            self._rings[user_id] = deque(stamps, maxlen=self.size)
 
-def get_driver_active_orders_count(driver_id):
-    cur = DB.cursor()
-    return cur.execute("SELECT COUNT(*) FROM trips WHERE driver_id = ? AND status IN ('accepted', 'in_progress')", (driver_id,)).fetchone()[0]
+    def check(self, ring, now):
+        """Первое правило, сработавшее на кольце ring (времена по возрастанию), или None."""
+        for policy in self.policies:
+            # Порог N достигнут, если N-я с конца отмена попала в окно правила
+            if len(ring) >= policy.threshold and ring[-policy.threshold] > now - policy.window:
+                return policy
+        return None
 
-# === UPDATE MESSAGE ID FUNCTIONS ===
-def update_passenger_message_id(trip_id, message_id):
-    _update_trip_field(trip_id, "passenger_message_id", message_id)
+    def count(self, user_id, window=None):
+        horizon = time.time() - (self.window if window is None else window)
+        return sum(1 for t in self._rings.get(user_id, ()) if t > horizon)
 
-def update_driver_message_id(trip_id, message_id):
-    _update_trip_field(trip_id, "driver_message_id", message_id)
+CANCELS = CancellationTracker(parse_cancel_policies(CANCEL_POLICIES))
 
-def update_driver_card_message_id(trip_id, message_id):
-    _update_trip_field(trip_id, "driver_card_message_id", message_id)
+@reads
+def _load_cancellations(cur):
+    return cur.execute("SELECT user_id, recent_cancels FROM user_stats WHERE recent_cancels != ''").fetchall()
 
-def update_passenger_fare_message_id(trip_id, message_id):
-    _update_trip_field(trip_id, "passenger_fare_message_id", message_id)
+@writes
+def increment_cancel_count(cur, user_id):
+    """Учитывает отмену пользователя; при срабатывании правила банит его в той же транзакции.
 
-def update_passenger_eta_message_id(trip_id, message_id):
-    _update_trip_field(trip_id, "passenger_eta_message_id", message_id)
+    Возвращает сработавшее CancelPolicy или None.
+    """
+    POOL.on_rollback(functools.partial(CANCELS.restore, user_id, CANCELS.snapshot(user_id)))
+    recent, policy = CANCELS.record(user_id, timeutil.now_ts())
+    cur.execute(
+        "INSERT INTO user_stats (user_id, recent_cancels) VALUES (?, ?) "
+        "ON CONFLICT(user_id) DO UPDATE SET recent_cancels = excluded.recent_cancels",
+        (user_id, recent))
+    if policy:
+        ban_user(user_id, policy.reason, policy.ban_days)
+    return policy
+
+@reads
+def get_active_drivers_count(cur):
+    return cur.execute("SELECT COUNT(*) FROM users WHERE role = 'driver' AND is_banned = 0").fetchone()[0]
 
-def update_driver_fare_message_id(trip_id, message_id):
-    _update_trip_field(trip_id, "driver_fare_message_id", message_id)
+@reads
+def get_driver_active_orders_count(cur, driver_id):
+    return cur.execute(HOT_QUERIES["get_driver_active_orders_count"][0], (driver_id,)).fetchone()[0]
+
+# === ЖУРНАЛ ИЗМЕНЕНИЙ ПОЕЗДОК ===
+# trip_events пополняют триггеры trips (миграция 9) в той же транзакции, что и
+# само изменение, — какой бы функцией оно ни было сделано. Писатель один, поэтому
+# seq растёт в порядке COMMIT: прочитав события до seq N, читатель уже не увидит
+# новое событие с меньшим seq, и курсора (последнего seq) достаточно для продолжения.
+TRIP_EVENT_COLUMNS = ("seq", "trip_id", "status", "prev_status", "passenger_id", "driver_id", "fare", "ts")
+
+@reads
+def get_trip_changes(cur, after_seq=0, limit=500):
+    """Изменения поездок с seq > after_seq по возрастанию, не больше limit.
+
+    {"events": [dict], "cursor": seq для следующего запроса, "has_more": bool,
+     "reset": bool}. reset — часть событий после after_seq уже удалена
+    (prune_trip_events): клиенту нужно перечитать поездки целиком и продолжить с cursor.
+    """
+    oldest, head = cur.execute("SELECT MIN(seq), MAX(seq) FROM trip_events").fetchone()
+    if limit > 0:
+        rows = cur.execute(f"SELECT {', '.join(TRIP_EVENT_COLUMNS)} FROM trip_events WHERE seq > ? ORDER BY seq LIMIT ?",
+                           (after_seq, limit)).fetchall()
+        cursor = rows[-1][0] if rows else after_seq
+    else:
+        # limit=0 — только текущий курсор: с него начинает клиент, прочитавший поездки целиком
+        rows, cursor = [], max(head or 0, after_seq)
+    return {
+        "events": [dict(zip(TRIP_EVENT_COLUMNS, row)) for row in rows],
+        "cursor": cursor,
+        "has_more": head is not None and cursor < head,
+        "reset": limit > 0 and oldest is not None and after_seq < oldest - 1,
+    }
 
-def update_driver_eta_message_id(trip_id, message_id):
-    _update_trip_field(trip_id, "driver_eta_message_id", message_id)
+@writes
+def prune_trip_events(cur, before_ts, batch=1000):
+    """Удаляет до batch событий старше before_ts (последнее событие остаётся всегда). Возвращает их число."""
+    cur.execute("""
+        DELETE FROM trip_events WHERE seq IN (
+            SELECT seq FROM trip_events WHERE ts < ? AND seq < (SELECT MAX(seq) FROM trip_events)
+            ORDER BY seq LIMIT ?)
+    """, (before_ts, batch))
+    return cur.rowcount
 
-def update_driver_control_message_id(trip_id, message_id):
-    _update_trip_field(trip_id, "driver_control_message_id", message_id)
+# === СООБЩЕНИЯ ПОЕЗДКИ ===
+@writes
+def add_trip_messages(cur, trip_id, messages):
+    """messages — список (chat_id, message_id, kind); одна пачка INSERT на все."""
+    cur.executemany(
+        "INSERT OR IGNORE INTO trip_messages (trip_id, chat_id, message_id, kind) VALUES (?, ?, ?, ?)",
+        [(trip_id, chat_id, message_id, kind) for chat_id, message_id, kind in messages if chat_id and message_id]
+    )
 
-def update_passenger_arrival_message_id(trip_id, message_id):
-    _update_trip_field(trip_id, "passenger_arrival_message_id", message_id)
+def add_trip_message(trip_id, chat_id, message_id, kind):
+    add_trip_messages(trip_id, [(chat_id, message_id, kind)])
 
-def update_driver_tariff_message_id(trip_id, message_id):
-    _update_trip_field(trip_id, "driver_tariff_message_id", message_id)
+@reads
+def get_trip_messages(cur, trip_id):
+    """Все сообщения поездки, сгруппированные по чату: {chat_id: [message_id, ...]}."""
+    grouped = {}
+    for chat_id, message_id in cur.execute(
+            "SELECT chat_id, message_id FROM trip_messages WHERE trip_id = ?", (trip_id,)):
+        grouped.setdefault(chat_id, []).append(message_id)
+    return grouped
 
-def update_driver_eta_select_message_id(trip_id, message_id):
-    _update_trip_field(trip_id, "driver_eta_select_message_id", message_id)
+@writes
+def delete_trip_messages(cur, trip_id):
+    cur.execute("DELETE FROM trip_messages WHERE trip_id = ?", (trip_id,))
 
-def update_confirm_timeout(trip_id, timeout_at):
-    _update_trip_field(trip_id, "confirm_timeout_at", timeout_at)
+@writes
+def update_confirm_timeout(cur, trip_id, timeout_at):
+    """timeout_at — datetime (локальное время) или epoch."""
+    deadline = timeutil.to_ts(timeout_at, local=True)
+    cur.execute("UPDATE trips SET confirm_timeout_at = ?, confirm_timeout_ts = ? WHERE id = ?",
+                (timeutil.to_text(deadline, local=True), deadline, trip_id))
 
-def increment_return_count(trip_id):
-    cur = DB.cursor()
+@writes
+def increment_return_count(cur, trip_id):
     cur.execute("UPDATE trips SET return_count = return_count + 1 WHERE id = ?", (trip_id,))
-    DB.commit()
 
-def get_return_count(trip_id):
-    cur = DB.cursor()
+@reads
+def get_return_count(cur, trip_id):
     res = cur.execute("SELECT return_count FROM trips WHERE id = ?", (trip_id,)).fetchone()
     return res[0] if res else 0
 
-def _update_trip_field(trip_id, field, value):
-    cur = DB.cursor()
+@writes
+def _update_trip_field(cur, trip_id, field, value):
     cur.execute(f"UPDATE trips SET {field} = ? WHERE id = ?", (value, trip_id))
-    DB.commit()
\ No newline at end of file
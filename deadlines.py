@@ -0,0 +1,175 @@
+# deadlines.py
+# Сроки поездок — таймеры в памяти процесса вместо периодического просмотра
+# trips. Срок ставится arm() (заказ создан, водитель принял заказ) и снимается
+# disarm() (заказ принят, цена назначена, поездка отменена или завершена).
+#
+# Сроки лежат в куче heapq; run() спит ровно до ближайшего и, проснувшись,
+# забирает все наступившие сразу: одновременные сроки одного вида уходят в
+# обработчик одним списком, то есть одним запросом к базе. Снятый или
+# переставленный срок из кучи не удаляется — его запись просто пропускается.
+#
+# Таймеры только будят бота: обработчики (expire_trips, release_stalled_trips)
+# сами проверяют в базе, что срок наступил и поездка всё ещё в нужном статусе.
+# Поэтому лишний или запоздавший таймер ничего не портит, а при старте и затем
+# раз в DEADLINE_RESYNC секунд сроки перечитываются из базы — так подхватываются
+# заказы, созданные до перезапуска или другим процессом бота.
+import asyncio
+import heapq
+import os
+import threading
+import time
+
+from querylog import Histogram
+
+ORDER_TIMEOUT = int(os.getenv("ORDER_TIMEOUT", "10"))  # минут на принятие заказа водителем
+# Минут водителю на выбор цены после принятия, иначе заказ вернётся в пул; 0 — без срока
+CONFIRM_TIMEOUT = int(os.getenv("CONFIRM_TIMEOUT", "3"))
+DEADLINE_RESYNC = float(os.getenv("DEADLINE_RESYNC", "300"))  # секунд между сверками с базой; 0 — только при старте
+
+# Виды сроков
+EXPIRE = "expire"  # заказ никто не принял
+CONFIRM = "confirm"  # водитель принял заказ, но не назначил цену
+KINDS = (EXPIRE, CONFIRM)
+
+
+class _KindStats:
+    __slots__ = ("fired", "batches", "lateness")
+
+    def __init__(self):
+        self.fired = 0
+        self.batches = 0
+        self.lateness = Histogram()  # от срока до запуска обработчика, мс
+
+
+class Deadlines:
+    """Куча сроков (epoch) по видам; обработчик вида получает ключи наступивших сроков пачкой."""
+
+    def __init__(self, resync=DEADLINE_RESYNC):
+        self.resync = resync
+        self._heap = []  # (срок, вид, ключ)
+        self._armed = {}  # (вид, ключ) -> срок; запись кучи с другим сроком устарела
+        self._handlers = {}
+        self._stats = {kind: _KindStats() for kind in KINDS}
+        self._lock = threading.Lock()  # arm/disarm вызывает и дашборд из своего потока
+        self._loop = None
+        self._wakeup = None
+        self._tasks = set()
+
+    def on(self, kind, handler):
+        """handler(ключи) — корутина; вызывается для всех сроков вида, наступивших одновременно."""
+        self._handlers[kind] = handler
+
+    def arm(self, kind, key, when):
+        """Ставит (или переставляет) срок вида kind для key на момент when (epoch)."""
+        with self._lock:
+            if self._armed.get((kind, key)) == when:
+                return
+            self._armed[(kind, key)] = when
+            heapq.heappush(self._heap, (when, kind, key))
+            earliest = self._heap[0][0] == when
+            if len(self._heap) > 2 * len(self._armed) + 64:
+                # Устаревших записей больше, чем живых — пересобираем кучу
+                self._heap = [(w, k, x) for (k, x), w in self._armed.items()]
+                heapq.heapify(self._heap)
+        if earliest:
+            self._wake()
+
+    def disarm(self, kind, key):
+        with self._lock:
+            self._armed.pop((kind, key), None)
+
+    def disarm_all(self, key):
+        """Снимает все сроки key (поездка отменена или завершена)."""
+        with self._lock:
+            for kind in KINDS:
+                self._armed.pop((kind, key), None)
+
+    def _wake(self):
+        loop, wakeup = self._loop, self._wakeup
+        if loop is not None and not loop.is_closed():
+            loop.call_soon_threadsafe(wakeup.set)
+
+    def _pop_due(self, now):
+        """Наступившие сроки по видам: {вид: [(ключ, срок)]} и время следующего срока."""
+        due = {}
+        with self._lock:
+            while self._heap and self._heap[0][0] <= now:
+                when, kind, key = heapq.heappop(self._heap)
+                if self._armed.get((kind, key)) != when:
+                    continue
+                del self._armed[(kind, key)]
+                due.setdefault(kind, []).append((key, when))
+            return due, self._heap[0][0] if self._heap else None
+
+    async def run(self, load=None):
+        """Основной цикл. load() — корутина со сроками из базы: [(вид, ключ, срок)]."""
+        self._loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        if load is not None:
+            await self._load(load)
+            if self.resync > 0:
+                self._spawn(self._resync_loop(load))
+        while True:
+            # Сброс до выборки: срок, поставленный во время неё, разбудит снова
+            self._wakeup.clear()
+            now = time.time()
+            due, next_at = self._pop_due(now)
+            for kind, entries in due.items():
+                stats = self._stats[kind]
+                with self._lock:
+                    stats.fired += len(entries)
+                    stats.batches += 1
+                    for _, when in entries:
+                        stats.lateness.add(max(now - when, 0) * 1000)
+                # Обработчик — отдельной задачей: медленный запрос или отправка не задержат другие сроки
+                self._spawn(self._handle(kind, [key for key, _ in entries]))
+            timeout = None if next_at is None else max(next_at - time.time(), 0)
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _handle(self, kind, keys):
+        try:
+            await self._handlers[kind](keys)
+        except Exception as e:
+            print(f"Ошибка обработки сроков {kind} ({len(keys)} шт.): {e}")
+
+    async def _load(self, load):
+        try:
+            entries = await load()
+        except Exception as e:
+            print(f"Ошибка загрузки сроков из базы: {e}")
+            return
+        for kind, key, when in entries:
+            if when is not None:
+                self.arm(kind, key, when)
+
+    async def _resync_loop(self, load):
+        while True:
+            await asyncio.sleep(self.resync)
+            await self._load(load)
+
+    def _spawn(self, coro):
+        task = self._loop.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def stats(self):
+        """По видам: ожидают, сработало, пачек, опоздание срабатывания."""
+        with self._lock:
+            armed = {kind: 0 for kind in KINDS}
+            for kind, _ in self._armed:
+                armed[kind] += 1
+            return {
+                kind: {
+                    "armed": armed[kind],
+                    "fired": s.fired,
+                    "batches": s.batches,
+                    "lateness": s.lateness.as_dict(),
+                }
+                for kind, s in self._stats.items()
+            }
+
+
+DEADLINES = Deadlines()
@@ -0,0 +1,64 @@
+# fanout.py
+# Рассылка нового заказа активным водителям. Предложения уходят параллельно, а
+# лимиты Telegram (общий и на чат, RetryAfter) соблюдает планировщик outbox.py,
+# через который проходит каждый запрос бота; предложения идут классом RIDE.
+#
+# Результат каждой отправки передаётся в on_sent сразу, а не после всей
+# рассылки: бот записывает ID предложения в ACTIVE_ORDER_MESSAGES, и заказ можно
+# принять, пока рассылка ещё идёт. Как только рассылка больше не нужна
+# (is_open() ложно — заказ принят, отменён, просрочен), оставшиеся отправки
+# пропускаются. Время каждой рассылки хранится в FANOUT.history.
+import asyncio
+import os
+import time
+from collections import deque
+
+FANOUT_CONCURRENCY = int(os.getenv("FANOUT_CONCURRENCY", "20"))  # отправок одной рассылки одновременно
+FANOUT_KEEP = int(os.getenv("FANOUT_KEEP", "200"))  # последних рассылок в статистике
+
+
+class FanOut:
+    """Параллельная рассылка с учётом времени доставки."""
+
+    def __init__(self, concurrency=FANOUT_CONCURRENCY, keep=FANOUT_KEEP):
+        self.concurrency = concurrency
+        self.history = deque(maxlen=keep)
+
+    async def run(self, key, chat_ids, send, on_sent, is_open=lambda: True):
+        """Рассылает send(chat_id) по chat_ids, не больше concurrency запросов сразу.
+
+        on_sent(chat_id, результат) — корутина, вызывается сразу после каждой
+        отправки. Возвращает сводку, она же попадает в history.
+        """
+        started = time.perf_counter()
+        stats = {"key": key, "recipients": len(chat_ids), "sent": 0, "failed": 0, "skipped": 0,
+                 "first_seconds": None}
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def deliver(chat_id):
+            async with semaphore:
+                if not is_open():
+                    stats["skipped"] += 1
+                    return
+                try:
+                    result = await send(chat_id)
+                except Exception:
+                    # Саму ошибку уже записал планировщик outbox
+                    stats["failed"] += 1
+                    return
+            stats["sent"] += 1
+            if stats["first_seconds"] is None:
+                stats["first_seconds"] = round(time.perf_counter() - started, 3)
+            await on_sent(chat_id, result)
+
+        await asyncio.gather(*(deliver(chat_id) for chat_id in chat_ids))
+        stats["seconds"] = round(time.perf_counter() - started, 3)
+        stats["finished_at"] = round(time.time(), 3)
+        self.history.append(stats)
+        return stats
+
+    def recent(self, limit=50):
+        return list(self.history)[-limit:][::-1]
+
+
+FANOUT = FanOut()
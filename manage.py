@@ -0,0 +1,193 @@
+# manage.py
+# Служебные команды: python manage.py <команда> [--db taxi.db]
+import argparse
+import os
+import sys
+import tempfile
+from datetime import date, timedelta
+
+import archive
+import conformance
+import db_utils
+import export
+import snapshot
+import storage
+import timeutil
+
+
+def cmd_migrate(args):
+    db_utils.init_db(args.db, migrate=False)
+    pending = db_utils._update_schema(dry_run=args.plan)
+    if not pending:
+        print("Схема актуальна, миграций нет.")
+        return 0
+    print("План миграций:" if args.plan else "Применены миграции:")
+    for version, name, steps in pending:
+        print(f"  {version:03d} {name}")
+        for step in steps:
+            print(f"        {step}")
+    return 0
+
+
+def cmd_check_plans(args):
+    db_utils.init_db(args.db)
+    failed = 0
+    for name, uses_index, plan in db_utils.explain_hot_queries():
+        mark = "OK  " if uses_index else "FAIL"
+        failed += not uses_index
+        print(f"{mark} {name}: {' | '.join(plan)}")
+    return 1 if failed else 0
+
+
+def cmd_rebuild_ratings(args):
+    db_utils.init_db(args.db)
+    drivers = db_utils.rebuild_rating_stats()
+    print(f"Агрегаты рейтинга пересчитаны: {drivers} водителей.")
+    return 0
+
+
+def cmd_verify_stats(args):
+    db_utils.init_db(args.db)
+    diffs = db_utils.verify_user_stats_rollup()
+    for user_id, column, stored, expected in diffs[:50]:
+        print(f"  {user_id}: {column} = {stored}, по пересчёту {expected}")
+    if len(diffs) > 50:
+        print(f"  ... и ещё {len(diffs) - 50}")
+    if not diffs:
+        print("user_stats_rollup совпадает с пересчётом.")
+        return 0
+    if args.fix:
+        users = db_utils.rebuild_user_stats()
+        print(f"Расхождений: {len(diffs)}, таблица пересчитана ({users} пользователей).")
+        return 0
+    print(f"Расхождений: {len(diffs)}. Запустите с --fix, чтобы пересчитать.")
+    return 1
+
+
+def cmd_backfill_revenue(args):
+    db_utils.init_db(args.db)
+    buckets = db_utils.rebuild_revenue()
+    print(f"Выручка пересчитана: {buckets} часовых корзин.")
+    return 0
+
+
+def cmd_backfill_timestamps(args):
+    db_utils.init_db(args.db)
+    def progress(table, rowid):
+        print(f"  {table}: до rowid {rowid}")
+    db_utils.backfill_timestamps(args.batch, args.pause, progress)
+    print("Колонки *_ts заполнены.")
+    return 0
+
+
+def cmd_archive(args):
+    db_utils.init_db(args.db)
+    if args.stats:
+        print(archive.stats())
+        return 0
+    def progress(moved):
+        print(f"  перенесено {moved}")
+    moved = archive.run(args.days, args.batch, args.pause, progress)
+    print(f"В архив перенесено поездок: {moved}. {archive.stats()}")
+    return 0
+
+
+def cmd_export(args):
+    db_utils.init_db(args.db)
+    start = timeutil.to_ts(args.date_from.isoformat()) if args.date_from else None
+    # --to включительно, как в дашборде
+    end = timeutil.to_ts((args.date_to + timedelta(days=1)).isoformat()) if args.date_to else None
+    statuses = args.status.split(",") if args.status else None
+    def progress(total):
+        print(f"  выгружено {total}", file=sys.stderr)
+    total = export.write(args.output, args.table, args.format, args.gzip, start, end, statuses,
+                         args.batch, progress if args.output != "-" else None)
+    print(f"Выгружено строк: {total}.", file=sys.stderr)
+    return 0
+
+
+def cmd_snapshot(args):
+    db_utils.init_db(args.db)
+    taken = snapshot.refresh(args.pages, args.sleep)
+    if taken is None:
+        print("Реплика отключена (SNAPSHOT_PATH=off или база в памяти).")
+        return 1
+    print(f"Снимок {snapshot.snapshot_path()} снят на {timeutil.to_text(taken)} UTC.")
+    return 0
+
+
+def cmd_conformance(args):
+    with tempfile.TemporaryDirectory() as tmp:
+        # SQLite проверяется на временной базе, рабочую не трогаем
+        dsn = os.path.join(tmp, "conformance.db") if args.backend == "sqlite" else args.dsn
+        backend = storage.create_storage(args.backend, dsn).init()
+        try:
+            failed = conformance.run(backend)
+        finally:
+            backend.close()
+    print(f"Проверок не пройдено: {failed}." if failed else "Все проверки пройдены.")
+    return 1 if failed else 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Служебные команды такси-бота")
+    parser.add_argument("--db", default=db_utils.DB_PATH, help="путь к файлу базы")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("migrate", help="применить миграции схемы")
+    p.add_argument("--plan", action="store_true", help="только показать, что будет применено")
+    p.set_defaults(func=cmd_migrate)
+
+    p = sub.add_parser("check-plans", help="проверить EXPLAIN QUERY PLAN горячих запросов")
+    p.set_defaults(func=cmd_check_plans)
+
+    p = sub.add_parser("rebuild-ratings", help="пересчитать driver_rating_stats по таблице ratings")
+    p.set_defaults(func=cmd_rebuild_ratings)
+
+    p = sub.add_parser("verify-stats", help="сверить user_stats_rollup с полным пересчётом по trips")
+    p.add_argument("--fix", action="store_true", help="пересчитать таблицу, если есть расхождения")
+    p.set_defaults(func=cmd_verify_stats)
+
+    p = sub.add_parser("backfill-revenue", help="пересчитать revenue_hourly/revenue_daily по trips")
+    p.set_defaults(func=cmd_backfill_revenue)
+
+    p = sub.add_parser("backfill-timestamps", help="заполнить колонки *_ts по текстовым временам пакетами")
+    p.add_argument("--batch", type=int, default=1000, help="строк в одной транзакции")
+    p.add_argument("--pause", type=float, default=0.0, help="пауза между пакетами, секунд")
+    p.set_defaults(func=cmd_backfill_timestamps)
+
+    p = sub.add_parser("archive", help="перенести старые закрытые поездки в taxi_archive.db")
+    p.add_argument("--days", type=float, default=archive.ARCHIVE_AFTER_DAYS, help="старше скольких дней")
+    p.add_argument("--batch", type=int, default=archive.ARCHIVE_BATCH, help="поездок в одной транзакции")
+    p.add_argument("--pause", type=float, default=0.0, help="пауза между пакетами, секунд")
+    p.add_argument("--stats", action="store_true", help="только показать размер живой таблицы и архива")
+    p.set_defaults(func=cmd_archive)
+
+    p = sub.add_parser("export", help="потоковая выгрузка таблицы в CSV/NDJSON (gzip для *.gz)")
+    p.add_argument("table", choices=sorted(export.TABLES))
+    p.add_argument("-o", "--output", default="-", help="файл выгрузки, '-' — stdout")
+    p.add_argument("--format", choices=export.FORMATS, default="csv")
+    p.add_argument("--gzip", action=argparse.BooleanOptionalAction, default=None,
+                   help="сжимать gzip (по умолчанию — если файл оканчивается на .gz)")
+    p.add_argument("--from", dest="date_from", type=date.fromisoformat, help="с даты YYYY-MM-DD (UTC)")
+    p.add_argument("--to", dest="date_to", type=date.fromisoformat, help="по дату YYYY-MM-DD включительно")
+    p.add_argument("--status", help="статусы поездок через запятую")
+    p.add_argument("--batch", type=int, default=export.EXPORT_BATCH, help="строк в одном чтении")
+    p.set_defaults(func=cmd_export)
+
+    p = sub.add_parser("snapshot", help="обновить реплику для аналитики дашборда (taxi_snapshot.db)")
+    p.add_argument("--pages", type=int, default=snapshot.SNAPSHOT_PAGES, help="страниц за шаг копирования")
+    p.add_argument("--sleep", type=float, default=snapshot.SNAPSHOT_SLEEP, help="пауза между шагами, секунд")
+    p.set_defaults(func=cmd_snapshot)
+
+    p = sub.add_parser("conformance", help="прогнать общие проверки хранилища (только на тестовой базе!)")
+    p.add_argument("--backend", choices=("sqlite", "postgres"), default=storage.DB_BACKEND)
+    p.add_argument("--dsn", default=storage.DATABASE_URL, help="строка подключения PostgreSQL")
+    p.set_defaults(func=cmd_conformance)
+
+    args = parser.parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,432 @@
+# migrations.py
+# Версионные миграции схемы. Базовые таблицы создаёт db_utils._create_tables,
+# всё, что меняется после, оформляется здесь отдельной миграцией с возрастающим
+# номером. Шаг миграции — строка SQL или функция, принимающая курсор.
+# Применённые версии записываются в schema_version, поэтому каждая миграция
+# выполняется ровно один раз.
+import sqlite3
+
+import timeutil
+
+
+def _column_exists(cur, table, column):
+    return any(row[1] == column for row in cur.execute(f"PRAGMA table_info({table})"))
+
+
+def _add_column(table, column, decl):
+    def step(cur):
+        if not _column_exists(cur, table, column):
+            cur.execute(f"ALTER TABLE {table} ADD COLUMN {column} {decl}")
+    step.__doc__ = f"ALTER TABLE {table} ADD COLUMN {column} {decl} -- если колонки нет"
+    return step
+
+
+def _drop_column(table, column):
+    def step(cur):
+        # DROP COLUMN появился в SQLite 3.35; на более старых версиях колонка просто остаётся
+        if sqlite3.sqlite_version_info >= (3, 35, 0) and _column_exists(cur, table, column):
+            cur.execute(f"ALTER TABLE {table} DROP COLUMN {column}")
+    step.__doc__ = f"ALTER TABLE {table} DROP COLUMN {column} -- если колонка есть"
+    return step
+
+
+# Колонки trips с ID сообщений Telegram: колонка -> (колонка с chat_id, kind)
+TRIP_MESSAGE_COLUMNS = {
+    "passenger_message_id": ("passenger_id", "passenger_order"),
+    "driver_message_id": ("driver_id", "driver_order"),
+    "driver_card_message_id": ("passenger_id", "driver_card"),
+    "passenger_fare_message_id": ("passenger_id", "passenger_fare"),
+    "passenger_eta_message_id": ("passenger_id", "passenger_eta"),
+    "driver_fare_message_id": ("driver_id", "driver_fare"),
+    "driver_eta_message_id": ("driver_id", "driver_eta"),
+    "driver_control_message_id": ("driver_id", "driver_control"),
+    "passenger_arrival_message_id": ("passenger_id", "passenger_arrival"),
+    "driver_tariff_message_id": ("driver_id", "driver_tariff"),
+    "driver_eta_select_message_id": ("driver_id", "driver_eta_select"),
+}
+
+
+def _copy_trip_messages(cur):
+    for column, (chat_column, kind) in TRIP_MESSAGE_COLUMNS.items():
+        if not _column_exists(cur, "trips", column):
+            continue
+        cur.execute(f"""
+            INSERT OR IGNORE INTO trip_messages (trip_id, chat_id, message_id, kind)
+            SELECT id, {chat_column}, {column}, ? FROM trips
+            WHERE {column} IS NOT NULL AND {chat_column} IS NOT NULL
+        """, (kind,))
+_copy_trip_messages.__doc__ = "INSERT INTO trip_messages SELECT ... FROM trips -- по одной выборке на каждую *_message_id"
+
+
+# Колонки trips, изменение которых попадает в журнал trip_events
+TRIP_EVENT_SOURCE_COLUMNS = ("status", "driver_id", "fare")
+
+
+def _trip_event_insert(prev_status):
+    return f"""
+    INSERT INTO trip_events (trip_id, status, prev_status, passenger_id, driver_id, fare, ts)
+    VALUES (NEW.id, NEW.status, {prev_status}, NEW.passenger_id, NEW.driver_id, NEW.fare, CAST(strftime('%s', 'now') AS INTEGER));"""
+
+
+def rebuild_driver_rating_stats(cur):
+    cur.execute("DELETE FROM driver_rating_stats")
+    cur.execute("""
+        INSERT INTO driver_rating_stats (driver_id, rating_sum, rating_count, r1, r2, r3, r4, r5)
+        SELECT driver_id, SUM(rating), COUNT(*),
+               SUM(rating = 1), SUM(rating = 2), SUM(rating = 3), SUM(rating = 4), SUM(rating = 5)
+        FROM ratings
+        WHERE driver_id IS NOT NULL AND rating IS NOT NULL
+        GROUP BY driver_id
+    """)
+    return cur.execute("SELECT COUNT(*) FROM driver_rating_stats").fetchone()[0]
+rebuild_driver_rating_stats.__doc__ = "INSERT INTO driver_rating_stats SELECT ... FROM ratings GROUP BY driver_id"
+
+
+CANCELLED_STATUSES = "('cancelled', 'cancelled_by_passenger', 'cancelled_by_driver', 'expired')"
+
+# Колонки user_stats_rollup, которые складываются из поездок, в порядке rollup_recompute_sql()
+ROLLUP_COLUMNS = (
+    "passenger_trips", "passenger_completed", "passenger_cancelled", "passenger_spent",
+    "driver_trips", "driver_completed", "driver_cancelled", "driver_earnings",
+)
+
+
+def _rollup_upsert(row, side, sign):
+    """Прибавить (sign=1) или вычесть (sign=-1) вклад поездки row в счётчики side."""
+    money = "spent" if side == "passenger" else "earnings"
+    cols = [f"{side}_trips", f"{side}_completed", f"{side}_cancelled", f"{side}_{money}"]
+    return f"""
+        INSERT INTO user_stats_rollup (user_id, {', '.join(cols)})
+        SELECT {row}.{side}_id, {sign}, {sign} * ({row}.status = 'completed'),
+               {sign} * ({row}.status IN {CANCELLED_STATUSES}),
+               {sign} * (CASE WHEN {row}.status = 'completed' THEN COALESCE({row}.fare, 0) ELSE 0 END)
+        WHERE {row}.{side}_id IS NOT NULL
+        ON CONFLICT(user_id) DO UPDATE SET
+            {', '.join(f"{c} = {c} + excluded.{c}" for c in cols)};"""
+
+
+def rollup_recompute_sql(source="trips"):
+    """Полный пересчёт: (user_id, *ROLLUP_COLUMNS) по source — таблице или подзапросу поездок."""
+    return f"""
+    SELECT user_id, SUM(pt), SUM(pc), SUM(pcan), SUM(ps), SUM(dt), SUM(dc), SUM(dcan), SUM(de)
+    FROM (
+        SELECT passenger_id AS user_id, 1 AS pt, status = 'completed' AS pc,
+               status IN {CANCELLED_STATUSES} AS pcan,
+               CASE WHEN status = 'completed' THEN COALESCE(fare, 0) ELSE 0 END AS ps,
+               0 AS dt, 0 AS dc, 0 AS dcan, 0 AS de
+        FROM {source} WHERE passenger_id IS NOT NULL
+        UNION ALL
+        SELECT driver_id, 0, 0, 0, 0, 1, status = 'completed', status IN {CANCELLED_STATUSES},
+               CASE WHEN status = 'completed' THEN COALESCE(fare, 0) ELSE 0 END
+        FROM {source} WHERE driver_id IS NOT NULL
+    )
+    GROUP BY user_id
+"""
+
+
+def rebuild_user_stats_rollup(cur, source="trips"):
+    cur.execute("DELETE FROM user_stats_rollup")
+    cur.execute(f"INSERT INTO user_stats_rollup (user_id, {', '.join(ROLLUP_COLUMNS)}) {rollup_recompute_sql(source)}")
+    return cur.execute("SELECT COUNT(*) FROM user_stats_rollup").fetchone()[0]
+rebuild_user_stats_rollup.__doc__ = "INSERT INTO user_stats_rollup SELECT ... FROM trips GROUP BY user_id"
+
+
+# Корзины выручки: таблица -> формат strftime ключа (UTC)
+REVENUE_BUCKETS = {
+    "revenue_hourly": "%Y-%m-%d %H:00",
+    "revenue_daily": "%Y-%m-%d",
+}
+
+
+def _revenue_key(fmt, prefix="", by_ts=True):
+    # С миграции 12 корзина считается по created_ts, как диапазоны get_revenue;
+    # строки, которым backfill ещё не заполнил created_ts, — по created_at
+    if not by_ts:
+        return f"strftime('{fmt}', {prefix}created_at)"
+    return f"strftime('{fmt}', COALESCE({prefix}created_ts, {timeutil.sql_to_ts(prefix + 'created_at')}), 'unixepoch')"
+
+
+def _revenue_upsert(table, row, sign, by_ts=True):
+    return f"""
+        INSERT INTO {table} (bucket, orders, revenue)
+        SELECT {_revenue_key(REVENUE_BUCKETS[table], row + ".", by_ts)}, {sign}, {sign} * COALESCE({row}.fare, 0)
+        WHERE {row}.status = 'completed'
+        ON CONFLICT(bucket) DO UPDATE SET
+            orders = orders + excluded.orders, revenue = revenue + excluded.revenue;"""
+
+
+def _revenue_trigger(by_ts=True):
+    # Завершение поездки (complete_trip) кладёт её в корзины; если у завершённой
+    # поездки потом меняется цена, статус или время создания, старый вклад вычитается
+    columns = ("status", "fare", "created_at") + (("created_ts",) if by_ts else ())
+    return (
+        f"CREATE TRIGGER IF NOT EXISTS trg_trips_revenue_update AFTER UPDATE OF {', '.join(columns)} ON trips "
+        "WHEN (OLD.status = 'completed' OR NEW.status = 'completed') AND ("
+        + " OR ".join(f"OLD.{c} IS NOT NEW.{c}" for c in columns) + ") BEGIN"
+        + _revenue_upsert("revenue_hourly", "OLD", -1, by_ts) + _revenue_upsert("revenue_daily", "OLD", -1, by_ts)
+        + _revenue_upsert("revenue_hourly", "NEW", 1, by_ts) + _revenue_upsert("revenue_daily", "NEW", 1, by_ts)
+        + "\nEND")
+
+
+def rebuild_revenue_rollups(cur, source="trips", by_ts=True):
+    for table, fmt in REVENUE_BUCKETS.items():
+        cur.execute(f"DELETE FROM {table}")
+        cur.execute(f"""
+            INSERT INTO {table} (bucket, orders, revenue)
+            SELECT {_revenue_key(fmt, by_ts=by_ts)}, COUNT(*), COALESCE(SUM(fare), 0)
+            FROM {source} WHERE status = 'completed'
+            GROUP BY 1
+        """)
+    return cur.execute("SELECT COUNT(*) FROM revenue_hourly").fetchone()[0]
+rebuild_revenue_rollups.__doc__ = "INSERT INTO revenue_hourly/revenue_daily SELECT ... FROM trips WHERE status = 'completed' GROUP BY корзина"
+
+
+def _rebuild_revenue_by_text(cur):
+    # Миграция 6 выполняется до появления created_ts (миграция 8)
+    return rebuild_revenue_rollups(cur, by_ts=False)
+_rebuild_revenue_by_text.__doc__ = rebuild_revenue_rollups.__doc__ + " -- по created_at"
+
+
+# Текстовые времена и их целочисленные пары: таблица -> [(текст, *_ts, текст в локальном времени)]
+TIMESTAMP_COLUMNS = {
+    "trips": [
+        ("created_at", "created_ts", False),
+        ("accepted_at", "accepted_ts", False),
+        ("arrived_at", "arrived_ts", False),
+        ("completed_at", "completed_ts", False),
+        ("confirm_timeout_at", "confirm_timeout_ts", True),
+    ],
+    "bans": [
+        ("banned_until", "banned_until_ts", True),
+        ("banned_at", "banned_at_ts", False),
+    ],
+    "users": [("registration_date", "registration_ts", False)],
+    "ratings": [("created_at", "created_ts", False)],
+}
+
+
+def convert_timestamps(cur, table, where="1", params=()):
+    """Заполняет пустые *_ts таблицы по текстовым колонкам для строк, подходящих под where."""
+    sets = ", ".join(
+        f"{ts} = COALESCE({ts}, {timeutil.sql_to_ts(text, local)})"
+        for text, ts, local in TIMESTAMP_COLUMNS[table])
+    cur.execute(f"UPDATE {table} SET {sets} WHERE {where}", params)
+    return cur.rowcount
+
+
+def unconverted(table):
+    """Условие на строки таблицы, у которых есть текстовое время без *_ts."""
+    return " OR ".join(f"({ts} IS NULL AND {text} IS NOT NULL)" for text, ts, _ in TIMESTAMP_COLUMNS[table])
+
+
+def convert_timestamps_batch(cur, table, after_rowid, batch):
+    """Один пакет онлайн-конвертации по rowid. Возвращает последний rowid пакета или None.
+
+    Пакет набирается только из ещё не сконвертированных строк, поэтому повторный
+    проход по уже заполненной таблице ничего не пишет.
+    """
+    pending = unconverted(table)
+    last = cur.execute(
+        f"SELECT MAX(rowid) FROM (SELECT rowid FROM {table} WHERE rowid > ? AND ({pending}) ORDER BY rowid LIMIT ?)",
+        (after_rowid, batch)).fetchone()[0]
+    if last is not None:
+        convert_timestamps(cur, table, f"rowid > ? AND rowid <= ? AND ({pending})", (after_rowid, last))
+    return last
+
+
+def _convert_hot_timestamps(cur):
+    # Сразу — только то, что нужно горячим запросам: баны и незавершённые поездки.
+    # Историю бот дозаполняет при старте фоновой задачей (db_utils.backfill_timestamps)
+    # пакетами, не блокируя записи; вручную — `manage.py backfill-timestamps`
+    convert_timestamps(cur, "bans")
+    convert_timestamps(cur, "trips", "status IN ('requested', 'accepted', 'in_progress')")
+_convert_hot_timestamps.__doc__ = "UPDATE bans/trips SET *_ts = strftime('%s', ...) -- баны и незавершённые поездки"
+
+
+# (версия, описание, шаги) — строго по возрастанию версии
+MIGRATIONS = [
+    (1, "Поля, которые раньше добавлял _update_schema", [
+        _add_column("trips", "confirm_timeout_at", "TEXT"),
+        _add_column("trips", "return_count", "INTEGER DEFAULT 0"),
+        _add_column("users", "is_banned", "INTEGER DEFAULT 0"),
+    ]),
+    (2, "Индексы горячих запросов", [
+        "CREATE INDEX IF NOT EXISTS idx_trips_status_created ON trips(status, created_at)",
+        "CREATE INDEX IF NOT EXISTS idx_trips_driver_status ON trips(driver_id, status)",
+        "CREATE INDEX IF NOT EXISTS idx_trips_passenger_status ON trips(passenger_id, status)",
+        "CREATE INDEX IF NOT EXISTS idx_ratings_driver ON ratings(driver_id)",
+        "CREATE INDEX IF NOT EXISTS idx_bans_user ON bans(user_id)",
+    ]),
+    (3, "ID сообщений поездки в отдельной таблице trip_messages", [
+        '''CREATE TABLE IF NOT EXISTS trip_messages (
+            trip_id INTEGER NOT NULL,
+            chat_id INTEGER NOT NULL,
+            message_id INTEGER NOT NULL,
+            kind TEXT NOT NULL,
+            PRIMARY KEY (trip_id, chat_id, message_id)
+        ) WITHOUT ROWID''',
+        _copy_trip_messages,
+    ] + [_drop_column("trips", column) for column in TRIP_MESSAGE_COLUMNS]),
+    (4, "Агрегаты рейтинга водителей", [
+        '''CREATE TABLE IF NOT EXISTS driver_rating_stats (
+            driver_id INTEGER PRIMARY KEY,
+            rating_sum INTEGER NOT NULL DEFAULT 0,
+            rating_count INTEGER NOT NULL DEFAULT 0,
+            r1 INTEGER NOT NULL DEFAULT 0,
+            r2 INTEGER NOT NULL DEFAULT 0,
+            r3 INTEGER NOT NULL DEFAULT 0,
+            r4 INTEGER NOT NULL DEFAULT 0,
+            r5 INTEGER NOT NULL DEFAULT 0
+        )''',
+        rebuild_driver_rating_stats,
+    ]),
+    (5, "Сводная статистика пользователей user_stats_rollup", [
+        '''CREATE TABLE IF NOT EXISTS user_stats_rollup (
+            user_id INTEGER PRIMARY KEY,
+            passenger_trips INTEGER NOT NULL DEFAULT 0,
+            passenger_completed INTEGER NOT NULL DEFAULT 0,
+            passenger_cancelled INTEGER NOT NULL DEFAULT 0,
+            passenger_spent REAL NOT NULL DEFAULT 0,
+            driver_trips INTEGER NOT NULL DEFAULT 0,
+            driver_completed INTEGER NOT NULL DEFAULT 0,
+            driver_cancelled INTEGER NOT NULL DEFAULT 0,
+            driver_earnings REAL NOT NULL DEFAULT 0
+        )''',
+        # Счётчики ведут триггеры: любой переход поездки (создание, принятие,
+        # завершение, отмена, истечение, смена цены) обновляет их в той же транзакции
+        "CREATE TRIGGER IF NOT EXISTS trg_trips_rollup_insert AFTER INSERT ON trips BEGIN"
+        + _rollup_upsert("NEW", "passenger", 1) + _rollup_upsert("NEW", "driver", 1) + "\nEND",
+        "CREATE TRIGGER IF NOT EXISTS trg_trips_rollup_update AFTER UPDATE OF passenger_id, driver_id, status, fare ON trips "
+        "WHEN OLD.passenger_id IS NOT NEW.passenger_id OR OLD.driver_id IS NOT NEW.driver_id "
+        "OR OLD.status IS NOT NEW.status OR OLD.fare IS NOT NEW.fare BEGIN"
+        + _rollup_upsert("OLD", "passenger", -1) + _rollup_upsert("OLD", "driver", -1)
+        + _rollup_upsert("NEW", "passenger", 1) + _rollup_upsert("NEW", "driver", 1) + "\nEND",
+        rebuild_user_stats_rollup,
+    ]),
+    (6, "Выручка по часам и дням", [
+        "CREATE TABLE IF NOT EXISTS revenue_hourly (bucket TEXT PRIMARY KEY, orders INTEGER NOT NULL DEFAULT 0, "
+        "revenue REAL NOT NULL DEFAULT 0) WITHOUT ROWID",
+        "CREATE TABLE IF NOT EXISTS revenue_daily (bucket TEXT PRIMARY KEY, orders INTEGER NOT NULL DEFAULT 0, "
+        "revenue REAL NOT NULL DEFAULT 0) WITHOUT ROWID",
+        _revenue_trigger(by_ts=False),
+        _rebuild_revenue_by_text,
+    ]),
+    (7, "Кольцо последних отмен пользователя", [
+        # Времена отмен (epoch, через запятую) в скользящем окне; cancel_count_24h
+        # и last_cancel_reset больше не используются
+        _add_column("user_stats", "recent_cancels", "TEXT"),
+    ]),
+    (8, "Время в целочисленных колонках *_ts", [
+        _add_column(table, ts, "INTEGER")
+        for table, columns in TIMESTAMP_COLUMNS.items() for _, ts, _ in columns
+    ] + [
+        "CREATE INDEX IF NOT EXISTS idx_trips_status_created_ts ON trips(status, created_ts)",
+        "DROP INDEX IF EXISTS idx_trips_status_created",
+        _convert_hot_timestamps,
+    ]),
+    (9, "Журнал изменений поездок trip_events", [
+        # Только дописывается; seq — курсор для выборки изменений (db_utils.get_trip_changes)
+        '''CREATE TABLE IF NOT EXISTS trip_events (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            trip_id INTEGER NOT NULL,
+            status TEXT,
+            prev_status TEXT,
+            passenger_id INTEGER,
+            driver_id INTEGER,
+            fare REAL,
+            ts INTEGER NOT NULL
+        )''',
+        # Событие пишет триггер — в той же транзакции, что и изменение поездки
+        "CREATE TRIGGER IF NOT EXISTS trg_trips_events_insert AFTER INSERT ON trips BEGIN"
+        + _trip_event_insert("NULL") + "\nEND",
+        f"CREATE TRIGGER IF NOT EXISTS trg_trips_events_update AFTER UPDATE OF {', '.join(TRIP_EVENT_SOURCE_COLUMNS)} "
+        "ON trips WHEN " + " OR ".join(f"OLD.{c} IS NOT NEW.{c}" for c in TRIP_EVENT_SOURCE_COLUMNS) + " BEGIN"
+        + _trip_event_insert("OLD.status") + "\nEND",
+    ]),
+    (10, "Задания рассылок broadcast_jobs", [
+        # cursor — ключ последнего получателя, которому отправка уже начата;
+        # last_user_id — последний ключ аудитории на момент создания (зарегистрированные позже не получат)
+        '''CREATE TABLE IF NOT EXISTS broadcast_jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            audience TEXT NOT NULL,
+            message_text TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'queued' CHECK(status IN ('queued', 'running', 'done', 'cancelled')),
+            cursor INTEGER NOT NULL DEFAULT 0,
+            last_user_id INTEGER NOT NULL DEFAULT 0,
+            total INTEGER NOT NULL DEFAULT 0,
+            sent INTEGER NOT NULL DEFAULT 0,
+            failed INTEGER NOT NULL DEFAULT 0,
+            lost INTEGER NOT NULL DEFAULT 0,
+            created_ts INTEGER,
+            started_ts INTEGER,
+            finished_ts INTEGER
+        )''',
+        "CREATE INDEX IF NOT EXISTS idx_broadcast_jobs_status ON broadcast_jobs(status)",
+        # Получатели взятой страницы, результат отправки которым ещё не записан
+        "CREATE TABLE IF NOT EXISTS broadcast_inflight (job_id INTEGER NOT NULL, user_id INTEGER NOT NULL, "
+        "PRIMARY KEY (job_id, user_id)) WITHOUT ROWID",
+    ]),
+    (11, "Индексы сегментов рассылок", [
+        # segments.py: роль — для подсчёта размера, пары (пользователь, время) — для
+        # проверки «были поездки с ...» по ключу, created_ts — для подсчёта от свежих поездок
+        "CREATE INDEX IF NOT EXISTS idx_users_role_banned ON users(role, is_banned)",
+        "CREATE INDEX IF NOT EXISTS idx_trips_passenger_created_ts ON trips(passenger_id, created_ts)",
+        "CREATE INDEX IF NOT EXISTS idx_trips_driver_created_ts ON trips(driver_id, created_ts)",
+        "CREATE INDEX IF NOT EXISTS idx_trips_created_ts ON trips(created_ts)",
+    ]),
+    (12, "Корзины выручки по created_ts", [
+        "DROP TRIGGER IF EXISTS trg_trips_revenue_update",
+        _revenue_trigger(),
+        rebuild_revenue_rollups,
+    ]),
+]
+
+
+def _ensure_version_table(cur):
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
+            name TEXT NOT NULL,
+            applied_at TEXT DEFAULT (datetime('now'))
+        )
+    ''')
+
+
+def current_version(cur):
+    exists = cur.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'schema_version'"
+    ).fetchone()
+    if not exists:
+        return 0
+    return cur.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version").fetchone()[0]
+
+
+def plan(cur):
+    """Миграции, которые ещё не применены: [(версия, описание, [описание шагов])]."""
+    version = current_version(cur)
+    return [
+        (v, name, [step if isinstance(step, str) else step.__doc__ for step in steps])
+        for v, name, steps in MIGRATIONS if v > version
+    ]
+
+
+def migrate(cur, dry_run=False):
+    """Применяет недостающие миграции в текущей транзакции курсора.
+
+    С dry_run=True ничего не меняет и возвращает тот же список, что и plan().
+    """
+    pending = plan(cur)
+    if dry_run or not pending:
+        return pending
+    _ensure_version_table(cur)
+    todo = {v for v, _, _ in pending}
+    for version, name, steps in MIGRATIONS:
+        if version not in todo:
+            continue
+        for step in steps:
+            if isinstance(step, str):
+                cur.execute(step)
+            else:
+                step(cur)
+        cur.execute("INSERT INTO schema_version (version, name) VALUES (?, ?)", (version, name))
+    return pending
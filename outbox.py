@@ -0,0 +1,294 @@
+# outbox.py
+# Единый планировщик исходящих запросов к Telegram. Он подключён к сессии бота
+# как request-middleware aiogram, поэтому через него проходит любой вызов API
+# с chat_id — send_message, edit_message_text, delete_message, message.answer
+# и т. д.; обработчикам ничего менять не нужно. Запросы без чата (например,
+# answer_callback_query) идут напрямую.
+#
+# Класс приоритета берётся из контекста вызова: по умолчанию RIDE, рассылки
+# оборачиваются в priority(BULK), второстепенные уведомления — в priority(NOTICE).
+# - Диспетчер всегда берёт следующий запрос из самого приоритетного класса, где
+#   есть готовый, так что поездка обгоняет любую очередь рассылки; BULK к тому
+#   же занимает не больше половины одновременных запросов.
+# - В один чат одновременно идёт не больше одного запроса; внутри класса
+#   порядок запросов чата сохраняется (правка не обгонит отправку сообщения).
+# - Общий токен-бакет OUTBOX_RATE запросов в секунду и OUTBOX_CHAT_RATE на чат
+#   (с запасом OUTBOX_CHAT_BURST).
+# - RetryAfter (429): общий бакет пуст столько, сколько попросил Telegram, а
+#   запрос встаёт первым в очередь своего чата и повторяется.
+# - Ошибки API не глотаются молча: каждая пишется в лог и в счётчики класса,
+#   а затем передаётся вызывающему, как и без планировщика.
+# Метрики по классам — stats(), в дашборде /api/admin/outbox_stats.
+import asyncio
+import contextvars
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramRetryAfter
+
+from querylog import Histogram
+
+OUTBOX_RATE = float(os.getenv("OUTBOX_RATE", "25"))  # запросов в секунду на бота (лимит Telegram ~30); 0 — без лимита
+OUTBOX_CHAT_RATE = float(os.getenv("OUTBOX_CHAT_RATE", "1"))  # запросов в секунду в один чат; 0 — без лимита
+OUTBOX_CHAT_BURST = int(os.getenv("OUTBOX_CHAT_BURST", "5"))  # запас чата: ответ в диалоге — несколько запросов подряд
+OUTBOX_CONCURRENCY = int(os.getenv("OUTBOX_CONCURRENCY", "16"))  # запросов к API одновременно
+OUTBOX_RETRIES = int(os.getenv("OUTBOX_RETRIES", "3"))  # повторов после RetryAfter
+
+# Классы в порядке приоритета
+RIDE = "ride"  # поездка: предложения, карточка водителя, прибытие, отмены; и ответы в диалоге
+NOTICE = "notice"  # уведомления, которые могут подождать: оценка, бан
+BULK = "bulk"  # рассылки
+CLASSES = (RIDE, NOTICE, BULK)
+
+_PRIORITY = contextvars.ContextVar("outbox_priority", default=RIDE)
+
+# Бакеты чатов, не использованные дольше этого (секунд), выбрасываются
+_CHAT_BUCKET_IDLE = 60
+_CHAT_BUCKETS_MAX = 10000
+
+
+@contextmanager
+def priority(name):
+    """Запросы к Telegram внутри блока (и в созданных в нём задачах) идут с классом name."""
+    token = _PRIORITY.set(name)
+    try:
+        yield
+    finally:
+        _PRIORITY.reset(token)
+
+
+class TokenBucket:
+    """Токен-бакет: rate токенов в секунду, запас до burst."""
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.capacity = burst if burst is not None else max(rate, 1)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self):
+        """Через сколько секунд появится токен (0 — уже есть)."""
+        if self.rate <= 0:
+            return 0
+        self._refill()
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        if self.rate > 0:
+            self.tokens -= 1
+
+    def penalize(self, seconds):
+        """Ни одного токена ближайшие seconds секунд (ответ RetryAfter)."""
+        if self.rate <= 0:
+            return
+        self._refill()
+        self.tokens = min(self.tokens, 0) - seconds * self.rate
+
+
+class _Request:
+    __slots__ = ("chat_id", "call", "method", "priority", "future", "queued_at", "attempts")
+
+    def __init__(self, chat_id, call, method, priority, future):
+        self.chat_id = chat_id
+        self.call = call
+        self.method = method
+        self.priority = priority
+        self.future = future
+        self.queued_at = time.perf_counter()
+        self.attempts = 0
+
+
+class _ClassStats:
+    __slots__ = ("queued", "sent", "failed", "retried", "latency")
+
+    def __init__(self):
+        self.queued = 0  # ждут отправки
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+        self.latency = Histogram()  # от постановки в очередь до ответа Telegram, мс
+
+
+class Outbox:
+    """Очереди исходящих запросов по классам и диспетчер, который их отправляет."""
+
+    def __init__(self, rate=OUTBOX_RATE, chat_rate=OUTBOX_CHAT_RATE, chat_burst=OUTBOX_CHAT_BURST,
+                 concurrency=OUTBOX_CONCURRENCY, retries=OUTBOX_RETRIES):
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.concurrency = concurrency
+        self.retries = retries
+        self._global = TokenBucket(rate)
+        self._chat_buckets = {}
+        # класс -> {chat_id: deque запросов}; порядок чатов — порядок поступления
+        self._pending = {name: OrderedDict() for name in CLASSES}
+        self._busy = set()  # чаты с запросом в полёте
+        self._inflight = {name: 0 for name in CLASSES}
+        self._stats = {name: _ClassStats() for name in CLASSES}
+        self._lock = threading.Lock()  # статистику читает дашборд из своего потока
+        self._loop = None
+        self._wakeup = None
+        self._task = None
+
+    async def submit(self, chat_id, call, method="request", priority=None):
+        """Ставит call() в очередь чата и ждёт результат (или исключение) запроса."""
+        self._ensure_running()
+        name = priority or _PRIORITY.get()
+        request = _Request(chat_id, call, method, name, self._loop.create_future())
+        self._pending[name].setdefault(chat_id, deque()).append(request)
+        with self._lock:
+            self._stats[name].queued += 1
+        self._wakeup.set()
+        return await request.future
+
+    def _ensure_running(self):
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop or self._task is None or self._task.done():
+            self._loop = loop
+            self._wakeup = asyncio.Event()
+            self._busy.clear()
+            self._inflight = {name: 0 for name in CLASSES}
+            self._task = loop.create_task(self._dispatch())
+
+    def _chat_bucket(self, chat_id):
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self._chat_buckets) >= _CHAT_BUCKETS_MAX:
+                idle = time.monotonic() - _CHAT_BUCKET_IDLE
+                self._chat_buckets = {k: b for k, b in self._chat_buckets.items() if b.updated > idle}
+            bucket = self._chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    def _next(self):
+        """Следующий запрос к отправке или (None, через сколько секунд проверить снова)."""
+        if sum(self._inflight.values()) >= self.concurrency:
+            return None, None
+        retry_in = None
+        for name in CLASSES:
+            if name == BULK and self._inflight[BULK] >= max(self.concurrency // 2, 1):
+                continue
+            queues = self._pending[name]
+            for chat_id, queue in queues.items():
+                if chat_id in self._busy:
+                    continue
+                wait = self._chat_bucket(chat_id).wait_time()
+                if wait:
+                    retry_in = wait if retry_in is None else min(retry_in, wait)
+                    continue
+                request = queue.popleft()
+                if not queue:
+                    del queues[chat_id]
+                return request, None
+        return None, retry_in
+
+    async def _dispatch(self):
+        while True:
+            # Сначала токен общего бакета, потом выбор запроса: всё, что пришло,
+            # пока ждали токен, участвует в выборе, и поездка обгоняет рассылку
+            wait = self._global.wait_time()
+            if wait:
+                await asyncio.sleep(wait)
+                continue
+            request, retry_in = self._next()
+            if request is None:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), retry_in)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            self._global.take()
+            self._chat_bucket(request.chat_id).take()
+            self._busy.add(request.chat_id)
+            self._inflight[request.priority] += 1
+            with self._lock:
+                self._stats[request.priority].queued -= 1
+            self._loop.create_task(self._send(request))
+
+    async def _send(self, request):
+        name = request.priority
+        stats = self._stats[name]
+        try:
+            request.attempts += 1
+            result = await request.call()
+        except TelegramRetryAfter as e:
+            if request.attempts <= self.retries:
+                # Превышен лимит бота: притормаживаем все запросы, этот повторим первым в своём чате
+                self._global.penalize(e.retry_after)
+                self._pending[name].setdefault(request.chat_id, deque()).appendleft(request)
+                self._pending[name].move_to_end(request.chat_id, last=False)
+                with self._lock:
+                    stats.queued += 1
+                    stats.retried += 1
+                print(f"Telegram просит подождать {e.retry_after} с ({name}, {request.method} в {request.chat_id})")
+                return
+            self._finish(request, stats, error=e)
+        except Exception as e:
+            self._finish(request, stats, error=e)
+        else:
+            self._finish(request, stats, result=result)
+        finally:
+            self._busy.discard(request.chat_id)
+            self._inflight[name] -= 1
+            self._wakeup.set()
+
+    def _finish(self, request, stats, result=None, error=None):
+        with self._lock:
+            stats.latency.add((time.perf_counter() - request.queued_at) * 1000)
+            if error is None:
+                stats.sent += 1
+            else:
+                stats.failed += 1
+        if error is not None:
+            print(f"Ошибка Telegram ({request.priority}, {request.method} в {request.chat_id}): {error}")
+        if request.future.done():
+            return
+        if error is None:
+            request.future.set_result(result)
+        else:
+            request.future.set_exception(error)
+
+    def stats(self):
+        """По каждому классу: глубина очереди, в полёте, отправлено, ошибок, повторов, задержка."""
+        with self._lock:
+            return {
+                name: {
+                    "queued": s.queued,
+                    "in_flight": self._inflight.get(name, 0),
+                    "sent": s.sent,
+                    "failed": s.failed,
+                    "retried": s.retried,
+                    "latency": s.latency.as_dict(),
+                }
+                for name, s in self._stats.items()
+            }
+
+
+class OutboxMiddleware(BaseRequestMiddleware):
+    """Пропускает запросы бота с chat_id через Outbox."""
+
+    def __init__(self, outbox):
+        self.outbox = outbox
+
+    async def __call__(self, make_request, bot, method):
+        chat_id = getattr(method, "chat_id", None)
+        if chat_id is None:
+            return await make_request(bot, method)
+        return await self.outbox.submit(chat_id, lambda: make_request(bot, method), type(method).__name__)
+
+
+OUTBOX = Outbox()
+
+
+def install(bot):
+    """Подключает планировщик к сессии бота."""
+    bot.session.middleware(OutboxMiddleware(OUTBOX))
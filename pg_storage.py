@@ -0,0 +1,534 @@
+# pg_storage.py
+# Хранилище на PostgreSQL для запуска нескольких процессов бота на общей базе.
+# Нужны psycopg 3 и psycopg_pool: pip install "psycopg[binary]" psycopg_pool
+#
+# Отличия от SQLite-версии:
+# - один писатель не нужен: каждая операция — своя транзакция на соединении
+#   из пула, конкуренцию разруливают блокировки строк;
+# - заказ забирается UPDATE ... WHERE id = (SELECT ... FOR UPDATE SKIP LOCKED),
+#   так что из нескольких водителей и процессов побеждает ровно один, а
+#   остальные не ждут чужую транзакцию;
+# - кэшей в памяти процесса нет (роль, баны, кольцо отмен): их видят все
+#   процессы сразу. Бан проверяется по banned_until_ts, фоновое снятие не нужно;
+# - iter_trips читает именованным (серверным) курсором порциями по itersize;
+# - seq журнала trip_events выдаётся под advisory-блокировкой до COMMIT, иначе
+#   параллельные транзакции фиксировались бы не в порядке seq и курсор
+#   get_trip_changes мог бы перескочить ещё не видимое событие.
+#
+# Схема создаётся сразу в актуальном виде; migrations.py — история SQLite-базы.
+import os
+from contextlib import contextmanager
+
+try:
+    import psycopg
+    from psycopg.rows import kwargs_row
+    from psycopg_pool import ConnectionPool
+except ImportError:  # нужен только при DB_BACKEND=postgres
+    psycopg = None
+
+import db_utils
+import timeutil
+import trip_states
+from db_utils import Trip, UserContext
+from storage import Storage
+
+PG_POOL_MIN = int(os.getenv("PG_POOL_MIN", "1"))
+PG_POOL_MAX = int(os.getenv("PG_POOL_MAX", "10"))
+PG_ITERSIZE = int(os.getenv("PG_ITERSIZE", "1000"))
+
+SCHEMA = [
+    '''CREATE TABLE IF NOT EXISTS users (
+        telegram_id BIGINT PRIMARY KEY,
+        username TEXT,
+        first_name TEXT,
+        role TEXT DEFAULT 'passenger' CHECK(role IN ('passenger', 'driver')),
+        is_banned INTEGER DEFAULT 0,
+        full_name TEXT,
+        car_brand TEXT,
+        car_model TEXT,
+        license_plate TEXT,
+        car_color TEXT,
+        phone_number TEXT,
+        payment_number TEXT,
+        bank_name TEXT,
+        registration_date TEXT,
+        registration_ts BIGINT
+    )''',
+    '''CREATE TABLE IF NOT EXISTS tariffs (
+        id BIGINT GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+        name TEXT UNIQUE NOT NULL,
+        price DOUBLE PRECISION NOT NULL
+    )''',
+    '''CREATE TABLE IF NOT EXISTS eta_options (
+        id BIGINT GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+        text TEXT NOT NULL,
+        minutes INTEGER NOT NULL
+    )''',
+    '''CREATE TABLE IF NOT EXISTS trips (
+        id BIGINT GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+        passenger_id BIGINT,
+        driver_id BIGINT,
+        status TEXT NOT NULL DEFAULT 'requested',
+        pickup TEXT,
+        destination TEXT,
+        fare DOUBLE PRECISION,
+        created_at TEXT,
+        accepted_at TEXT,
+        arrived_at TEXT,
+        completed_at TEXT,
+        cancellation_reason TEXT,
+        confirm_timeout_at TEXT,
+        return_count INTEGER NOT NULL DEFAULT 0,
+        created_ts BIGINT,
+        accepted_ts BIGINT,
+        arrived_ts BIGINT,
+        completed_ts BIGINT,
+        confirm_timeout_ts BIGINT
+    )''',
+    "CREATE INDEX IF NOT EXISTS idx_trips_status_created_ts ON trips(status, created_ts)",
+    "CREATE INDEX IF NOT EXISTS idx_trips_driver_status ON trips(driver_id, status)",
+    "CREATE INDEX IF NOT EXISTS idx_trips_passenger_status ON trips(passenger_id, status)",
+    '''CREATE TABLE IF NOT EXISTS ratings (
+        id BIGINT GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+        trip_id BIGINT UNIQUE,
+        driver_id BIGINT,
+        passenger_id BIGINT,
+        rating INTEGER CHECK(rating BETWEEN 1 AND 5),
+        created_at TEXT,
+        created_ts BIGINT
+    )''',
+    "CREATE INDEX IF NOT EXISTS idx_ratings_driver ON ratings(driver_id)",
+    '''CREATE TABLE IF NOT EXISTS driver_rating_stats (
+        driver_id BIGINT PRIMARY KEY,
+        rating_sum BIGINT NOT NULL DEFAULT 0,
+        rating_count BIGINT NOT NULL DEFAULT 0,
+        r1 BIGINT NOT NULL DEFAULT 0,
+        r2 BIGINT NOT NULL DEFAULT 0,
+        r3 BIGINT NOT NULL DEFAULT 0,
+        r4 BIGINT NOT NULL DEFAULT 0,
+        r5 BIGINT NOT NULL DEFAULT 0
+    )''',
+    '''CREATE TABLE IF NOT EXISTS cancellation_reasons (
+        id BIGINT GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+        user_type TEXT CHECK(user_type IN ('driver', 'passenger')),
+        reason_text TEXT NOT NULL
+    )''',
+    '''CREATE TABLE IF NOT EXISTS bans (
+        id BIGINT GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+        user_id BIGINT NOT NULL,
+        reason TEXT NOT NULL,
+        banned_until TEXT,
+        banned_at TEXT,
+        banned_until_ts BIGINT,
+        banned_at_ts BIGINT
+    )''',
+    "CREATE INDEX IF NOT EXISTS idx_bans_user ON bans(user_id)",
+    # Кольцо последних отмен — массив epoch по возрастанию
+    '''CREATE TABLE IF NOT EXISTS user_stats (
+        user_id BIGINT PRIMARY KEY,
+        recent_cancels BIGINT[] NOT NULL DEFAULT '{}'
+    )''',
+    '''CREATE TABLE IF NOT EXISTS trip_events (
+        seq BIGINT GENERATED ALWAYS AS IDENTITY PRIMARY KEY,
+        trip_id BIGINT NOT NULL,
+        status TEXT,
+        prev_status TEXT,
+        passenger_id BIGINT,
+        driver_id BIGINT,
+        fare DOUBLE PRECISION,
+        ts BIGINT NOT NULL
+    )''',
+    '''CREATE OR REPLACE FUNCTION log_trip_event() RETURNS trigger LANGUAGE plpgsql AS $$
+    DECLARE
+        prev TEXT;
+    BEGIN
+        IF TG_OP = 'UPDATE' THEN
+            prev := OLD.status;
+        END IF;
+        PERFORM pg_advisory_xact_lock(hashtext('taxi_trip_events'));
+        INSERT INTO trip_events (trip_id, status, prev_status, passenger_id, driver_id, fare, ts)
+        VALUES (NEW.id, NEW.status, prev, NEW.passenger_id, NEW.driver_id, NEW.fare, EXTRACT(EPOCH FROM now())::BIGINT);
+        RETURN NULL;
+    END $$''',
+    "DROP TRIGGER IF EXISTS trg_trips_events_insert ON trips",
+    "CREATE TRIGGER trg_trips_events_insert AFTER INSERT ON trips FOR EACH ROW EXECUTE FUNCTION log_trip_event()",
+    "DROP TRIGGER IF EXISTS trg_trips_events_update ON trips",
+    "CREATE TRIGGER trg_trips_events_update AFTER UPDATE OF status, driver_id, fare ON trips FOR EACH ROW "
+    "WHEN (OLD.status IS DISTINCT FROM NEW.status OR OLD.driver_id IS DISTINCT FROM NEW.driver_id "
+    "OR OLD.fare IS DISTINCT FROM NEW.fare) EXECUTE FUNCTION log_trip_event()",
+    '''CREATE TABLE IF NOT EXISTS trip_messages (
+        trip_id BIGINT NOT NULL,
+        chat_id BIGINT NOT NULL,
+        message_id BIGINT NOT NULL,
+        kind TEXT NOT NULL,
+        PRIMARY KEY (trip_id, chat_id, message_id)
+    )''',
+]
+
+# Строка бана, действующего на момент now
+_ACTIVE_BAN = '''
+    SELECT reason, banned_until FROM bans
+    WHERE user_id = %(uid)s AND (banned_until_ts IS NULL OR banned_until_ts > %(now)s)
+    ORDER BY id DESC LIMIT 1
+'''
+
+
+class PostgresStorage(Storage):
+    """Хранилище на PostgreSQL с пулом соединений psycopg_pool."""
+
+    name = "postgres"
+
+    def __init__(self, dsn, min_size=PG_POOL_MIN, max_size=PG_POOL_MAX):
+        if psycopg is None:
+            raise RuntimeError('Для DB_BACKEND=postgres нужны пакеты psycopg и psycopg_pool: '
+                               'pip install "psycopg[binary]" psycopg_pool')
+        if not dsn:
+            raise RuntimeError("Для DB_BACKEND=postgres задайте DATABASE_URL")
+        self.dsn = dsn
+        self.max_connections = max_size
+        self.pool = ConnectionPool(dsn, min_size=min_size, max_size=max_size, open=False)
+
+    def init(self):
+        self.pool.open(wait=True)
+        with self._cursor() as cur:
+            # Два процесса, стартующие одновременно, не должны создавать схему параллельно
+            cur.execute("SELECT pg_advisory_xact_lock(hashtext('taxi_bot_schema'))")
+            for statement in SCHEMA:
+                cur.execute(statement)
+            if not cur.execute("SELECT 1 FROM tariffs LIMIT 1").fetchone():
+                cur.executemany("INSERT INTO tariffs (name, price) VALUES (%s, %s)", db_utils.DEFAULT_TARIFFS)
+            if not cur.execute("SELECT 1 FROM eta_options LIMIT 1").fetchone():
+                cur.executemany("INSERT INTO eta_options (text, minutes) VALUES (%s, %s)", db_utils.DEFAULT_ETA_OPTIONS)
+            if not cur.execute("SELECT 1 FROM cancellation_reasons LIMIT 1").fetchone():
+                cur.executemany("INSERT INTO cancellation_reasons (user_type, reason_text) VALUES (%s, %s)",
+                                db_utils.DEFAULT_CANCELLATION_REASONS)
+        return self
+
+    def close(self):
+        self.pool.close()
+
+    @contextmanager
+    def _cursor(self, row_factory=None):
+        """Курсор в отдельной транзакции: COMMIT при выходе, ROLLBACK при исключении."""
+        with self.pool.connection() as conn:
+            with conn.cursor(row_factory=row_factory) as cur:
+                yield cur
+
+    def _trip(self, sql, params):
+        with self._cursor(kwargs_row(Trip)) as cur:
+            return cur.execute(sql, params).fetchone()
+
+    def _transition(self, name, trip_id, skip_locked=False, driver=None, **fields):
+        return self._trip(trip_states.transition_sql(name, tuple(fields), "%s", skip_locked),
+                          trip_states.transition_params(name, trip_id, tuple(fields.values()), driver_id=driver))
+
+    # === ПОЛЬЗОВАТЕЛИ И БАНЫ ===
+    def save_user(self, telegram_id, username, first_name):
+        now = timeutil.now_ts()
+        with self._cursor() as cur:
+            cur.execute('''
+                INSERT INTO users (telegram_id, username, first_name, role, registration_date, registration_ts)
+                VALUES (%s, %s, %s, 'passenger', %s, %s)
+                ON CONFLICT (telegram_id) DO UPDATE SET username = EXCLUDED.username, first_name = EXCLUDED.first_name
+            ''', (telegram_id, username, first_name, timeutil.to_text(now), now))
+
+    def get_user_context(self, telegram_id):
+        with self._cursor() as cur:
+            role, reason, banned_until = cur.execute(f'''
+                SELECT u.role, b.reason, b.banned_until
+                FROM (SELECT %(uid)s::BIGINT AS id) q
+                LEFT JOIN users u ON u.telegram_id = q.id
+                LEFT JOIN LATERAL ({_ACTIVE_BAN}) b ON TRUE
+            ''', {"uid": telegram_id, "now": timeutil.now_ts()}).fetchone()
+        return UserContext(role, reason is not None, banned_until, reason)
+
+    def get_user_role(self, telegram_id):
+        with self._cursor() as cur:
+            row = cur.execute("SELECT role FROM users WHERE telegram_id = %s", (telegram_id,)).fetchone()
+        return row[0] if row else None
+
+    def is_user_banned(self, user_id):
+        with self._cursor() as cur:
+            return cur.execute(_ACTIVE_BAN, {"uid": user_id, "now": timeutil.now_ts()}).fetchone() is not None
+
+    def ban_user(self, user_id, reason, ban_duration_days=None):
+        with self._cursor() as cur:
+            self._ban(cur, int(user_id), reason, ban_duration_days)
+
+    @staticmethod
+    def _ban(cur, user_id, reason, ban_duration_days):
+        now = timeutil.now_ts()
+        banned_until = deadline = None
+        if ban_duration_days:
+            deadline = timeutil.from_now(days=ban_duration_days)
+            banned_until = timeutil.to_text(deadline, local=True)
+        # У пользователя один действующий бан: новый заменяет прежний
+        cur.execute("DELETE FROM bans WHERE user_id = %s", (user_id,))
+        cur.execute('''
+            INSERT INTO bans (user_id, reason, banned_until, banned_at, banned_until_ts, banned_at_ts)
+            VALUES (%s, %s, %s, %s, %s, %s)
+        ''', (user_id, reason, banned_until, timeutil.to_text(now), deadline, now))
+        cur.execute("UPDATE users SET is_banned = 1 WHERE telegram_id = %s", (user_id,))
+
+    def unban_user(self, user_id):
+        user_id = int(user_id)
+        with self._cursor() as cur:
+            cur.execute("UPDATE users SET is_banned = 0 WHERE telegram_id = %s", (user_id,))
+            cur.execute("DELETE FROM bans WHERE user_id = %s", (user_id,))
+
+    def increment_cancel_count(self, user_id):
+        """Учитывает отмену; кольцо обновляется одним UPSERT под блокировкой строки пользователя.
+
+        Правила те же, что у SQLite-версии (db_utils.CANCELS). Возвращает сработавшее
+        CancelPolicy или None.
+        """
+        tracker = db_utils.CANCELS
+        now = timeutil.now_ts()
+        with self._cursor() as cur:
+            ring = cur.execute('''
+                INSERT INTO user_stats AS s (user_id, recent_cancels) VALUES (%(uid)s, ARRAY[%(now)s::BIGINT])
+                ON CONFLICT (user_id) DO UPDATE SET recent_cancels = ARRAY(
+                    SELECT t FROM (
+                        SELECT t FROM unnest(s.recent_cancels || %(now)s::BIGINT) t
+                        WHERE t > %(horizon)s ORDER BY t DESC LIMIT %(size)s
+                    ) last ORDER BY t)
+                RETURNING recent_cancels
+            ''', {"uid": user_id, "now": now, "horizon": now - tracker.window, "size": tracker.size}).fetchone()[0]
+            policy = tracker.check(ring, now)
+            if policy:
+                cur.execute("UPDATE user_stats SET recent_cancels = '{}' WHERE user_id = %s", (user_id,))
+                self._ban(cur, int(user_id), policy.reason, policy.ban_days)
+        return policy
+
+    # === СПРАВОЧНИКИ ===
+    def get_driver_profile(self, driver_id):
+        with self._cursor() as cur:
+            return cur.execute('''
+                SELECT full_name, car_brand, car_model, license_plate, phone_number, payment_number, bank_name
+                FROM users WHERE telegram_id = %s
+            ''', (driver_id,)).fetchone()
+
+    def get_tariffs(self):
+        with self._cursor() as cur:
+            return cur.execute("SELECT id, name, price FROM tariffs ORDER BY id").fetchall()
+
+    def get_cancellation_reasons(self, user_type):
+        with self._cursor() as cur:
+            return cur.execute("SELECT id, reason_text FROM cancellation_reasons WHERE user_type = %s ORDER BY id",
+                               (user_type,)).fetchall()
+
+    def get_cancellation_reason_text(self, reason_id):
+        with self._cursor() as cur:
+            row = cur.execute("SELECT reason_text FROM cancellation_reasons WHERE id = %s", (reason_id,)).fetchone()
+        return row[0] if row else None
+
+    # === ПОЕЗДКИ ===
+    def has_active_order(self, user_id):
+        with self._cursor() as cur:
+            return cur.execute(
+                "SELECT 1 FROM trips WHERE passenger_id = %s AND status IN ('requested', 'accepted', 'in_progress') LIMIT 1",
+                (user_id,)).fetchone() is not None
+
+    def create_trip(self, passenger_id, pickup, destination):
+        now = timeutil.now_ts()
+        with self._cursor() as cur:
+            return cur.execute('''
+                INSERT INTO trips (passenger_id, pickup, destination, created_at, created_ts)
+                VALUES (%s, %s, %s, %s, %s) RETURNING id
+            ''', (passenger_id, pickup, destination, timeutil.to_text(now), now)).fetchone()[0]
+
+    def get_trip(self, trip_id):
+        return self._trip("SELECT * FROM trips WHERE id = %s", (trip_id,))
+
+    def assign_driver_to_trip(self, trip_id, driver_id, confirm_by=None):
+        # Строку, которую уже забирает другой водитель, пропускаем, а не ждём:
+        # тот, кто её захватил, и получит заказ
+        return self._transition("accept", trip_id, skip_locked=True, driver_id=driver_id,
+                                **db_utils.confirm_fields(confirm_by))
+
+    def mark_arrived(self, trip_id, driver_id):
+        return self._transition("arrive", trip_id, driver=driver_id)
+
+    def complete_trip(self, trip_id, driver_id):
+        return self._transition("complete", trip_id, driver=driver_id)
+
+    def set_trip_fare(self, trip_id, fare, driver_id):
+        return self._transition("set_fare", trip_id, driver=driver_id, fare=fare, **db_utils.confirm_fields(None))
+
+    def cancel_trip(self, trip_id, status, reason_text=None, driver_id=None):
+        return self._transition(trip_states.CANCEL_TRANSITIONS[status], trip_id, driver=driver_id,
+                                cancellation_reason=reason_text)
+
+    def expire_trip(self, trip_id):
+        return self._transition("expire", trip_id)
+
+    def expire_due_trips(self, timeout_minutes, limit=100):
+        """Как db_utils.expire_due_trips; параллельные вызовы получают непересекающиеся заказы."""
+        with self._cursor() as cur:
+            return cur.execute('''
+                UPDATE trips SET status = 'expired'
+                WHERE id IN (
+                    SELECT id FROM trips WHERE status = 'requested' AND created_ts < %s
+                    ORDER BY created_ts LIMIT %s FOR UPDATE SKIP LOCKED)
+                RETURNING id, passenger_id
+            ''', (timeutil.from_now(minutes=-timeout_minutes), limit)).fetchall()
+
+    def get_trip_deadlines(self, timeout_minutes):
+        """Как db_utils.get_trip_deadlines."""
+        with self._cursor() as cur:
+            return cur.execute('''
+                SELECT id, status, CASE status WHEN 'requested' THEN COALESCE(confirm_timeout_ts, created_ts + %s)
+                                               ELSE confirm_timeout_ts END
+                FROM trips WHERE status = 'requested' OR (status = 'accepted' AND confirm_timeout_ts IS NOT NULL)
+            ''', (timeout_minutes * 60,)).fetchall()
+
+    def expire_trips(self, trip_ids, timeout_minutes):
+        """Как db_utils.expire_trips; заказ, который уже обрабатывает другой процесс, пропускается."""
+        if not trip_ids:
+            return []
+        with self._cursor() as cur:
+            return cur.execute(f'''
+                UPDATE trips SET status = 'expired'
+                WHERE id IN (
+                    SELECT id FROM trips WHERE id = ANY(%s) AND {trip_states.status_condition("expire")}
+                      AND COALESCE(confirm_timeout_ts, created_ts + %s) <= %s
+                    FOR UPDATE SKIP LOCKED)
+                RETURNING id, passenger_id
+            ''', (list(trip_ids), timeout_minutes * 60, timeutil.now_ts())).fetchall()
+
+    def release_stalled_trips(self, trip_ids, timeout_minutes):
+        """Как db_utils.release_stalled_trips; строки, занятые другим процессом, пропускаются."""
+        if not trip_ids:
+            return []
+        now = timeutil.now_ts()
+        deadline = now + timeout_minutes * 60
+        with self._cursor() as cur:
+            drivers = dict(cur.execute(f'''
+                SELECT id, driver_id FROM trips
+                WHERE id = ANY(%s) AND {trip_states.status_condition("release")} AND confirm_timeout_ts <= %s
+                FOR UPDATE SKIP LOCKED
+            ''', (list(trip_ids), now)).fetchall())
+            if not drivers:
+                return []
+            cur.row_factory = kwargs_row(Trip)
+            trips = cur.execute('''
+                UPDATE trips SET status = 'requested', driver_id = NULL, accepted_at = NULL, accepted_ts = NULL,
+                    confirm_timeout_at = %s, confirm_timeout_ts = %s, return_count = return_count + 1
+                WHERE id = ANY(%s)
+                RETURNING *
+            ''', (timeutil.to_text(deadline, local=True), deadline, list(drivers))).fetchall()
+        return [(trip, drivers[trip.id]) for trip in trips]
+
+    def iter_trips(self, start_ts=None, end_ts=None, batch=PG_ITERSIZE):
+        """Поездки с created_ts в [start_ts, end_ts) по возрастанию id, серверным курсором.
+
+        Соединение из пула занято, пока генератор не дочитан или не закрыт.
+        """
+        where, params = ["TRUE"], []
+        if start_ts is not None:
+            where.append("created_ts >= %s")
+            params.append(start_ts)
+        if end_ts is not None:
+            where.append("created_ts < %s")
+            params.append(end_ts)
+        with self.pool.connection() as conn:
+            with conn.cursor(name="iter_trips", row_factory=kwargs_row(Trip)) as cur:
+                cur.itersize = batch
+                cur.execute(f"SELECT * FROM trips WHERE {' AND '.join(where)} ORDER BY id", params)
+                yield from cur
+
+    def get_trip_changes(self, after_seq=0, limit=500):
+        """Как db_utils.get_trip_changes."""
+        columns = db_utils.TRIP_EVENT_COLUMNS
+        with self._cursor() as cur:
+            oldest, head = cur.execute("SELECT MIN(seq), MAX(seq) FROM trip_events").fetchone()
+            if limit > 0:
+                rows = cur.execute(f"SELECT {', '.join(columns)} FROM trip_events WHERE seq > %s ORDER BY seq LIMIT %s",
+                                   (after_seq, limit)).fetchall()
+                cursor = rows[-1][0] if rows else after_seq
+            else:
+                rows, cursor = [], max(head or 0, after_seq)
+        return {
+            "events": [dict(zip(columns, row)) for row in rows],
+            "cursor": cursor,
+            "has_more": head is not None and cursor < head,
+            "reset": limit > 0 and oldest is not None and after_seq < oldest - 1,
+        }
+
+    # === СТАТИСТИКА И РЕЙТИНГ ===
+    def save_rating(self, trip_id, driver_id, passenger_id, rating):
+        now = timeutil.now_ts()
+        with self._cursor() as cur:
+            # Блокировка поездки упорядочивает повторные оценки одной поездки
+            cur.execute("SELECT 1 FROM trips WHERE id = %s FOR UPDATE", (trip_id,))
+            old = cur.execute("SELECT driver_id, rating FROM ratings WHERE trip_id = %s", (trip_id,)).fetchone()
+            cur.execute('''
+                INSERT INTO ratings (trip_id, driver_id, passenger_id, rating, created_at, created_ts)
+                VALUES (%s, %s, %s, %s, %s, %s)
+                ON CONFLICT (trip_id) DO UPDATE SET driver_id = EXCLUDED.driver_id, passenger_id = EXCLUDED.passenger_id,
+                    rating = EXCLUDED.rating, created_at = EXCLUDED.created_at, created_ts = EXCLUDED.created_ts
+            ''', (trip_id, driver_id, passenger_id, rating, timeutil.to_text(now), now))
+            if old and old[0] is not None and old[1] is not None:
+                self._add_to_rating_stats(cur, old[0], old[1], -1)
+            if driver_id is not None:
+                self._add_to_rating_stats(cur, driver_id, rating, 1)
+
+    @staticmethod
+    def _add_to_rating_stats(cur, driver_id, rating, sign):
+        buckets = [sign if rating == stars else 0 for stars in range(1, 6)]
+        cur.execute('''
+            INSERT INTO driver_rating_stats AS s (driver_id, rating_sum, rating_count, r1, r2, r3, r4, r5)
+            VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+            ON CONFLICT (driver_id) DO UPDATE SET
+                rating_sum = s.rating_sum + EXCLUDED.rating_sum,
+                rating_count = s.rating_count + EXCLUDED.rating_count,
+                r1 = s.r1 + EXCLUDED.r1, r2 = s.r2 + EXCLUDED.r2, r3 = s.r3 + EXCLUDED.r3,
+                r4 = s.r4 + EXCLUDED.r4, r5 = s.r5 + EXCLUDED.r5
+        ''', (driver_id, sign * rating, sign, *buckets))
+
+    def get_driver_rating(self, driver_id):
+        with self._cursor() as cur:
+            row = cur.execute("SELECT rating_sum, rating_count FROM driver_rating_stats WHERE driver_id = %s",
+                              (driver_id,)).fetchone()
+        return round(row[0] / row[1], 1) if row and row[1] else None
+
+    def get_driver_stats(self, driver_id):
+        # Счётчики поездок считаются по индексу (driver_id, status), отдельной сводки нет
+        with self._cursor() as cur:
+            return cur.execute('''
+                SELECT
+                    (SELECT COUNT(*) FROM trips WHERE driver_id = %(id)s AND status = 'completed'),
+                    (SELECT SUM(COALESCE(fare, 0)) FROM trips WHERE driver_id = %(id)s AND status = 'completed'),
+                    (SELECT rating_sum * 1.0 / NULLIF(rating_count, 0) FROM driver_rating_stats WHERE driver_id = %(id)s)
+            ''', {"id": driver_id}).fetchone()
+
+    def get_passenger_completed_count(self, passenger_id):
+        with self._cursor() as cur:
+            return cur.execute("SELECT COUNT(*) FROM trips WHERE passenger_id = %s AND status = 'completed'",
+                               (passenger_id,)).fetchone()[0]
+
+    # === СООБЩЕНИЯ ПОЕЗДКИ ===
+    def add_trip_messages(self, trip_id, messages):
+        rows = [(trip_id, chat_id, message_id, kind) for chat_id, message_id, kind in messages if chat_id and message_id]
+        if not rows:
+            return
+        with self._cursor() as cur:
+            cur.executemany('''
+                INSERT INTO trip_messages (trip_id, chat_id, message_id, kind) VALUES (%s, %s, %s, %s)
+                ON CONFLICT DO NOTHING
+            ''', rows)
+
+    def add_trip_message(self, trip_id, chat_id, message_id, kind):
+        self.add_trip_messages(trip_id, [(chat_id, message_id, kind)])
+
+    def get_trip_messages(self, trip_id):
+        grouped = {}
+        with self._cursor() as cur:
+            for chat_id, message_id in cur.execute(
+                    "SELECT chat_id, message_id FROM trip_messages WHERE trip_id = %s", (trip_id,)):
+                grouped.setdefault(chat_id, []).append(message_id)
+        return grouped
+
+    def delete_trip_messages(self, trip_id):
+        with self._cursor() as cur:
+            cur.execute("DELETE FROM trip_messages WHERE trip_id = %s", (trip_id,))
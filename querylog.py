@@ -0,0 +1,312 @@
+# querylog.py
+# Учёт запросов к SQLite: каждый курсор пула — TracedCursor, который замеряет
+# выполнение запроса вместе с чтением результата и складывает время и число
+# строк в гистограмму по ключу (операция, текст запроса). Операция — имя
+# функции db_utils (@reads/@writes) или маршрут дашборда, см. operation().
+#
+# Отдельно считаются ожидания вне самих запросов: взять соединение-читатель из
+# пула, дождаться своей очереди у писателя, захватить запись (BEGIN IMMEDIATE)
+# и зафиксировать её (COMMIT).
+#
+# Запросы дольше SLOW_QUERY_MS попадают в журнал SLOW_QUERY_LOG, если он задан (JSON по
+# строке, с EXPLAIN QUERY PLAN) и в кольцо последних медленных в памяти.
+# Всё это отдаёт /api/admin/query_stats.
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from functools import lru_cache
+
+QUERY_LOG = os.getenv("QUERY_LOG", "1") != "0"
+SLOW_QUERY_MS = float(os.getenv("SLOW_QUERY_MS", "100"))
+# Файл журнала медленных запросов (например, slow_queries.log); пусто — только в памяти
+SLOW_QUERY_LOG = os.getenv("SLOW_QUERY_LOG", "")
+SLOW_QUERY_KEEP = int(os.getenv("SLOW_QUERY_KEEP", "200"))
+
+# Верхние границы корзин гистограммы, мс; последняя корзина — всё, что дольше
+BUCKETS_MS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500)
+
+_EXPLAINABLE = ("SELECT", "WITH", "INSERT", "UPDATE", "DELETE", "REPLACE")
+
+_local = threading.local()
+
+
+def set_operation(name):
+    _local.name = name
+
+
+@contextmanager
+def operation(name):
+    """Запросы внутри блока учитываются под именем name."""
+    previous = getattr(_local, "name", None)
+    _local.name = name
+    try:
+        yield
+    finally:
+        _local.name = previous
+
+
+def current_operation():
+    return getattr(_local, "name", None) or "-"
+
+
+@lru_cache(maxsize=2048)
+def normalize(sql):
+    """Текст запроса без лишних пробелов; списки '?, ?, ?' любой длины сворачиваются в один."""
+    sql = " ".join(sql.split())
+    return re.sub(r"\?(?:\s*,\s*\?)+", "?, ...", sql)
+
+
+class Histogram:
+    __slots__ = ("count", "total", "max", "buckets")
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.buckets = [0] * (len(BUCKETS_MS) + 1)
+
+    def add(self, ms):
+        self.count += 1
+        self.total += ms
+        if ms > self.max:
+            self.max = ms
+        for i, bound in enumerate(BUCKETS_MS):
+            if ms <= bound:
+                self.buckets[i] += 1
+                return
+        self.buckets[-1] += 1
+
+    def quantile(self, q):
+        """Верхняя граница корзины, в которую попал квантиль q (для хвоста — максимум)."""
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if n and seen >= rank:
+                return BUCKETS_MS[i] if i < len(BUCKETS_MS) else round(self.max, 2)
+        return 0
+
+    def as_dict(self):
+        return {
+            "count": self.count,
+            "total_ms": round(self.total, 2),
+            "avg_ms": round(self.total / self.count, 3) if self.count else 0,
+            "p50_ms": self.quantile(0.5),
+            "p95_ms": self.quantile(0.95),
+            "p99_ms": self.quantile(0.99),
+            "max_ms": round(self.max, 2),
+        }
+
+
+class QueryStats:
+    """Статистика запросов и ожиданий, общая для всех потоков."""
+
+    def __init__(self, slow_ms=SLOW_QUERY_MS, slow_log=SLOW_QUERY_LOG, keep=SLOW_QUERY_KEEP):
+        self.slow_ms = slow_ms
+        self.slow_log = slow_log
+        self._lock = threading.Lock()
+        self._queries = {}
+        self._waits = {}
+        self._slow = deque(maxlen=keep)
+        self._log_lock = threading.Lock()
+        self.started = time.time()
+
+    def record(self, name, sql, ms, rows, error=False):
+        key = (name, normalize(sql))
+        with self._lock:
+            entry = self._queries.get(key)
+            if entry is None:
+                entry = self._queries[key] = [Histogram(), 0, 0]
+            entry[0].add(ms)
+            entry[1] += rows
+            entry[2] += error
+
+    def record_wait(self, name, kind, ms):
+        key = (name, kind)
+        with self._lock:
+            hist = self._waits.get(key)
+            if hist is None:
+                hist = self._waits[key] = Histogram()
+            hist.add(ms)
+
+    def record_slow(self, name, sql, params, ms, rows, plan):
+        entry = {
+            "ts": round(time.time(), 3),
+            "operation": name,
+            "ms": round(ms, 2),
+            "rows": rows,
+            "sql": normalize(sql),
+            "params": [p if isinstance(p, (int, float, str)) or p is None else repr(p) for p in params]
+                      if isinstance(params, (list, tuple)) else repr(params),
+            "plan": plan,
+        }
+        with self._lock:
+            self._slow.append(entry)
+        if not self.slow_log:
+            return
+        with self._log_lock:
+            try:
+                with open(self.slow_log, "a", encoding="utf-8") as f:
+                    f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+            except OSError as e:
+                print(f"Не удалось записать журнал медленных запросов: {e}")
+
+    def snapshot(self, sort="total_ms", limit=50):
+        with self._lock:
+            queries = [
+                {"operation": name, "sql": sql, "rows": rows, "errors": errors, **hist.as_dict()}
+                for (name, sql), (hist, rows, errors) in self._queries.items()
+            ]
+            waits = [
+                {"operation": name, "kind": kind, **hist.as_dict()}
+                for (name, kind), hist in self._waits.items()
+            ]
+        queries.sort(key=lambda q: q.get(sort, 0), reverse=True)
+        waits.sort(key=lambda w: w["total_ms"], reverse=True)
+        return {
+            "since": round(self.started, 3),
+            "slow_ms": self.slow_ms,
+            "queries": queries[:limit],
+            "waits": waits[:limit],
+        }
+
+    def slow(self, limit=50):
+        with self._lock:
+            return list(self._slow)[-limit:][::-1]
+
+    def reset(self):
+        with self._lock:
+            self._queries.clear()
+            self._waits.clear()
+            self._slow.clear()
+            self.started = time.time()
+
+
+STATS = QueryStats()
+
+
+class TracedCursor(sqlite3.Cursor):
+    """Курсор, замеряющий каждый запрос от execute до последней прочитанной строки.
+
+    Запрос учитывается, когда курсор выполняет следующий или закрывается.
+    """
+
+    _pending = None
+
+    def execute(self, sql, params=()):
+        self._finish()
+        start = time.perf_counter()
+        try:
+            super().execute(sql, params)
+        except Exception:
+            STATS.record(current_operation(), sql, (time.perf_counter() - start) * 1000, 0, error=True)
+            raise
+        self._pending = [sql, params, time.perf_counter() - start, 0]
+        if self.description is None:
+            # Запрос без результата уже выполнен целиком — учитываем сразу
+            self._finish()
+        return self
+
+    def executemany(self, sql, seq_of_params):
+        self._finish()
+        seq_of_params = list(seq_of_params)
+        start = time.perf_counter()
+        try:
+            super().executemany(sql, seq_of_params)
+        except Exception:
+            STATS.record(current_operation(), sql, (time.perf_counter() - start) * 1000, 0, error=True)
+            raise
+        self._pending = [sql, seq_of_params[0] if seq_of_params else (), time.perf_counter() - start, 0]
+        self._finish()
+        return self
+
+    def fetchone(self):
+        start = time.perf_counter()
+        row = super().fetchone()
+        self._add(time.perf_counter() - start, row is not None)
+        return row
+
+    def fetchmany(self, size=None):
+        start = time.perf_counter()
+        rows = super().fetchmany(self.arraysize if size is None else size)
+        self._add(time.perf_counter() - start, len(rows))
+        return rows
+
+    def fetchall(self):
+        start = time.perf_counter()
+        rows = super().fetchall()
+        self._add(time.perf_counter() - start, len(rows))
+        return rows
+
+    def __next__(self):
+        start = time.perf_counter()
+        try:
+            row = super().__next__()
+        except StopIteration:
+            self._add(time.perf_counter() - start, 0)
+            raise
+        self._add(time.perf_counter() - start, 1)
+        return row
+
+    def close(self):
+        self._finish()
+        super().close()
+
+    def _add(self, elapsed, rows):
+        pending = self._pending
+        if pending is not None:
+            pending[2] += elapsed
+            pending[3] += rows
+
+    def _finish(self):
+        pending, self._pending = self._pending, None
+        if pending is None:
+            return
+        sql, params, elapsed, rows = pending
+        if not rows and self.rowcount > 0:
+            rows = self.rowcount  # INSERT/UPDATE/DELETE
+        ms = elapsed * 1000
+        name = current_operation()
+        STATS.record(name, sql, ms, rows)
+        if ms >= STATS.slow_ms:
+            STATS.record_slow(name, sql, params, ms, rows, self._explain(sql, params))
+
+    def _explain(self, sql, params):
+        if not sql.lstrip().upper().startswith(_EXPLAINABLE):
+            return []
+        try:
+            return [row[3] for row in self.connection.execute("EXPLAIN QUERY PLAN " + sql, params)]
+        except sqlite3.Error as e:
+            return [f"EXPLAIN не удался: {e}"]
+
+
+class TracedConnection(sqlite3.Connection):
+    """Соединение, чьи курсоры по умолчанию — TracedCursor."""
+
+    def cursor(self, factory=TracedCursor):
+        return super().cursor(factory)
+
+
+def connection_factory():
+    return TracedConnection if QUERY_LOG else sqlite3.Connection
+
+
+def record_wait(kind, since):
+    """Учитывает ожидание, начавшееся в since (time.perf_counter()), для текущей операции."""
+    if QUERY_LOG:
+        STATS.record_wait(current_operation(), kind, (time.perf_counter() - since) * 1000)
+
+
+@contextmanager
+def timed_wait(kind):
+    """Замеряет ожидание внутри блока и учитывает его для текущей операции."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_wait(kind, start)
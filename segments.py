@@ -0,0 +1,195 @@
+# segments.py
+# Аудитории рассылок. Сегмент — условие на пользователя (users u), которое
+# проверяется по индексам (миграция 11): роль — idx_users_role_banned, «были
+# поездки с ...» — trips(passenger_id|driver_id, created_ts), активный заказ —
+# idx_trips_passenger_status.
+#
+# Получатели выбираются страницами по ключу telegram_id (page()): в памяти
+# никогда нет всей аудитории, а за всё задание users просматривается один раз.
+# Размер до отправки считает size() — отдельным запросом, который идёт от
+# меньшей стороны (свежие поездки, активные заказы, индекс по роли), а не
+# проверяет условие для каждого пользователя.
+#
+# Сегменты по истории поездок (since) смотрят и в архив (archive.trips), если
+# их окно заходит в него: архивные поездки тоже активность пользователя.
+#
+# Сегмент с параметром записывается "имя:значение", например "active:7"; так он
+# хранится и в broadcast_jobs.audience. Относительное время («за 7 дней», «эта
+# неделя») отсчитывается от переданного now: для задания это момент создания,
+# поэтому все его страницы видят одну и ту же аудиторию.
+import time
+
+import db_utils
+import timeutil
+import trip_states
+
+_ACTIVE = ", ".join(repr(s) for s in trip_states.ACTIVE_STATUSES)
+
+
+class Segment:
+    """Аудитория: where(значение, now, tables) -> (условие на users u, параметры); count — то же для размера.
+
+    since(значение, now) — начало окна истории поездок для сегментов, которые её читают;
+    tables — таблицы поездок, в которые это окно заходит (db_utils.trip_tables).
+    """
+
+    def __init__(self, title, where, count=None, param=None, since=None):
+        self.title = title  # с параметром — шаблон: "Активные за {} дн."
+        self.where = where
+        self.count = count
+        self.param = param  # (подпись, по умолчанию, минимум, максимум) или None
+        self.since = since
+
+
+def _role(role):
+    condition = f"u.role = '{role}' AND u.is_banned = 0"
+    return lambda value, now, tables: (condition, ())
+
+
+def _active_since(days, now):
+    return now - days * 86400
+
+
+def _active_where(days, now, tables):
+    since = _active_since(days, now)
+    exists = " OR ".join(
+        f"EXISTS (SELECT 1 FROM {table} t WHERE t.{column} = u.telegram_id AND t.created_ts >= ?)"
+        for table in tables for column in ("passenger_id", "driver_id"))
+    return f"u.is_banned = 0 AND ({exists})", (since,) * (2 * len(tables))
+
+
+def _active_count(days, now, tables):
+    since = _active_since(days, now)
+    ids = " UNION ".join(
+        f"SELECT {column} FROM {table} WHERE created_ts >= ?"
+        for table in tables for column in ("passenger_id", "driver_id"))
+    return f"SELECT COUNT(*) FROM users u WHERE u.is_banned = 0 AND u.telegram_id IN ({ids})", (since,) * (2 * len(tables))
+
+
+def _week_since(value, now):
+    return timeutil.week_start(now)
+
+
+def _idle_drivers_where(value, now, tables):
+    since = _week_since(value, now)
+    completed = " OR ".join(
+        f"EXISTS (SELECT 1 FROM {table} t WHERE t.driver_id = u.telegram_id "
+        "AND t.status = 'completed' AND t.created_ts >= ?)" for table in tables)
+    return f"u.role = 'driver' AND u.is_banned = 0 AND NOT ({completed})", (since,) * len(tables)
+
+
+def _idle_drivers_count(value, now, tables):
+    # Все водители минус те, у кого на этой неделе есть завершённая поездка
+    since = _week_since(value, now)
+    busy = " UNION ".join(
+        f"SELECT driver_id FROM {table} WHERE status = 'completed' AND created_ts >= ?" for table in tables)
+    return ("SELECT (SELECT COUNT(*) FROM users u WHERE u.role = 'driver' AND u.is_banned = 0) - "
+            f"(SELECT COUNT(*) FROM users u WHERE u.role = 'driver' AND u.is_banned = 0 AND u.telegram_id IN ({busy}))",
+            (since,) * len(tables))
+
+
+def _waiting_where(value, now, tables):
+    # Активные заказы в архив не попадают
+    return (f"u.is_banned = 0 AND EXISTS (SELECT 1 FROM trips t WHERE t.passenger_id = u.telegram_id "
+            f"AND t.status IN ({_ACTIVE}))", ())
+
+
+def _waiting_count(value, now, tables):
+    return (f"SELECT COUNT(*) FROM users u WHERE u.is_banned = 0 AND u.telegram_id IN ("
+            f"SELECT passenger_id FROM trips WHERE status IN ({_ACTIVE}))", ())
+
+
+SEGMENTS = {
+    "drivers": Segment("Водители", _role("driver")),
+    "passengers": Segment("Пассажиры", _role("passenger")),
+    "all": Segment("Все пользователи", lambda value, now, tables: ("u.is_banned = 0", ())),
+    "active": Segment("Активные за {} дн.", _active_where, _active_count, ("Дней", 7, 1, 365), _active_since),
+    "idle_drivers": Segment("Водители без завершённых поездок на этой неделе", _idle_drivers_where,
+                            _idle_drivers_count, since=_week_since),
+    "waiting_passengers": Segment("Пассажиры с активным заказом", _waiting_where, _waiting_count),
+}
+
+
+def parse(spec):
+    """'имя' или 'имя:значение' -> (имя, значение или None). ValueError, если сегмент или значение неверны."""
+    name, _, raw = (spec or "").partition(":")
+    segment = SEGMENTS.get(name)
+    if segment is None:
+        raise ValueError(f"Неизвестная аудитория: {name}")
+    if segment.param is None:
+        if raw:
+            raise ValueError(f"У аудитории {name} нет параметра")
+        return name, None
+    label, default, low, high = segment.param
+    try:
+        value = int(raw) if raw else default
+    except ValueError:
+        raise ValueError(f"{label}: нужно целое число") from None
+    if not low <= value <= high:
+        raise ValueError(f"{label}: от {low} до {high}")
+    return name, value
+
+
+def canonical(spec):
+    """Запись сегмента с явным значением параметра: 'active' -> 'active:7'."""
+    name, value = parse(spec)
+    return name if value is None else f"{name}:{value}"
+
+
+def title(spec):
+    name, value = parse(spec)
+    return SEGMENTS[name].title.format(value)
+
+
+def size(cur, spec, now=None):
+    """Число получателей сегмента на момент now."""
+    name, value = parse(spec)
+    segment = SEGMENTS[name]
+    now = timeutil.now_ts() if now is None else now
+    tables = _tables(cur, segment, value, now)
+    if segment.count is not None:
+        sql, params = segment.count(value, now, tables)
+    else:
+        where, params = segment.where(value, now, tables)
+        sql = f"SELECT COUNT(*) FROM users u WHERE {where}"
+    return cur.execute(sql, params).fetchone()[0]
+
+
+def _tables(cur, segment, value, now):
+    if segment.since is None:
+        return ("trips",)
+    return db_utils.trip_tables(cur, segment.since(value, now))
+
+
+def page(cur, spec, after, limit, until=None, now=None):
+    """Следующие limit получателей с telegram_id > after (и <= until), по возрастанию ключа."""
+    name, value = parse(spec)
+    segment = SEGMENTS[name]
+    now = timeutil.now_ts() if now is None else now
+    where, params = segment.where(value, now, _tables(cur, segment, value, now))
+    bound, bound_params = ("AND u.telegram_id <= ?", (until,)) if until is not None else ("", ())
+    rows = cur.execute(
+        f"SELECT u.telegram_id FROM users u WHERE u.telegram_id > ? {bound} AND {where} "
+        "ORDER BY u.telegram_id LIMIT ?", (after, *bound_params, *params, limit))
+    return [row[0] for row in rows]
+
+
+@db_utils.reads
+def estimate(cur, spec):
+    """Размер сегмента до отправки: {"audience", "title", "size", "ms"}."""
+    started = time.perf_counter()
+    total = size(cur, spec)
+    return {"audience": canonical(spec), "title": title(spec), "size": total,
+            "ms": round((time.perf_counter() - started) * 1000, 1)}
+
+
+def describe():
+    """Сегменты для дашборда: имя, название и параметр."""
+    result = []
+    for name, segment in SEGMENTS.items():
+        param = None
+        if segment.param is not None:
+            label, default, low, high = segment.param
+            param = {"label": label, "default": default, "min": low, "max": high}
+        result.append({"name": name, "title": segment.title.replace("{}", "N"), "param": param})
+    return result
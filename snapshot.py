@@ -0,0 +1,100 @@
+# snapshot.py
+# Реплика только для чтения (taxi_snapshot.db) для аналитики дашборда: тяжёлые
+# выборки /api/dashboard, /api/drivers, /api/financial идут в копию, а не в
+# файл, куда бот пишет на каждое нажатие кнопки. Операционные маршруты
+# (отмена заказа, баны, тарифы) по-прежнему работают с основной базой.
+#
+# Копия снимается через sqlite3.Connection.backup небольшими порциями страниц
+# с паузами, во временный файл, который затем атомарно подменяет реплику.
+# Источник держит одну читающую транзакцию на всё копирование: в WAL она не
+# мешает писателю, а без неё каждая запись бота перезапускала бы копирование
+# с первой страницы. Время снимка хранится в самой реплике (snapshot_info).
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+import db_utils
+import querylog
+import timeutil
+
+# Пусто — taxi_snapshot.db рядом с основной базой, "off" — без реплики
+SNAPSHOT_PATH = os.getenv("SNAPSHOT_PATH", "")
+# Как часто бот обновляет реплику, секунд; 0 — только вручную (manage.py snapshot)
+SNAPSHOT_INTERVAL = float(os.getenv("SNAPSHOT_INTERVAL", "300"))
+SNAPSHOT_PAGES = int(os.getenv("SNAPSHOT_PAGES", "256"))  # страниц за шаг backup
+SNAPSHOT_SLEEP = float(os.getenv("SNAPSHOT_SLEEP", "0.005"))  # пауза между шагами, секунд
+# Реплика старше этого (секунд) не используется — аналитика читает основную базу; 0 — без ограничения
+SNAPSHOT_MAX_AGE = float(os.getenv("SNAPSHOT_MAX_AGE", "900"))
+
+_refresh_lock = threading.Lock()
+
+
+def snapshot_path():
+    db_path = db_utils.POOL.db_path
+    if db_path == ':memory:' or SNAPSHOT_PATH == 'off':
+        return None
+    return SNAPSHOT_PATH or os.path.join(os.path.dirname(os.path.abspath(db_path)), 'taxi_snapshot.db')
+
+
+def refresh(pages=SNAPSHOT_PAGES, sleep=SNAPSHOT_SLEEP):
+    """Снимает новую копию основной базы. Возвращает время снимка (epoch) или None без реплики."""
+    path = snapshot_path()
+    if not path:
+        return None
+    tmp = path + ".tmp"
+    with _refresh_lock:
+        for leftover in (tmp, tmp + "-journal"):
+            if os.path.exists(leftover):
+                os.remove(leftover)
+        src = sqlite3.connect(f"file:{os.path.abspath(db_utils.POOL.db_path)}?mode=ro", uri=True, isolation_level=None)
+        dst = sqlite3.connect(tmp, isolation_level=None)
+        try:
+            src.execute("BEGIN")
+            src.execute("SELECT 1 FROM sqlite_master LIMIT 1").fetchone()
+            taken = timeutil.now_ts()
+            src.backup(dst, pages=pages, sleep=sleep)
+            src.execute("COMMIT")
+            # Реплику открывают только на чтение: без WAL ей не нужны файлы -wal/-shm
+            dst.execute("PRAGMA journal_mode = DELETE")
+            dst.execute("CREATE TABLE snapshot_info (taken_ts INTEGER NOT NULL)")
+            dst.execute("INSERT INTO snapshot_info VALUES (?)", (taken,))
+        finally:
+            src.close()
+            dst.close()
+        os.replace(tmp, path)
+    return taken
+
+
+def _open_replica(path):
+    """Соединение с репликой и её время снимка; None, если реплики нет или она устарела."""
+    if not path or not os.path.exists(path):
+        return None
+    conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True, isolation_level=None,
+                           factory=querylog.connection_factory())
+    taken = conn.execute("SELECT taken_ts FROM snapshot_info").fetchone()[0]
+    if SNAPSHOT_MAX_AGE and timeutil.now_ts() - taken > SNAPSHOT_MAX_AGE:
+        conn.close()
+        return None
+    if db_utils.POOL.archive_path:
+        # trips_source() объединяет поездки с архивом — подключаем его и к реплике
+        conn.execute("ATTACH DATABASE ? AS archive", (f"file:{os.path.abspath(db_utils.POOL.archive_path)}?mode=ro",))
+    return conn, taken
+
+
+@contextmanager
+def reader():
+    """(курсор, сведения о снимке) для аналитики: реплика, а пока её нет — основная база."""
+    replica = _open_replica(snapshot_path())
+    if replica is None:
+        with db_utils.reader() as cur:
+            yield cur, {"source": "primary", "taken_at": None, "age_seconds": 0}
+        return
+    conn, taken = replica
+    cur = conn.cursor()
+    try:
+        yield cur, {"source": "snapshot", "taken_at": timeutil.to_text(taken),
+                    "age_seconds": max(0, timeutil.now_ts() - taken)}
+    finally:
+        cur.close()
+        conn.close()
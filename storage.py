@@ -0,0 +1,91 @@
+# storage.py
+# Хранилище за интерфейсом: бот работает с объектом Storage, а не с конкретной
+# СУБД. SQLiteStorage — прежний db_utils (один процесс, пул соединений и
+# GroupCommitWriter), PostgresStorage (pg_storage.py) — общий сервер, к которому
+# можно подключить несколько процессов бота.
+#
+# Методы и их результаты одинаковы у всех реализаций: поездка — db_utils.Trip,
+# профиль, тарифы и причины отмены — кортежи в том же порядке колонок, что и в
+# SQLite. conformance.py проверяет это на любой реализации.
+import os
+
+DB_BACKEND = os.getenv("DB_BACKEND", "sqlite")  # sqlite | postgres
+DATABASE_URL = os.getenv("DATABASE_URL", "")
+
+
+class Storage:
+    """Операции хранилища, которыми пользуется бот."""
+
+    name = None
+
+    # Всё, что должна уметь реализация; AsyncDB вызывает их по имени
+    OPERATIONS = (
+        "save_user", "get_user_context", "get_user_role", "is_user_banned",
+        "ban_user", "unban_user", "get_driver_profile", "get_tariffs",
+        "get_cancellation_reasons", "get_cancellation_reason_text",
+        "has_active_order", "create_trip", "get_trip", "assign_driver_to_trip",
+        "mark_arrived", "complete_trip", "set_trip_fare", "cancel_trip",
+        "expire_trip", "expire_due_trips", "increment_cancel_count",
+        "save_rating", "get_driver_rating", "get_driver_stats",
+        "get_passenger_completed_count", "add_trip_messages", "add_trip_message",
+        "get_trip_messages", "delete_trip_messages", "iter_trips",
+        "get_trip_changes", "get_trip_deadlines", "expire_trips", "release_stalled_trips",
+    )
+
+    def init(self):
+        """Открывает соединения и приводит схему к актуальной."""
+        raise NotImplementedError
+
+    def close(self):
+        raise NotImplementedError
+
+    def __getattr__(self, name):
+        if name in Storage.OPERATIONS:
+            raise NotImplementedError(f"{type(self).__name__}.{name}")
+        raise AttributeError(name)
+
+
+class SQLiteStorage(Storage):
+    """Хранилище поверх db_utils; все операции — его функции как есть."""
+
+    name = "sqlite"
+
+    def __init__(self, db_path=None, **options):
+        import db_utils
+        self._db = db_utils
+        self.db_path = db_path or db_utils.DB_PATH
+        self.options = options
+
+    def init(self):
+        self._db.init_db(self.db_path, **self.options)
+        return self
+
+    def close(self):
+        self._db.WRITER.stop()
+        self._db.BANS.stop()
+        self._db.POOL.close()
+
+    def __getattr__(self, name):
+        if name in Storage.OPERATIONS:
+            return getattr(self._db, name)
+        raise AttributeError(name)
+
+
+def create_storage(backend=DB_BACKEND, dsn=DATABASE_URL, **options):
+    if backend == "sqlite":
+        return SQLiteStorage(dsn or None, **options)
+    if backend == "postgres":
+        from pg_storage import PostgresStorage
+        return PostgresStorage(dsn, **options)
+    raise ValueError(f"Неизвестный DB_BACKEND: {backend!r} (ожидается sqlite или postgres)")
+
+
+STORAGE = None
+
+
+def get_storage():
+    """Хранилище процесса, выбранное DB_BACKEND; создаётся и инициализируется при первом вызове."""
+    global STORAGE
+    if STORAGE is None:
+        STORAGE = create_storage().init()
+    return STORAGE
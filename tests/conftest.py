@@ -0,0 +1,27 @@
+# tests/conftest.py
+# Модули проекта лежат в корне репозитория; тесты запускаются из него: python -m pytest -q
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import storage  # noqa: E402
+
+# PostgreSQL проверяется, только если задана отдельная тестовая база: проверки пишут в неё
+TEST_DATABASE_URL = os.getenv("TEST_DATABASE_URL", "")
+
+BACKENDS = ["sqlite"] + (["postgres"] if TEST_DATABASE_URL else [])
+
+
+@pytest.fixture(scope="session", params=BACKENDS)
+def backend(request, tmp_path_factory):
+    """Хранилище на временной базе; db_utils держит один пул на процесс, поэтому одно на сессию."""
+    if request.param == "sqlite":
+        dsn = str(tmp_path_factory.mktemp("db") / "test.db")
+    else:
+        dsn = TEST_DATABASE_URL
+    instance = storage.create_storage(request.param, dsn).init()
+    yield instance
+    instance.close()
@@ -0,0 +1,13 @@
+# tests/test_conformance.py
+# Проверки conformance.py как тесты: по умолчанию на SQLite, с TEST_DATABASE_URL — и на PostgreSQL.
+# Среди них гонки двойного принятия (check_claim_race) и принятия с просрочкой
+# (check_accept_expire_race), кнопки водителя после возврата заказа в пул (check_released_driver).
+import pytest
+
+import conformance
+
+
+@pytest.mark.parametrize("check", conformance.CHECKS, ids=lambda check: check.__name__)
+def test_conformance(backend, check):
+    check(backend)
+
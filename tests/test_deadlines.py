@@ -0,0 +1,62 @@
+# tests/test_deadlines.py
+import asyncio
+import time
+
+import pytest
+
+import deadlines
+import trip_states
+
+
+def _collect(scheduler, fired):
+    async def handler(keys):
+        fired.append(sorted(keys))
+    for kind in deadlines.KINDS:
+        scheduler.on(kind, handler)
+
+
+def test_due_deadlines_fire_in_one_batch():
+    async def scenario():
+        scheduler, fired = deadlines.Deadlines(resync=0), []
+        _collect(scheduler, fired)
+        task = asyncio.create_task(scheduler.run())
+        await asyncio.sleep(0)
+        when = time.time() + 0.05
+        scheduler.arm(deadlines.EXPIRE, 1, when)
+        scheduler.arm(deadlines.EXPIRE, 2, when)
+        scheduler.arm(deadlines.EXPIRE, 3, when)
+        scheduler.disarm(deadlines.EXPIRE, 3)
+        await asyncio.sleep(0.2)
+        task.cancel()
+        return fired, scheduler.stats()[deadlines.EXPIRE]
+
+    fired, stats = asyncio.run(scenario())
+    assert fired == [[1, 2]]
+    assert (stats["armed"], stats["fired"], stats["batches"]) == (0, 2, 1)
+
+
+def test_rearm_moves_deadline():
+    async def scenario():
+        scheduler, fired = deadlines.Deadlines(resync=0), []
+        _collect(scheduler, fired)
+        task = asyncio.create_task(scheduler.run())
+        await asyncio.sleep(0)
+        scheduler.arm(deadlines.CONFIRM, 7, time.time() + 0.05)
+        scheduler.arm(deadlines.CONFIRM, 7, time.time() + 10)
+        await asyncio.sleep(0.2)
+        early = list(fired)
+        scheduler.arm(deadlines.CONFIRM, 7, time.time())
+        await asyncio.sleep(0.05)
+        task.cancel()
+        return early, fired
+
+    early, fired = asyncio.run(scenario())
+    assert early == []
+    assert fired == [[7]]
+
+
+def test_driver_transitions_require_driver():
+    with pytest.raises(ValueError):
+        trip_states.transition_params("set_fare", 1, (100,))
+    assert "driver_id = ?" in trip_states.transition_sql("complete")
+    assert "driver_id" not in trip_states.transition_sql("expire")
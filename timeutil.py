@@ -0,0 +1,59 @@
+# timeutil.py
+# Все преобразования времени в одном месте. Для сравнений и диапазонов время
+# хранится в колонках *_ts целыми секундами Unix; текстовые колонки остались
+# для отображения. Исторически текст писался по-разному: datetime('now') в
+# SQLite — UTC без долей секунды, datetime.now() в Python — локальное время,
+# иногда с микросекундами. Флаг local говорит, какой из вариантов имеется в виду.
+import time
+from datetime import datetime, timedelta, timezone
+
+TEXT_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+def now_ts():
+    return int(time.time())
+
+
+def from_now(seconds=0, minutes=0, days=0):
+    return now_ts() + int(seconds + minutes * 60 + days * 86400)
+
+
+def to_ts(value, local=False):
+    """datetime, текст 'YYYY-MM-DD HH:MM:SS[.ffffff]' или число -> epoch; None -> None.
+
+    Время без часового пояса считается UTC, а с local=True — локальным.
+    """
+    if value is None or value == '':
+        return None
+    if isinstance(value, (int, float)):
+        return int(value)
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value)
+    if value.tzinfo is None and not local:
+        value = value.replace(tzinfo=timezone.utc)
+    return int(value.timestamp())
+
+
+def to_text(ts, local=False):
+    """epoch -> 'YYYY-MM-DD HH:MM:SS' в UTC (как datetime('now')) или в локальном времени."""
+    if ts is None:
+        return None
+    dt = datetime.fromtimestamp(ts) if local else datetime.fromtimestamp(ts, timezone.utc)
+    return dt.strftime(TEXT_FORMAT)
+
+
+def week_start(ts=None):
+    """Начало недели (понедельник 00:00 по местному времени), в которую попадает ts, -> epoch."""
+    dt = datetime.fromtimestamp(now_ts() if ts is None else ts)
+    monday = (dt - timedelta(days=dt.weekday())).replace(hour=0, minute=0, second=0, microsecond=0)
+    return int(monday.timestamp())
+
+
+def days_left(ts):
+    return max(0, (ts - now_ts()) // 86400)
+
+
+def sql_to_ts(column, local=False):
+    """SQL-выражение, переводящее текстовую колонку в epoch (для пакетной конвертации)."""
+    modifier = ", 'utc'" if local else ""
+    return f"CAST(strftime('%s', {column}{modifier}) AS INTEGER)"
@@ -0,0 +1,94 @@
+# trip_states.py
+# Жизненный цикл поездки одной таблицей переходов. Каждый переход — один
+# UPDATE ... WHERE id = ? AND status IN (допустимые) RETURNING *: условие и
+# запись атомарны, а вызывающий сразу получает свежую строку (или None, если
+# поездки нет или она уже в другом статусе). Поэтому повторное нажатие
+# «Прибыл» или «Завершить» ничего не меняет и не требует отдельного чтения.
+#
+#   requested --accept--> accepted --arrive--> in_progress --complete--> completed
+#     |   ^                  |   \_____________complete_____________/
+#     |   +----release-------+
+#     +-- expire             +---- cancel_* -------+--> cancelled*
+#
+# Завершить можно и без «Я на месте»: у водителя обе кнопки на одном сообщении.
+# release — водитель принял заказ, но не назначил цену вовремя (confirm_timeout_ts):
+# заказ возвращается в пул. Сроки expire и release отслеживает deadlines.py.
+#
+# Переходы водителя (DRIVER_TRANSITIONS) проверяют ещё и driver_id: после release
+# заказ может принять другой водитель, и старые кнопки или ввод цены прежнего
+# водителя не должны менять чужую поездку.
+import timeutil
+
+ACTIVE_STATUSES = ('requested', 'accepted', 'in_progress')
+
+# Переход -> (из каких статусов, новый статус или None, метка времени <stamp>_at/<stamp>_ts)
+TRANSITIONS = {
+    "accept": (('requested',), 'accepted', 'accepted'),
+    "arrive": (('accepted',), 'in_progress', 'arrived'),
+    "complete": (('accepted', 'in_progress'), 'completed', 'completed'),
+    "expire": (('requested',), 'expired', None),
+    "release": (('accepted',), 'requested', None),
+    "cancel": (ACTIVE_STATUSES, 'cancelled', None),  # диспетчер
+    "cancel_by_passenger": (ACTIVE_STATUSES, 'cancelled_by_passenger', None),
+    "cancel_by_driver": (('accepted', 'in_progress'), 'cancelled_by_driver', None),
+    # Цена меняется без смены статуса, пока поездка не завершена
+    "set_fare": (('accepted', 'in_progress'), None, None),
+}
+
+# Переходы, которые выполняет водитель поездки: UPDATE дополнительно требует driver_id = ?
+DRIVER_TRANSITIONS = frozenset(("arrive", "complete", "set_fare", "cancel_by_driver"))
+
+# Статус отмены (как его передают cancel_trip) -> переход
+CANCEL_TRANSITIONS = {
+    TRANSITIONS[name][1]: name for name in ("cancel", "cancel_by_passenger", "cancel_by_driver")
+}
+
+
+def _status_condition(sources):
+    if len(sources) == 1:
+        return f"status = '{sources[0]}'"
+    return f"status IN ({', '.join(repr(s) for s in sources)})"
+
+
+def status_condition(name):
+    """Условие на статус, при котором допустим переход name (для пакетных UPDATE)."""
+    return _status_condition(TRANSITIONS[name][0])
+
+
+def transition_sql(name, fields=(), placeholder="?", skip_locked=False):
+    """UPDATE для перехода name; fields — дополнительные колонки, которые он записывает.
+
+    Параметры запроса — transition_params(). skip_locked (PostgreSQL) пропускает
+    строку, которую уже меняет другая транзакция, вместо ожидания.
+    """
+    sources, target, stamp = TRANSITIONS[name]
+    p = placeholder
+    sets = [f"status = '{target}'"] if target else []
+    if stamp:
+        sets += [f"{stamp}_at = {p}", f"{stamp}_ts = {p}"]
+    sets += [f"{field} = {p}" for field in fields]
+    condition = _status_condition(sources)
+    if name in DRIVER_TRANSITIONS:
+        condition += f" AND driver_id = {p}"
+    if skip_locked:
+        where = f"id = (SELECT id FROM trips WHERE id = {p} AND {condition} FOR UPDATE SKIP LOCKED)"
+    else:
+        where = f"id = {p} AND {condition}"
+    return f"UPDATE trips SET {', '.join(sets)} WHERE {where} RETURNING *"
+
+
+def transition_params(name, trip_id, values=(), now=None, driver_id=None):
+    """Параметры для transition_sql(name, fields) в том же порядке: время, значения fields, id.
+
+    Для переходов водителя (DRIVER_TRANSITIONS) driver_id обязателен.
+    """
+    guard = ()
+    if name in DRIVER_TRANSITIONS:
+        if driver_id is None:
+            raise ValueError(f"Переход {name} выполняет водитель поездки: нужен driver_id")
+        guard = (driver_id,)
+    stamp = TRANSITIONS[name][2]
+    if stamp:
+        now = timeutil.now_ts() if now is None else now
+        return (timeutil.to_text(now), now, *values, trip_id, *guard)
+    return (*values, trip_id, *guard)